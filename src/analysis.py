@@ -0,0 +1,114 @@
+"""
+Vectorized orbital analysis of position histories
+
+The functions take position histories with the indices (..., snapshot, dim, celestial),
+e.g. a single Simulation.x_hist or the (run, snapshot, dim, celestial) stack of sweep.run_sweep,
+and analyze every object of every run at once.
+The results have the indices (..., celestial).
+"""
+
+import typing as tp
+
+import numpy as np
+
+
+def sines(x_hist: np.ndarray) -> np.ndarray:
+    """
+    Sine of the angle of each object in the xy plane with the indices (..., snapshot, celestial)
+
+    Undefined values at the ends of the histories, e.g. for an object that starts at the origin,
+    are replaced with the nearest defined values.
+    """
+    x_hist = np.asarray(x_hist)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sin = x_hist[..., 1, :] / np.linalg.norm(x_hist, axis=-2)
+
+    # The snapshots before the first and after the last defined value are mapped to these values.
+    defined = ~np.isnan(sin)
+    first = np.argmax(defined, axis=-2)[..., np.newaxis, :]
+    last = sin.shape[-2] - 1 - np.argmax(np.flip(defined, axis=-2), axis=-2)[..., np.newaxis, :]
+    snaps = np.arange(sin.shape[-2])[:, np.newaxis]
+    sin = np.take_along_axis(sin, np.clip(snaps, first, last), axis=-2)
+
+    if np.any(np.isnan(sin)):
+        raise ValueError("The computed sines should not contain nan values.")
+    return sin
+
+
+def _crossings(signal: np.ndarray) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """Rising-edge zero crossings of the signal and their fractional positions in units of snapshots"""
+    crossing = (signal[..., 1:, :] >= 0) & (signal[..., :-1, :] < 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        frac = -signal[..., :-1, :] / (signal[..., 1:, :] - signal[..., :-1, :])
+    return crossing, np.arange(crossing.shape[-2])[:, np.newaxis] + frac
+
+
+def _interval(dt: tp.Union[float, np.ndarray], save_interval: int) -> np.ndarray:
+    """Time between the snapshots, broadcastable over the celestials"""
+    return np.asarray(dt)[..., np.newaxis] * save_interval
+
+
+def crossing_times(
+        x_hist: np.ndarray,
+        dt: tp.Union[float, np.ndarray],
+        save_interval: int = 1) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """
+    Times of the rising-edge zero crossings of the sine of the angle of each object in the xy plane,
+    which are interpolated linearly between the snapshots.
+    :param dt: timestep, or an array of the timesteps of the runs
+    :return: the crossing times with the indices (..., crossing, celestial), padded with nan,
+        and the number of crossings with the indices (..., celestial)
+    """
+    crossing, pos = _crossings(sines(x_hist))
+    counts = crossing.sum(axis=-2)
+    # The rank of each crossing among the crossings of its object
+    rank = np.cumsum(crossing, axis=-2) - 1
+    times = np.full(crossing.shape[:-2] + (counts.max(initial=0), crossing.shape[-1]), np.nan)
+    ind = np.nonzero(crossing)
+    times[ind[:-2] + (rank[ind], ind[-1])] = pos[ind]
+    return times * _interval(dt, save_interval)[..., np.newaxis, :], counts
+
+
+def periods(x_hist: np.ndarray, dt: tp.Union[float, np.ndarray], save_interval: int = 1) -> np.ndarray:
+    """
+    Mean orbital period of each object from the zero crossings, see crossing_times
+    :return: periods in the units of dt, nan for the objects with less than two crossings
+    """
+    crossing, pos = _crossings(sines(x_hist))
+    counts = crossing.sum(axis=-2)
+    # The mean of the intervals between the crossings depends only on the first and the last crossing.
+    first = np.argmax(crossing, axis=-2)[..., np.newaxis, :]
+    last = (crossing.shape[-2] - 1 - np.argmax(np.flip(crossing, axis=-2), axis=-2))[..., np.newaxis, :]
+    span = np.take_along_axis(pos, last, axis=-2)[..., 0, :] - np.take_along_axis(pos, first, axis=-2)[..., 0, :]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 1, span / (counts - 1), np.nan) * _interval(dt, save_interval)
+
+
+def _radii(x_hist: np.ndarray, center: tp.Optional[int]) -> np.ndarray:
+    x_hist = np.asarray(x_hist)
+    if center is not None:
+        x_hist = x_hist - x_hist[..., center, np.newaxis]
+    return np.linalg.norm(x_hist, axis=-2)
+
+
+def radii(x_hist: np.ndarray, center: tp.Optional[int] = None) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """
+    Mean and standard deviation of the orbital radius of each object
+    :param center: index of the object the radii are measured from, or None for the origin
+    """
+    r = _radii(x_hist, center)
+    return r.mean(axis=-2), r.std(axis=-2)
+
+
+def eccentricities(x_hist: np.ndarray, center: tp.Optional[int] = None) -> np.ndarray:
+    """
+    Eccentricity of each orbit from its apocenter and pericenter distances, (r_max - r_min) / (r_max + r_min).
+    The histories should cover at least one full orbit.
+    :param center: index of the object the orbits are around, or None for the origin, e.g. the center of mass
+    :return: eccentricities, nan for the center object
+    """
+    r = _radii(x_hist, center)
+    r_max = r.max(axis=-2)
+    r_min = r.min(axis=-2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (r_max - r_min) / (r_max + r_min)
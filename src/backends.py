@@ -0,0 +1,263 @@
+"""
+Compute backends of the simulations
+
+A backend computes the forces and advances the fixed-step integrators for Simulation.
+The Fortran backend uses the compiled core, and the NumPy backend is a vectorized implementation
+that works without a Fortran compiler. The arrays have the Fortran-ordered indices (dim, celestial) of the core,
+and the histories are C-ordered with the indices (snapshot, dim, celestial) as in Simulation.x_hist.
+"""
+
+import abc
+import logging
+import typing as tp
+
+import numpy as np
+
+try:
+    # Your IDE may complain that the module does not exist, since the generated Python module is found dynamically
+    import core
+except ImportError:
+    core = None
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("auto", "fortran", "numpy")
+# The NumPy backend computes the interactions of this many pairs at a time, which bounds its memory use
+NUMPY_CHUNK_PAIRS = 2**18
+# Composition weights of the velocity-Verlet substeps, see core.symplectic_step
+FR_W1 = 1 / (2 - 2**(1/3))
+SYMPLECTIC_WEIGHTS = {
+    2: (1.,),
+    4: (FR_W1, 1 - 2*FR_W1, FR_W1),
+    6: (0.784513610477560, 0.235573213359357, -1.17767998417887,
+        1 - 2*(-1.17767998417887 + 0.235573213359357 + 0.784513610477560),
+        -1.17767998417887, 0.235573213359357, 0.784513610477560),
+}
+
+
+class Backend(abc.ABC):
+    """Interface of the compute backends"""
+    name: str = ""
+    forces: tp.Tuple[str, ...] = ()
+    integrators: tp.Tuple[str, ...] = ()
+
+    @abc.abstractmethod
+    def compute_accel(
+            self, x: np.ndarray, m: np.ndarray, g: float, min_dist: float,
+            theta: float = 0) -> tp.Tuple[np.ndarray, float]:
+        """
+        Accelerations of all the objects and the total potential energy
+        :param theta: opening angle of the Barnes-Hut tree, 0 for the direct sum
+            and negative for the mixed-precision direct sum
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def accel_direct(
+            self, x: np.ndarray, m: np.ndarray, g: float, min_dist: float, inds: np.ndarray = None) -> np.ndarray:
+        """Accelerations of the objects with the given indices, or of all the objects, by the direct sum"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def diagnostics(self, x: np.ndarray, v: np.ndarray, m: np.ndarray, pot: float) -> np.ndarray:
+        """Conservation diagnostics of the state in the order of sim.DIAGNOSTICS_DTYPE"""
+        raise NotImplementedError
+
+    def set_threads(self, n_threads: int):
+        """Set the number of threads, where values below 1 keep the current setting"""
+
+    @abc.abstractmethod
+    def iterate_hist(
+            self,
+            x: np.ndarray,
+            v: np.ndarray,
+            a: np.ndarray,
+            m: np.ndarray,
+            dt: float,
+            save_interval: int,
+            g: float,
+            min_dist: float,
+            x_hist: np.ndarray,
+            v_hist: np.ndarray = None,
+            x_scale: float = 1,
+            v_scale: float = 1,
+            use_rk4: bool = False,
+            theta: float = 0,
+            n_threads: int = 0,
+            order: int = 2,
+            diag: np.ndarray = None,
+            energy_ref: float = 0,
+            max_drift: float = 0) -> int:
+        """
+        Advance the state in place by save_interval steps of a fixed-step integrator for each row of the histories,
+        which are filled with the scaled snapshots as in core.iterate_hist.
+        :param order: order of the symplectic integrator when use_rk4 is False, see core.symplectic_step
+        :param diag: diagnostics of each snapshot with the indices (snapshot, value)
+        :return: number of snapshots written, which is smaller than requested if the energy drifted
+        """
+        raise NotImplementedError
+
+
+class FortranBackend(Backend):
+    """The compiled Fortran core with OpenMP threading and the Barnes-Hut tree"""
+    name = "fortran"
+    forces = ("direct", "tree", "mixed")
+    integrators = ("verlet", "forest_ruth", "yoshida6", "rk4", "rk45", "wh", "block")
+
+    def __init__(self):
+        if core is None:
+            raise ImportError("The Fortran core has not been compiled. Build it with build.py or \"make python\".")
+
+    @property
+    def core(self):
+        """The core module for the integrators that only the Fortran backend provides"""
+        return core.core
+
+    def compute_accel(self, x, m, g, min_dist, theta=0):
+        return core.core.compute_accel(x, m, g, min_dist, theta)
+
+    def accel_direct(self, x, m, g, min_dist, inds=None):
+        if inds is None:
+            return core.core.accel_all(x, m, g, min_dist)[0]
+        # The Fortran indexing starts from 1
+        return np.array([core.core.accel(x, x[:, i], m, i + 1, g, min_dist) for i in inds]).T
+
+    def diagnostics(self, x, v, m, pot):
+        return core.core.compute_diagnostics(x, v, m, pot)
+
+    def set_threads(self, n_threads):
+        core.core.set_threads(n_threads)
+
+    def iterate_hist(
+            self, x, v, a, m, dt, save_interval, g, min_dist, x_hist, v_hist=None, x_scale=1, v_scale=1,
+            use_rk4=False, theta=0, n_threads=0, order=2, diag=None, energy_ref=0, max_drift=0):
+        kwargs = {}
+        # The transposes are Fortran-ordered views, which the core fills in place.
+        if v_hist is not None:
+            kwargs["v_hist"] = v_hist.T
+        if diag is not None:
+            kwargs.update(diag=diag.T, energy_ref=energy_ref, max_drift=max_drift)
+        return core.core.iterate_hist(
+            x, v, a, m, dt,
+            save_interval=save_interval,
+            g=g,
+            min_dist=min_dist,
+            x_hist=x_hist.T,
+            x_scale=x_scale,
+            v_scale=v_scale,
+            use_rk4=use_rk4,
+            theta=theta,
+            n_threads=n_threads,
+            order=order,
+            **kwargs)
+
+
+class NumpyBackend(Backend):
+    """
+    Vectorized direct sum with NumPy broadcasting, which needs no compiler.
+    The pairwise interactions are computed in chunks of rows, so the memory use is O(N) instead of O(N^2).
+    """
+    name = "numpy"
+    forces = ("direct",)
+    integrators = ("verlet", "forest_ruth", "yoshida6", "rk4")
+
+    def _accel_rows(
+            self, x: np.ndarray, m: np.ndarray, g: float, min_dist: float,
+            inds: np.ndarray) -> tp.Tuple[np.ndarray, float]:
+        """Accelerations of the given objects and the sum of m_i*m_j/r over their pairs with all the objects"""
+        min_dist2 = min_dist**2
+        a = np.empty((3, inds.size))
+        pot = 0.
+        chunk = max(1, NUMPY_CHUNK_PAIRS // m.size)
+        for start in range(0, inds.size, chunk):
+            rows = inds[start:start + chunk]
+            # Indices: (dim, row, celestial)
+            d = x[:, np.newaxis, :] - x[:, rows, np.newaxis]
+            dist2 = np.einsum("kij,kij->ij", d, d)
+            # The clipping is the same as in the core, which also excludes the object itself.
+            near = dist2 <= min_dist2
+            dist2[near] = 1
+            inv_dist = 1 / np.sqrt(dist2)
+            inv_dist[near] = 0
+            weights = m * inv_dist**3
+            a[:, start:start + chunk] = np.einsum("ij,kij->ki", weights, d)
+            pot += np.dot(m[rows], inv_dist @ m)
+        return g*a, pot
+
+    def compute_accel(self, x, m, g, min_dist, theta=0):
+        if theta != 0:
+            raise ValueError("The NumPy backend supports only the direct force.")
+        a, pot = self._accel_rows(x, m, g, min_dist, np.arange(m.size))
+        # Each pair was counted twice
+        return np.asfortranarray(a), -g*pot/2
+
+    def accel_direct(self, x, m, g, min_dist, inds=None):
+        return self._accel_rows(x, m, g, min_dist, np.arange(m.size) if inds is None else np.asarray(inds))[0]
+
+    def diagnostics(self, x, v, m, pot):
+        return np.concatenate([
+            [np.sum(m * np.sum(v**2, axis=0)) / 2, pot],
+            v @ m,
+            np.cross(x, v, axis=0) @ m,
+            x @ m / np.sum(m),
+        ])
+
+    def _verlet_step(self, x, v, a, m, dt, g, min_dist) -> float:
+        x += v*dt + 0.5*a*dt**2
+        a_prev = a.copy()
+        a[:], pot = self.compute_accel(x, m, g, min_dist)
+        v += 0.5*(a + a_prev)*dt
+        return pot
+
+    def _rk4_step(self, x, v, a, m, dt, g, min_dist):
+        a[:] = self.compute_accel(x, m, g, min_dist)[0]
+        k2r = v + a * dt/2
+        k2v = self.compute_accel(x + v * dt/2, m, g, min_dist)[0]
+        k3r = v + k2v * dt/2
+        k3v = self.compute_accel(x + k2r * dt/2, m, g, min_dist)[0]
+        k4r = v + k3v * dt
+        k4v = self.compute_accel(x + k3r * dt, m, g, min_dist)[0]
+        x += dt/6 * (v + 2*k2r + 2*k3r + k4r)
+        v += dt/6 * (a + 2*k2v + 2*k3v + k4v)
+
+    def iterate_hist(
+            self, x, v, a, m, dt, save_interval, g, min_dist, x_hist, v_hist=None, x_scale=1, v_scale=1,
+            use_rk4=False, theta=0, n_threads=0, order=2, diag=None, energy_ref=0, max_drift=0):
+        if theta != 0:
+            raise ValueError("The NumPy backend supports only the direct force.")
+        weights = SYMPLECTIC_WEIGHTS[order]
+        for snap in range(x_hist.shape[0]):
+            for _ in range(save_interval):
+                if use_rk4:
+                    self._rk4_step(x, v, a, m, dt, g, min_dist)
+                    continue
+                for weight in weights:
+                    pot = self._verlet_step(x, v, a, m, weight*dt, g, min_dist)
+            x_hist[snap] = x_scale*x
+            if v_hist is not None:
+                v_hist[snap] = v_scale*v
+            if diag is not None:
+                if use_rk4:
+                    pot = self.compute_accel(x, m, g, min_dist)[1]
+                diag[snap] = self.diagnostics(x, v, m, pot)
+                if max_drift > 0 and abs(diag[snap, 0] + diag[snap, 1] - energy_ref) > max_drift*abs(energy_ref):
+                    return snap + 1
+        return x_hist.shape[0]
+
+
+def get_backend(name: str = "auto") -> Backend:
+    """
+    Get a backend by its name, one of BACKENDS.
+    The "auto" selection uses the Fortran core when it has been compiled and otherwise falls back to NumPy.
+    The core is faster for all system sizes, by a factor of about 10 for a single thread, see bench.bench_backends.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend: {name}. Available: {BACKENDS}")
+    if name == "fortran":
+        return FortranBackend()
+    if name == "numpy":
+        return NumpyBackend()
+    if core is None:
+        logger.warning("The Fortran core has not been compiled, so the slower NumPy backend is used.")
+        return NumpyBackend()
+    return FortranBackend()
@@ -0,0 +1,516 @@
+"""
+Performance benchmarks of planetary-motion
+
+The Fortran core has to be compiled before running these, e.g. with "make all".
+
+The benchmark suite (run_suite) measures the times of the main code paths and stores them as JSON.
+The results can be compared against a baseline file to flag regressions, e.g.
+python3 bench.py --suite --output bench.json --baseline bench_baseline.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import typing as tp
+
+import numpy as np
+
+import analysis
+import backends
+# Your IDE may complain that the module does not exist, since the generated Python module is found dynamically
+import core
+import ics
+import plotting
+import sim
+
+logger = logging.getLogger(__name__)
+
+
+def random_system(n_objs: int, seed: int = 0) -> tp.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Random cluster in the Fortran order used by the core, similar to main.nbody_test2"""
+    rng = np.random.default_rng(seed)
+    x = np.asfortranarray(2*rng.random((3, n_objs)) - 1)
+    v = np.asfortranarray((2*rng.random((3, n_objs)) - 1)*0.1)
+    a = np.zeros_like(x)
+    m = np.ones(n_objs, order="F")
+    return x, v, a, m
+
+
+def bench_threads(
+        n_objs: int = 5000,
+        n_steps: int = 10,
+        max_threads: int = None,
+        theta: float = 0) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """
+    Speedup of the Verlet integrator as a function of the number of OpenMP threads
+    :param theta: opening angle of the Barnes-Hut tree, 0 for the direct sum
+    :return: thread counts and the corresponding speedups compared to a single thread
+    """
+    if max_threads is None:
+        max_threads = os.cpu_count()
+    threads = np.arange(1, max_threads + 1)
+    times = np.zeros(threads.size)
+    for i, n_threads in enumerate(threads):
+        x, v, a, m = random_system(n_objs)
+        start = time.perf_counter()
+        core.core.iterate(x, v, a, m, 1e-3, n_steps=n_steps, g=1, min_dist=1e-4, theta=theta, n_threads=n_threads)
+        times[i] = time.perf_counter() - start
+        logger.info("Threads: %s, time: %s s, speedup: %s", n_threads, times[i], times[0] / times[i])
+    return threads, times[0] / times
+
+
+def total_energy(x: np.ndarray, v: np.ndarray, m: np.ndarray, g: float) -> np.ndarray:
+    """
+    Total energy of each snapshot
+    :param x: positions with the indices (snapshot, dim, celestial)
+    :param v: velocities with the indices (snapshot, dim, celestial)
+    """
+    kinetic = 0.5 * np.sum(m * np.sum(v**2, axis=1), axis=-1)
+    dist = np.linalg.norm(x[:, :, :, np.newaxis] - x[:, :, np.newaxis, :], axis=1)
+    i, j = np.triu_indices(m.size, k=1)
+    potential = -g * np.sum(m[i] * m[j] / dist[:, i, j], axis=-1)
+    return kinetic + potential
+
+
+def eccentric_system() -> tp.List[sim.Celestial]:
+    """A star with two planets on eccentric orbits in units where G=1, the inner period being about 2 pi"""
+    star = sim.Celestial(x=np.zeros(3), v=np.zeros(3), m=1, radius=1)
+    return [
+        star,
+        sim.Celestial(x=np.array([1., 0, 0]), v=np.array([0, 1.2, 0]), m=1e-3, radius=1, reference=star),
+        sim.Celestial(x=np.array([0, -3., 0]), v=np.array([0.45, 0, 0.05]), m=1e-4, radius=1, reference=star),
+    ]
+
+
+def bench_integrators(
+        integrators: tp.Sequence[str] = None,
+        dts: tp.Sequence[float] = (0.1, 0.05, 0.02, 0.01, 0.005),
+        rtols: tp.Sequence[float] = (1e-5, 1e-7, 1e-9, 1e-11),
+        t_end: float = 200,
+        n_saves: int = 200) -> tp.List[tp.Dict[str, tp.Any]]:
+    """
+    Cost versus accuracy of the integrators
+    The fixed-step integrators are run with each of the timesteps and the adaptive rk45 with each of the tolerances.
+    The accuracy is measured by the maximum relative energy error over the saved snapshots.
+    :return: a dict for each run with the integrator, dt or rtol, force evaluations, time and energy error
+    """
+    if integrators is None:
+        integrators = sim.INTEGRATORS
+    results = []
+    for integrator in integrators:
+        settings = [(dt_ref, None) for dt_ref in dts] if integrator != "rk45" else [(dts[0], rtol) for rtol in rtols]
+        for dt, rtol in settings:
+            # Round the number of steps so that the run ends at t_end
+            save_interval = max(1, round(t_end / n_saves / dt))
+            steps = save_interval * n_saves
+            simulation = sim.Simulation(eccentric_system(), dt=t_end / steps, save_velocities=True)
+            kwargs = {} if rtol is None else {"rtol": rtol, "atol": 1e-3 * rtol}
+            start = time.perf_counter()
+            simulation.run(steps, save_interval, integrator=integrator, **kwargs)
+            elapsed = time.perf_counter() - start
+            energy = total_energy(simulation.x_hist, simulation.v_hist, simulation.m, simulation.g)
+            result = {
+                "integrator": integrator,
+                "dt": simulation.dt,
+                "rtol": rtol,
+                "n_force_evals": simulation.n_force_evals,
+                "time": elapsed,
+                "energy_error": float(np.max(np.abs(energy / energy[0] - 1))),
+            }
+            logger.info(
+                "%s, dt: %s, rtol: %s, force evaluations: %s, time: %s s, energy error: %s",
+                integrator, result["dt"], rtol, result["n_force_evals"], elapsed, result["energy_error"])
+            results.append(result)
+    return results
+
+
+def bench_backends(
+        sizes: tp.Sequence[int] = (2, 10, 100, 1000, 4000),
+        n_steps: int = 10,
+        integrators: tp.Sequence[str] = ("verlet", "rk4")) -> tp.List[tp.Dict[str, tp.Any]]:
+    """
+    Parity and timings of the compute backends
+    Each backend is run from the same random system, and the positions are compared to the Fortran backend.
+    :return: a dict for each run with the backend, the number of objects, time per step and the maximum
+        relative difference of the positions and of the accelerations compared to the Fortran backend
+    """
+    results = []
+    for n_objs in sizes:
+        for integrator in integrators:
+            reference = None
+            for name in ("fortran", "numpy"):
+                backend = backends.get_backend(name)
+                x, v, _, m = random_system(n_objs)
+                a, _ = backend.compute_accel(x, m, 1, 1e-4)
+                x_hist = np.empty((1, *x.shape))
+                start = time.perf_counter()
+                backend.iterate_hist(
+                    x, v, a, m, 1e-3, save_interval=n_steps, g=1, min_dist=1e-4, x_hist=x_hist,
+                    use_rk4=integrator == "rk4", order=sim.SYMPLECTIC_ORDERS.get(integrator, 2))
+                elapsed = time.perf_counter() - start
+                if reference is None:
+                    reference = (x_hist[0], a)
+                result = {
+                    "backend": name,
+                    "n_objs": n_objs,
+                    "integrator": integrator,
+                    "time_per_step": elapsed / n_steps,
+                    "x_diff": float(np.max(np.abs(x_hist[0] - reference[0])) / np.max(np.abs(reference[0]))),
+                    "a_diff": float(np.max(np.abs(a - reference[1])) / np.max(np.abs(reference[1]))),
+                }
+                logger.info(
+                    "%s, N: %s, %s, time per step: %s s, position difference: %s, acceleration difference: %s",
+                    name, n_objs, integrator, result["time_per_step"], result["x_diff"], result["a_diff"])
+                results.append(result)
+    return results
+
+def bench_precision(
+        sizes: tp.Sequence[int] = (100, 1000, 4000, 16000)) -> tp.List[tp.Dict[str, tp.Any]]:
+    """
+    Throughput and accuracy of the mixed-precision force compared to the double-precision direct sum
+    The forces are evaluated for Plummer spheres of the given sizes.
+    :return: a dict for each size with the times of a force evaluation, the speedup
+        and the mean and maximum relative error of the mixed-precision accelerations
+    """
+    results = []
+    for n_objs in sizes:
+        x, _, m = ics.plummer(n_objs, seed=0)
+        x = np.asfortranarray(x.T)
+        a_double, _ = core.core.compute_accel(x, m, 1, 1e-3, 0)
+        a_mixed, _ = core.core.compute_accel(x, m, 1, 1e-3, -1)
+        error = np.linalg.norm(a_mixed - a_double, axis=0) / np.linalg.norm(a_double, axis=0)
+        # The small systems are evaluated many times for a measurable time
+        number = max(1, 10**7 // n_objs**2)
+        time_double = _timeit(lambda: core.core.compute_accel(x, m, 1, 1e-3, 0), number=number)
+        time_mixed = _timeit(lambda: core.core.compute_accel(x, m, 1, 1e-3, -1), number=number)
+        result = {
+            "n_objs": n_objs,
+            "time_double": time_double,
+            "time_mixed": time_mixed,
+            "speedup": time_double / time_mixed,
+            "error_mean": float(np.mean(error)),
+            "error_max": float(np.max(error)),
+        }
+        logger.info(
+            "N: %s, double: %s s, mixed: %s s, speedup: %s, mean error: %s, max error: %s",
+            n_objs, time_double, time_mixed, result["speedup"], result["error_mean"], result["error_max"])
+        results.append(result)
+    return results
+
+
+def bench_precision_energy(
+        integrators: tp.Sequence[str] = ("verlet", "yoshida6"),
+        dts: tp.Sequence[float] = (0.1, 0.01, 0.001),
+        t_end: float = 200,
+        n_saves: int = 200) -> tp.List[tp.Dict[str, tp.Any]]:
+    """
+    Energy error of the mixed-precision force compared to the direct sum as a function of the timestep
+    The mixed precision is safe when the integration error is larger than its error floor of about 1e-7,
+    e.g. with velocity Verlet for dt > 0.001, but it spoils the accuracy of the high-order integrators at short steps.
+    :return: a dict for each run with the integrator, dt and the maximum relative energy error of both forces
+    """
+    results = []
+    for integrator in integrators:
+        for dt in dts:
+            save_interval = max(1, round(t_end / n_saves / dt))
+            steps = save_interval * n_saves
+            result = {"integrator": integrator, "dt": t_end / steps}
+            for force in ("direct", "mixed"):
+                simulation = sim.Simulation(eccentric_system(), dt=t_end / steps, save_velocities=True, force=force)
+                simulation.run(steps, save_interval, integrator=integrator)
+                energy = total_energy(simulation.x_hist, simulation.v_hist, simulation.m, simulation.g)
+                result[f"energy_error_{force}"] = float(np.max(np.abs(energy / energy[0] - 1)))
+            logger.info(
+                "%s, dt: %s, energy error: %s (direct), %s (mixed)",
+                integrator, result["dt"], result["energy_error_direct"], result["energy_error_mixed"])
+            results.append(result)
+    return results
+
+# Benchmark suite
+
+# Version of the JSON format of the suite results
+SUITE_VERSION = 1
+# A benchmark is flagged as a regression if it is slower than the baseline by more than this fraction
+DEFAULT_TOLERANCE = 0.25
+
+
+def _timeit(func: tp.Callable[[], tp.Any], repeat: int = 3, number: int = 1) -> float:
+    """Minimum time of a call over the repeats (s), which is the least affected by other processes"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return min(times)
+
+
+def circular_orbits(n_runs: int, n_snaps: int, n_objs: int) -> np.ndarray:
+    """Synthetic histories of circular orbits with the indices (run, snapshot, dim, celestial)"""
+    t = np.arange(n_snaps)[:, np.newaxis]
+    radii = np.arange(1, n_objs + 1)
+    # Kepler's third law
+    omega = 2*np.pi / (100 * radii**1.5)
+    phase = omega * t * (1 + 1e-3*np.arange(n_runs))[:, np.newaxis, np.newaxis]
+    x_hist = np.zeros((n_runs, n_snaps, 3, n_objs))
+    x_hist[:, :, 0] = radii * np.cos(phase)
+    x_hist[:, :, 1] = radii * np.sin(phase)
+    return x_hist
+
+
+def suite_steps(sizes: tp.Sequence[int] = (2, 10, 100, 1000), n_steps: int = 100) -> tp.Dict[str, float]:
+    """Time per step of core.iterate (velocity Verlet) and core.iterate_rk4 as a function of the number of objects"""
+    results = {}
+    for n_objs in sizes:
+        # Keep the cost of each measurement roughly constant
+        steps = max(1, n_steps * 100 // n_objs)
+        for name, func in (("iterate", core.core.iterate), ("iterate_rk4", core.core.iterate_rk4)):
+            x, v, a, m = random_system(n_objs)
+            results[f"steps/{name}/N={n_objs}"] = _timeit(
+                lambda: func(x, v, a, m, 1e-3, n_steps=steps, g=1, min_dist=1e-4)) / steps
+    return results
+
+
+def suite_precision(sizes: tp.Sequence[int] = (1000, 4000)) -> tp.Dict[str, float]:
+    """Time of a force evaluation with the double-precision and the mixed-precision direct sum"""
+    results = {}
+    for n_objs in sizes:
+        x, _, _, m = random_system(n_objs)
+        results[f"force/direct/objs={n_objs}"] = _timeit(lambda: core.core.compute_accel(x, m, 1, 1e-4, 0))
+        results[f"force/mixed/objs={n_objs}"] = _timeit(lambda: core.core.compute_accel(x, m, 1, 1e-4, -1))
+    return results
+
+
+def suite_save_interval(
+        save_intervals: tp.Sequence[int] = (1, 10, 100, 1000),
+        steps: int = 10000) -> tp.Dict[str, float]:
+    """Time per step of Simulation.run as a function of the save interval, which shows the overhead of saving"""
+    results = {}
+    for save_interval in save_intervals:
+        def run():
+            simulation = sim.Simulation(eccentric_system(), dt=1e-3)
+            simulation.run(steps, save_interval)
+        results[f"run/save_interval={save_interval}"] = _timeit(run) / steps
+    return results
+
+
+def suite_history(n_snaps: tp.Sequence[int] = (10**3, 10**5), n_objs: int = 9) -> tp.Dict[str, float]:
+    """Cost of converting a history to a new array with np.array, e.g. for plotting"""
+    results = {}
+    for snaps in n_snaps:
+        x_hist = circular_orbits(1, snaps, n_objs)[0]
+        results[f"history/np.array/snaps={snaps}"] = _timeit(lambda: np.array(x_hist))
+    return results
+
+
+def suite_analysis(n_runs: int = 50, n_snaps: int = 10**4, n_objs: int = 9) -> tp.Dict[str, float]:
+    """Analysis of a sweep of histories with the functions of the analysis module"""
+    x_hist = circular_orbits(n_runs, n_snaps, n_objs)
+    dts = np.ones(n_runs)
+    return {
+        "analysis/periods": _timeit(lambda: analysis.periods(x_hist, dts)),
+        "analysis/crossing_times": _timeit(lambda: analysis.crossing_times(x_hist, dts)),
+        "analysis/radii": _timeit(lambda: analysis.radii(x_hist)),
+        "analysis/eccentricities": _timeit(lambda: analysis.eccentricities(x_hist)),
+    }
+
+
+def suite_plotting(n_snaps: tp.Sequence[int] = (10**4, 10**6), n_out: int = 2560) -> tp.Dict[str, float]:
+    """Decimation of an orbit for plotting, without the cache"""
+    results = {}
+    for snaps in n_snaps:
+        x, y = circular_orbits(1, snaps, 2)[0, :, :2, 1].T
+        results[f"plotting/lttb/snaps={snaps}"] = _timeit(lambda: plotting.lttb_indices(x, y, n_out))
+        results[f"plotting/minmax/snaps={snaps}"] = _timeit(lambda: plotting.minmax_indices(y, n_out // 2))
+    return results
+
+
+def suite_ics(n_objs: int = 10**6, n_sim: int = 10**4, path: str = "bench_ics.npy") -> tp.Dict[str, float]:
+    """
+    Generation of initial conditions, their save and load, and the creation of a simulation from them
+    compared to creating it from celestials
+    """
+    results = {
+        f"ics/plummer/objs={n_objs}": _timeit(lambda: ics.plummer(n_objs, seed=0)),
+        f"ics/belt/objs={n_objs}": _timeit(lambda: ics.belt(n_objs, seed=0)),
+    }
+    x, v, m = ics.plummer(n_objs, seed=0)
+    try:
+        results[f"ics/save/objs={n_objs}"] = _timeit(lambda: ics.save(path, x, v, m))
+        results[f"ics/load/objs={n_objs}"] = _timeit(lambda: [np.array(arr) for arr in ics.load(path)])
+    finally:
+        os.remove(path)
+    # The initial accelerations are computed only when the simulation is run
+    x, v, m = x[:n_sim], v[:n_sim], m[:n_sim]
+    results[f"ics/from_arrays/objs={n_sim}"] = _timeit(
+        lambda: sim.Simulation.from_arrays(x, v, m, dt=1e-3, min_dist=1e-3))
+    results[f"ics/from_celestials/objs={n_sim}"] = _timeit(lambda: sim.Simulation(
+        [sim.Celestial(x=x[i].copy(), v=v[i].copy(), m=m[i], radius=1) for i in range(n_sim)],
+        dt=1e-3, min_dist=1e-3))
+    return results
+
+
+def suite_gui(n_snaps: int = 10**5, n_objs: int = 100, n_redraws: int = 100) -> tp.Dict[str, float]:
+    """Latency of MainWindow.redraw with a large history, skipped if the GUI libraries are not installed"""
+    try:
+        import pyqtgraph as pg
+        from gui import MainWindow
+    except ImportError as e:
+        logger.warning("Skipping the GUI benchmark: %s", e)
+        return {}
+    app = pg.mkQApp()
+    x, v, _, m = random_system(n_objs)
+    simulation = sim.Simulation.from_arrays(x.T, v.T, m, dt=1e-3)
+    simulation.x_hist = np.random.default_rng().random((n_snaps, 3, n_objs))
+    win = MainWindow(simulation)
+    inds = np.linspace(0, n_snaps - 1, n_redraws).astype(int)
+
+    def redraw():
+        for i in inds:
+            win.redraw(i)
+            app.processEvents()
+    return {f"gui/redraw/snaps={n_snaps}": _timeit(redraw) / n_redraws}
+
+
+def run_suite(quick: bool = False) -> tp.Dict[str, tp.Any]:
+    """
+    Run the benchmark suite
+    :param quick: use smaller problems, e.g. for checking that the suite runs
+    :return: the metadata of the machine and the times of the benchmarks (s) by their names
+    """
+    results = {}
+    if quick:
+        results.update(suite_steps(sizes=(2, 100), n_steps=10))
+        results.update(suite_precision(sizes=(1000,)))
+        results.update(suite_save_interval(save_intervals=(1, 100), steps=1000))
+        results.update(suite_history(n_snaps=(10**3,)))
+        results.update(suite_analysis(n_runs=5, n_snaps=10**3))
+        results.update(suite_plotting(n_snaps=(10**4,)))
+        results.update(suite_ics(n_objs=10**4, n_sim=10**3))
+        results.update(suite_gui(n_snaps=10**3, n_redraws=10))
+    else:
+        results.update(suite_steps())
+        results.update(suite_precision())
+        results.update(suite_save_interval())
+        results.update(suite_history())
+        results.update(suite_analysis())
+        results.update(suite_plotting())
+        results.update(suite_ics())
+        results.update(suite_gui())
+    for name, value in results.items():
+        logger.info("%s: %s s", name, value)
+    return {
+        "version": SUITE_VERSION,
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": sys.version,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "threads": int(core.core.get_threads()),
+            "quick": quick,
+        },
+        "results": results,
+    }
+
+
+def save_results(results: tp.Dict[str, tp.Any], path: str):
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+
+
+def load_results(path: str) -> tp.Dict[str, tp.Any]:
+    with open(path) as file:
+        results = json.load(file)
+    if results.get("version") != SUITE_VERSION:
+        raise ValueError(f"Unsupported benchmark result version in {path}: {results.get('version')}")
+    return results
+
+
+def compare(
+        results: tp.Dict[str, tp.Any],
+        baseline: tp.Dict[str, tp.Any],
+        tolerance: float = DEFAULT_TOLERANCE) -> tp.Dict[str, float]:
+    """
+    Compare the results of the suite to a baseline
+    :param tolerance: allowed relative slowdown
+    :return: the ratios of the times to the baseline for the benchmarks that regressed
+    """
+    if results["meta"]["quick"] != baseline["meta"]["quick"]:
+        logger.warning("Comparing a quick run to a full run, or vice versa")
+    regressions = {}
+    for name, value in results["results"].items():
+        if name not in baseline["results"]:
+            logger.info("%s: no baseline", name)
+            continue
+        ratio = value / baseline["results"][name]
+        if ratio > 1 + tolerance:
+            logger.warning("%s: %.3g s, %.2fx slower than the baseline", name, value, ratio)
+            regressions[name] = ratio
+        else:
+            logger.info("%s: %.3g s, %.2fx the baseline", name, value, ratio)
+    return regressions
+
+
+def plot_cost_accuracy(results: tp.List[tp.Dict[str, tp.Any]], path: str = None):
+    import matplotlib.pyplot as plt
+
+    fig: plt.Figure = plt.figure()
+    ax: plt.Axes = fig.add_subplot()
+    for integrator in dict.fromkeys(result["integrator"] for result in results):
+        runs = [result for result in results if result["integrator"] == integrator]
+        ax.loglog(
+            [run["n_force_evals"] for run in runs], [run["energy_error"] for run in runs],
+            marker=".", label=integrator)
+    ax.set_xlabel("Force evaluations")
+    ax.set_ylabel("Max. relative energy error")
+    ax.legend()
+    if path is not None:
+        fig.savefig(path)
+    return ax
+
+
+def plot_speedup(threads: np.ndarray, speedup: np.ndarray, path: str = None):
+    # Matplotlib is imported here so that the benchmarks can be run without it.
+    import matplotlib.pyplot as plt
+
+    fig: plt.Figure = plt.figure()
+    ax: plt.Axes = fig.add_subplot()
+    ax.plot(threads, speedup, marker=".", label="measured")
+    ax.plot(threads, threads, ls="--", color="black", label="ideal")
+    ax.set_xlabel("Threads")
+    ax.set_ylabel("Speedup")
+    ax.legend()
+    if path is not None:
+        fig.savefig(path)
+    return ax
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suite", action="store_true", help="run the benchmark suite instead of the studies")
+    parser.add_argument("--quick", action="store_true", help="use smaller problems in the suite")
+    parser.add_argument("--output", help="JSON file for the results of the suite")
+    parser.add_argument("--baseline", help="JSON file of earlier results to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed relative slowdown compared to the baseline")
+    args = parser.parse_args()
+
+    if not args.suite:
+        bench_threads()
+        bench_integrators()
+        bench_backends()
+        bench_precision()
+        bench_precision_energy()
+        sys.exit()
+    suite_results = run_suite(quick=args.quick)
+    if args.output:
+        save_results(suite_results, args.output)
+    if args.baseline:
+        if compare(suite_results, load_results(args.baseline), tolerance=args.tolerance):
+            sys.exit(1)
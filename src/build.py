@@ -0,0 +1,105 @@
+"""
+Cached building of the f2py module of the Fortran core
+
+The module is rebuilt only when a hash of core.f90, the compiler flags and the Python environment changes.
+The hash of the latest build is stored next to the module by the python target of the Makefile,
+so that the builds made with make are recognized as well.
+Run this file directly to build the module from the command line.
+"""
+
+import argparse
+import hashlib
+import importlib.machinery
+import logging
+import os
+import re
+import subprocess
+import sys
+import typing as tp
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_PATH = os.path.join(SRC_DIR, "core.f90")
+MAKEFILE_PATH = os.path.join(SRC_DIR, "Makefile")
+HASH_PATH = os.path.join(SRC_DIR, ".core-build-hash")
+
+
+def default_fflags() -> str:
+    """Compiler flags of the Makefile"""
+    with open(MAKEFILE_PATH) as file:
+        match = re.search(r"^FFLAGS\s*=(.*)$", file.read(), flags=re.MULTILINE)
+    if match is None:
+        raise ValueError(f"FFLAGS not found in {MAKEFILE_PATH}")
+    return match.group(1).strip()
+
+
+def build_hash(fflags: str) -> str:
+    """Hash of everything that affects the compiled module"""
+    digest = hashlib.sha256()
+    with open(SOURCE_PATH, "rb") as file:
+        digest.update(file.read())
+    for item in (fflags, sys.version, np.__version__, importlib.machinery.EXTENSION_SUFFIXES[0]):
+        digest.update(b"\0" + item.encode())
+    return digest.hexdigest()
+
+
+def module_path() -> tp.Optional[str]:
+    """Path of the compiled module for this Python version, if it exists"""
+    path = os.path.join(SRC_DIR, "core" + importlib.machinery.EXTENSION_SUFFIXES[0])
+    return path if os.path.isfile(path) else None
+
+
+def is_current(fflags: str) -> bool:
+    if module_path() is None or not os.path.isfile(HASH_PATH):
+        return False
+    with open(HASH_PATH) as file:
+        return file.read().strip() == build_hash(fflags)
+
+
+def write_hash(fflags: str):
+    """Record the module as built with the given flags"""
+    with open(HASH_PATH, "w") as file:
+        file.write(build_hash(fflags))
+
+
+def ensure_core(fflags: str = None, force: bool = False) -> bool:
+    """
+    Build the f2py module of the Fortran core, unless an up-to-date build exists.
+    This has to be called before the module is imported.
+    :param fflags: compiler flags, defaults to those of the Makefile
+    :param force: build even if the existing build is up to date
+    :return: whether the module was built
+    """
+    if fflags is None:
+        fflags = default_fflags()
+    if not force and is_current(fflags):
+        logger.debug("The Fortran core is up to date: %s", module_path())
+        return False
+
+    logger.info("Compiling the Fortran core with the flags \"%s\"", fflags)
+    # The hash is removed first, so that a failed build is not considered up to date.
+    if os.path.isfile(HASH_PATH):
+        os.remove(HASH_PATH)
+    # The Makefile writes the hash after a successful build
+    subprocess.run(
+        ["make", "python", f"FFLAGS={fflags}", f"PYTHON={sys.executable}"],
+        cwd=SRC_DIR, check=True)
+    logger.info("The Fortran core was compiled")
+    return True
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fflags", help="compiler flags, defaults to those of the Makefile")
+    parser.add_argument("--force", action="store_true", help="build even if the existing build is up to date")
+    parser.add_argument(
+        "--write-hash", action="store_true", help="only record an existing build, which the Makefile uses")
+    args = parser.parse_args()
+    if args.write_hash:
+        write_hash(default_fflags() if args.fflags is None else args.fflags)
+    else:
+        ensure_core(fflags=args.fflags, force=args.force)
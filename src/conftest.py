@@ -0,0 +1,44 @@
+"""
+Configuration of the tests, which are run with "python3 -m pytest" in this folder
+
+The Fortran core is built before the test modules import it.
+The Fortran CLI is built on demand by the cli fixture.
+"""
+
+import os
+import shutil
+import subprocess
+import typing as tp
+
+import pytest
+
+import build
+
+build.ensure_core()
+
+CLI_SOURCES = ("Makefile", "core.f90", "cmd_line.f90", "utils.f90", "main.f90")
+
+
+@pytest.fixture(scope="session")
+def cli(tmp_path_factory) -> tp.Callable[..., str]:
+    """
+    Build the Fortran CLI in a temporary folder, so that the object files do not end up in the sources.
+    :return: a function that runs the CLI with the given output folder and scalars of the configuration,
+        and returns its standard output
+    """
+    build_dir = tmp_path_factory.mktemp("cli")
+    for name in CLI_SOURCES:
+        shutil.copy(os.path.join(build.SRC_DIR, name), build_dir)
+    subprocess.run(["make", "cli"], cwd=build_dir, check=True, capture_output=True)
+    executable = str(build_dir / "planetary-motion")
+
+    def run(output_path: str, **scalars) -> str:
+        config_path = f"{output_path}.txt"
+        with open(config_path, "w") as file:
+            file.write("planetary-motion configuration\n[scalars]\n")
+            file.writelines(f"{name} = {value}\n" for name, value in scalars.items())
+        result = subprocess.run(
+            [executable, config_path, str(output_path)], check=True, capture_output=True, text=True)
+        return result.stdout
+
+    return run
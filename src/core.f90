@@ -4,6 +4,9 @@ module core
   ! https://stackoverflow.com/questions/19983850/f2py-access-module-parameter-from-subroutine
   ! Therefore these constants have been re-declared in the functions.
   ! With more time this issue could be debugged further.
+  !
+  ! The kernels that are called from Python are marked with "!f2py threadsafe", which releases the GIL
+  ! for the duration of the call, so that e.g. the GUI can run while a simulation thread is in the core.
 
   implicit none
 !  integer, parameter :: DIMS = 3
@@ -43,8 +46,604 @@ contains
     end do
   end function accel
 
-  subroutine iterate(x, v, a, m, dt, n_steps, n_objs, g, min_dist, print_interval, write_interval, path)
+  subroutine accel_all(x, m, a, n_objs, g, min_dist, pot)
+    ! Compute the accelerations of all objects at once.
+    ! Each pair is evaluated only once by using Newton's third law, and the pairs are processed in tiles
+    ! that fit in the cache. The inner loop is branch-free so that the compiler can vectorize it.
+    ! If pot is present, the total potential energy is computed in the same pass.
+    !
+    ! With OpenMP the rows of tiles are distributed to the threads in a fixed order, and each thread accumulates
+    ! to its own buffer. The buffers are summed in the order of the threads,
+    ! so the results are bitwise reproducible for a fixed number of threads.
+    !$ use omp_lib
+    !f2py threadsafe
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    ! 256 objects * 3 dims * 8 bytes = 6 kB per tile, which fits in the L1 cache of any modern CPU
+    integer, parameter :: TILE = 256
+
+    integer, intent(in) :: n_objs
+    real(kind=REAL_KIND), intent(in) :: x(DIMS,n_objs), m(n_objs), g, min_dist
+    real(kind=REAL_KIND), intent(out) :: a(DIMS,n_objs)
+    real(kind=REAL_KIND), intent(out), optional :: pot
+
+    real(kind=REAL_KIND) :: xi(DIMS), ai(DIMS), d(DIMS), dist2, min_dist2, inv_dist3, mi, pot_i
+    real(kind=REAL_KIND), allocatable :: a_thread(:,:,:), pot_thread(:)
+    integer :: i, j, i_tile, j_tile, i_end, j_end, n_threads, thread
+    logical :: with_pot
+
+    min_dist2 = min_dist**2
+    with_pot = present(pot)
+    n_threads = 1
+    !$ n_threads = omp_get_max_threads()
+    allocate(a_thread(DIMS,n_objs,n_threads), pot_thread(n_threads))
+
+    !$omp parallel private(i, j, i_tile, j_tile, i_end, j_end, thread, xi, ai, d, dist2, inv_dist3, mi, pot_i)
+    thread = 1
+    !$ thread = omp_get_thread_num() + 1
+    a_thread(:,:,thread) = 0
+    pot_thread(thread) = 0
+    ! When called from within a parallel region the team may be smaller than the maximum
+    !$omp single
+    !$ n_threads = omp_get_num_threads()
+    !$omp end single
+    ! The tile rows get shorter towards the end, so they are dealt cyclically for load balancing
+    !$omp do schedule(static, 1)
+    do i_tile=1,n_objs,TILE
+      i_end = min(i_tile + TILE - 1, n_objs)
+      do j_tile=i_tile,n_objs,TILE
+        j_end = min(j_tile + TILE - 1, n_objs)
+        do i=i_tile,i_end
+          xi = x(:,i)
+          mi = m(i)
+          ai = 0
+          pot_i = 0
+          do j=max(j_tile, i+1),j_end
+            d(1) = x(1,j) - xi(1)
+            d(2) = x(2,j) - xi(2)
+            d(3) = x(3,j) - xi(3)
+            dist2 = d(1)**2 + d(2)**2 + d(3)**2
+            ! Clipping prevents overflow. The max() keeps the division finite for overlapping objects,
+            ! whose contribution is then discarded by the merge().
+            inv_dist3 = max(dist2, min_dist2, tiny(dist2))
+            inv_dist3 = merge(1 / (inv_dist3*sqrt(inv_dist3)), 0._REAL_KIND, dist2 > min_dist2)
+            ai = ai + m(j)*inv_dist3*d
+            ! The condition is invariant, so the compiler generates separate loops with and without it
+            if (with_pot) pot_i = pot_i + m(j)*inv_dist3*dist2
+            a_thread(1,j,thread) = a_thread(1,j,thread) - mi*inv_dist3*d(1)
+            a_thread(2,j,thread) = a_thread(2,j,thread) - mi*inv_dist3*d(2)
+            a_thread(3,j,thread) = a_thread(3,j,thread) - mi*inv_dist3*d(3)
+          end do
+          a_thread(:,i,thread) = a_thread(:,i,thread) + ai
+          pot_thread(thread) = pot_thread(thread) + mi*pot_i
+        end do
+      end do
+    end do
+    !$omp end do
+
+    ! Deterministic reduction
+    !$omp do schedule(static)
+    do j=1,n_objs
+      a(:,j) = a_thread(:,j,1)
+      do thread=2,n_threads
+        a(:,j) = a(:,j) + a_thread(:,j,thread)
+      end do
+      a(:,j) = g*a(:,j)
+    end do
+    !$omp end do
+    !$omp end parallel
+    if (with_pot) then
+      pot = -g*sum(pot_thread(1:n_threads))
+    end if
+  end subroutine accel_all
+
+  subroutine accel_mixed(x, m, a, n_objs, g, min_dist, pot)
+    ! Compute the accelerations of all objects like accel_all, but with the pairwise interactions in single precision,
+    ! which doubles the width of the vectorized inner loop and halves the memory traffic of the positions.
+    ! The positions and masses are converted to single precision relative to the center of the system
+    ! and in the units of its extent and of the largest mass, so that neither SI nor scaled units overflow.
+    ! The converted positions have the indices (object, dim), so that the loads of the inner loop are contiguous.
+    ! The interactions of each pair of tiles are summed in single precision, and the sums of the tiles
+    ! are accumulated in double precision, so that the rounding error does not grow with the number of objects.
+    ! The relative error of the accelerations is then about 1e-7 on average, see bench.bench_precision.
+    !$ use omp_lib
+    !f2py threadsafe
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: SP = 4
+    integer, parameter :: TILE = 256
+    ! Objects closer than this fraction of the extent coincide in single precision and are excluded,
+    ! which also keeps the inverse distances of the excluded pairs finite
+    real(kind=REAL_KIND), parameter :: MIN_REL_DIST = 1e-10
+
+    integer, intent(in) :: n_objs
+    real(kind=REAL_KIND), intent(in) :: x(DIMS,n_objs), m(n_objs), g, min_dist
+    real(kind=REAL_KIND), intent(out) :: a(DIMS,n_objs)
+    real(kind=REAL_KIND), intent(out), optional :: pot
+
+    real(kind=SP) :: xi(DIMS), ai(DIMS), aj(TILE,DIMS), d(DIMS), dist2, min_dist2, inv_dist3, mi, pot_i
+    real(kind=SP), allocatable :: xs(:,:), ms(:)
+    real(kind=REAL_KIND) :: center(DIMS), length, mass, pot_tile
+    real(kind=REAL_KIND), allocatable :: a_thread(:,:,:), pot_thread(:)
+    integer :: i, j, k, i_tile, j_tile, i_end, j_end, n_threads, thread
+    logical :: with_pot
+
+    center = sum(x, dim=2) / n_objs
+    length = maxval(abs(x - spread(center, 2, n_objs)))
+    if (length == 0) length = 1
+    mass = maxval(m)
+    if (mass == 0) mass = 1
+    xs = real(transpose(x - spread(center, 2, n_objs)) / length, SP)
+    ms = real(m / mass, SP)
+    min_dist2 = real(max(min_dist / length, MIN_REL_DIST)**2, SP)
+
+    with_pot = present(pot)
+    n_threads = 1
+    !$ n_threads = omp_get_max_threads()
+    allocate(a_thread(DIMS,n_objs,n_threads), pot_thread(n_threads))
+
+    !$omp parallel private(i, j, k, i_tile, j_tile, i_end, j_end, thread, xi, ai, aj, d, dist2, inv_dist3, mi, &
+    !$omp pot_i, pot_tile)
+    thread = 1
+    !$ thread = omp_get_thread_num() + 1
+    a_thread(:,:,thread) = 0
+    pot_thread(thread) = 0
+    !$omp single
+    !$ n_threads = omp_get_num_threads()
+    !$omp end single
+    !$omp do schedule(static, 1)
+    do i_tile=1,n_objs,TILE
+      i_end = min(i_tile + TILE - 1, n_objs)
+      do j_tile=i_tile,n_objs,TILE
+        j_end = min(j_tile + TILE - 1, n_objs)
+        aj = 0
+        pot_tile = 0
+        do i=i_tile,i_end
+          xi = xs(i,:)
+          mi = ms(i)
+          ai = 0
+          pot_i = 0
+          do j=max(j_tile, i+1),j_end
+            k = j - j_tile + 1
+            d(1) = xs(j,1) - xi(1)
+            d(2) = xs(j,2) - xi(2)
+            d(3) = xs(j,3) - xi(3)
+            dist2 = d(1)**2 + d(2)**2 + d(3)**2
+            ! The pairs within min_dist are masked out with sign() instead of merge(),
+            ! which the compiler would implement as a branch that prevents the vectorization.
+            ! The potential is summed also without pot for the same reason.
+            inv_dist3 = max(dist2, min_dist2)
+            inv_dist3 = (0.5_SP + sign(0.5_SP, dist2 - min_dist2)) / (inv_dist3*sqrt(inv_dist3))
+            ai(1) = ai(1) + ms(j)*inv_dist3*d(1)
+            ai(2) = ai(2) + ms(j)*inv_dist3*d(2)
+            ai(3) = ai(3) + ms(j)*inv_dist3*d(3)
+            pot_i = pot_i + ms(j)*inv_dist3*dist2
+            aj(k,1) = aj(k,1) - mi*inv_dist3*d(1)
+            aj(k,2) = aj(k,2) - mi*inv_dist3*d(2)
+            aj(k,3) = aj(k,3) - mi*inv_dist3*d(3)
+          end do
+          a_thread(:,i,thread) = a_thread(:,i,thread) + ai
+          pot_tile = pot_tile + mi*pot_i
+        end do
+        a_thread(:,j_tile:j_end,thread) = a_thread(:,j_tile:j_end,thread) + transpose(aj(1:j_end-j_tile+1,:))
+        pot_thread(thread) = pot_thread(thread) + pot_tile
+      end do
+    end do
+    !$omp end do
+
+    !$omp do schedule(static)
+    do j=1,n_objs
+      a(:,j) = a_thread(:,j,1)
+      do thread=2,n_threads
+        a(:,j) = a(:,j) + a_thread(:,j,thread)
+      end do
+      a(:,j) = g*mass/length**2*a(:,j)
+    end do
+    !$omp end do
+    !$omp end parallel
+    if (with_pot) then
+      pot = -g*mass**2/length*sum(pot_thread(1:n_threads))
+    end if
+  end subroutine accel_mixed
+
+  subroutine accel_tree(x, m, a, n_objs, g, min_dist, theta, pot)
+    ! Compute the accelerations of all objects using the Barnes-Hut algorithm.
+    ! An octree is built from the positions, and the pull of a distant node is approximated by its total mass
+    ! at its center of mass, when the node size divided by its distance from the object is smaller than theta.
+    ! With theta = 0 every node is opened and the result equals the direct sum.
+    ! The tree is built serially, and the tree walk is parallelized with OpenMP.
+    !
+    ! The tree is stored in flat arrays, where the children of a node are contiguous and always have larger indices
+    ! than their parent. Nodes with only one non-empty octant are shrunk instead of being split,
+    ! so every internal node has at least two children and the tree has at most 2*n_objs nodes.
+    ! If pot is present, the total potential energy is computed with the same approximations.
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    ! Nodes with at most this many objects are not split further but summed directly
+    integer, parameter :: LEAF_SIZE = 8
+    ! Limit for shrinking a node, which is reached only when objects are on top of each other
+    integer, parameter :: MAX_SHRINK = 64
+
+    integer, intent(in) :: n_objs
+    real(kind=REAL_KIND), intent(in) :: x(DIMS,n_objs), m(n_objs), g, min_dist, theta
+    real(kind=REAL_KIND), intent(out) :: a(DIMS,n_objs)
+    real(kind=REAL_KIND), intent(out), optional :: pot
+
+    integer :: perm(n_objs), perm_pos(n_objs), perm_tmp(n_objs), octant(n_objs)
+    integer, allocatable :: node_lo(:), node_hi(:), node_child(:), node_n_child(:), stack(:)
+    real(kind=REAL_KIND), allocatable :: node_center(:,:), node_half(:), node_mass(:), node_com(:,:)
+    real(kind=REAL_KIND) :: xi(DIMS), ai(DIMS), d(DIMS), dist2, min_dist2, theta2, x_min(DIMS), x_max(DIMS)
+    real(kind=REAL_KIND) :: pot_obj(n_objs), pot_i
+    integer :: i, j, k, p, lo, hi, n_nodes, max_nodes, sp, oct, n_nonempty, shrink, counts(8), starts(8)
+    logical :: with_pot
+
+    a = 0
+    with_pot = present(pot)
+    if (with_pot) pot = 0
+    if (n_objs < 1) return
+    min_dist2 = min_dist**2
+    theta2 = theta**2
+    max_nodes = 2*n_objs
+    allocate(node_lo(max_nodes), node_hi(max_nodes), node_child(max_nodes), node_n_child(max_nodes))
+    allocate(node_center(DIMS,max_nodes), node_half(max_nodes), node_mass(max_nodes), node_com(DIMS,max_nodes))
+
+    ! Tree construction
+    do i=1,n_objs
+      perm(i) = i
+    end do
+    x_min = minval(x, dim=2)
+    x_max = maxval(x, dim=2)
+    node_lo(1) = 1
+    node_hi(1) = n_objs
+    node_center(:,1) = (x_min + x_max) / 2
+    ! The margin ensures that the objects on the boundary are within the root node
+    node_half(1) = 0.5*maxval(x_max - x_min)*(1 + 1e-10) + tiny(theta)
+    n_nodes = 1
+
+    k = 1
+    do while (k <= n_nodes)
+      lo = node_lo(k)
+      hi = node_hi(k)
+      node_child(k) = 0
+      node_n_child(k) = 0
+      if (hi - lo + 1 > LEAF_SIZE) then
+        do shrink=0,MAX_SHRINK
+          counts = 0
+          do p=lo,hi
+            j = perm(p)
+            oct = 1
+            if (x(1,j) > node_center(1,k)) oct = oct + 1
+            if (x(2,j) > node_center(2,k)) oct = oct + 2
+            if (x(3,j) > node_center(3,k)) oct = oct + 4
+            octant(p) = oct
+            counts(oct) = counts(oct) + 1
+          end do
+          n_nonempty = count(counts > 0)
+          if (n_nonempty > 1 .or. shrink == MAX_SHRINK) exit
+          ! All the objects are in the same octant, so the node is shrunk to it
+          oct = maxloc(counts, dim=1) - 1
+          node_half(k) = node_half(k) / 2
+          node_center(:,k) = node_center(:,k) + node_half(k)*octant_sign(oct)
+        end do
+
+        if (n_nonempty > 1) then
+          ! Counting sort of the objects by octant
+          starts(1) = lo
+          do oct=2,8
+            starts(oct) = starts(oct-1) + counts(oct-1)
+          end do
+          do p=lo,hi
+            perm_tmp(starts(octant(p))) = perm(p)
+            starts(octant(p)) = starts(octant(p)) + 1
+          end do
+          perm(lo:hi) = perm_tmp(lo:hi)
+
+          node_child(k) = n_nodes + 1
+          p = lo
+          do oct=1,8
+            if (counts(oct) == 0) cycle
+            n_nodes = n_nodes + 1
+            node_lo(n_nodes) = p
+            node_hi(n_nodes) = p + counts(oct) - 1
+            node_half(n_nodes) = node_half(k) / 2
+            node_center(:,n_nodes) = node_center(:,k) + node_half(n_nodes)*octant_sign(oct-1)
+            p = p + counts(oct)
+          end do
+          node_n_child(k) = n_nonempty
+        end if
+      end if
+      k = k + 1
+    end do
+
+    do p=1,n_objs
+      perm_pos(perm(p)) = p
+    end do
+
+    ! Masses and centers of mass from the leaves upwards
+    do k=n_nodes,1,-1
+      if (node_child(k) == 0) then
+        node_mass(k) = 0
+        node_com(:,k) = 0
+        do p=node_lo(k),node_hi(k)
+          j = perm(p)
+          node_mass(k) = node_mass(k) + m(j)
+          node_com(:,k) = node_com(:,k) + m(j)*x(:,j)
+        end do
+      else
+        node_mass(k) = sum(node_mass(node_child(k):node_child(k)+node_n_child(k)-1))
+        node_com(:,k) = sum(node_com(:,node_child(k):node_child(k)+node_n_child(k)-1), dim=2)
+      end if
+    end do
+    do k=1,n_nodes
+      if (node_mass(k) > 0) then
+        node_com(:,k) = node_com(:,k) / node_mass(k)
+      else
+        node_com(:,k) = node_center(:,k)
+      end if
+    end do
+
+    ! Tree walk
+    ! The objects are independent of each other, so the results do not depend on the number of threads.
+    !$omp parallel private(i, j, k, p, sp, xi, ai, d, dist2, stack, pot_i)
+    allocate(stack(max_nodes))
+    !$omp do schedule(dynamic, 64)
+    do i=1,n_objs
+      xi = x(:,i)
+      ai = 0
+      pot_i = 0
+      sp = 1
+      stack(1) = 1
+      do while (sp > 0)
+        k = stack(sp)
+        sp = sp - 1
+        if (node_child(k) == 0) then
+          do p=node_lo(k),node_hi(k)
+            j = perm(p)
+            d = x(:,j) - xi
+            dist2 = sum(d**2)
+            if ((i /= j) .and. (dist2 > min_dist2)) then
+              ai = ai + m(j)*d / (dist2*sqrt(dist2))
+              if (with_pot) pot_i = pot_i + m(j) / sqrt(dist2)
+            end if
+          end do
+        else
+          d = node_com(:,k) - xi
+          dist2 = sum(d**2)
+          ! A node containing the object itself is always opened
+          if ((perm_pos(i) < node_lo(k) .or. perm_pos(i) > node_hi(k)) .and. 4*node_half(k)**2 < theta2*dist2) then
+            if (dist2 > min_dist2) then
+              ai = ai + node_mass(k)*d / (dist2*sqrt(dist2))
+              if (with_pot) pot_i = pot_i + node_mass(k) / sqrt(dist2)
+            end if
+          else
+            do j=node_child(k),node_child(k)+node_n_child(k)-1
+              sp = sp + 1
+              stack(sp) = j
+            end do
+          end if
+        end if
+      end do
+      a(:,i) = g*ai
+      pot_obj(i) = m(i)*pot_i
+    end do
+    !$omp end do
+    deallocate(stack)
+    !$omp end parallel
+    ! Each pair is counted from both sides
+    if (with_pot) then
+      pot = -g*sum(pot_obj) / 2
+    end if
+
+  contains
+    function octant_sign(oct) result(sgn)
+      ! Direction from the center of a node to the center of its octant oct = 0...7
+      integer, intent(in) :: oct
+      real(kind=REAL_KIND) :: sgn(DIMS)
+      sgn = -1
+      if (iand(oct, 1) /= 0) sgn(1) = 1
+      if (iand(oct, 2) /= 0) sgn(2) = 1
+      if (iand(oct, 4) /= 0) sgn(3) = 1
+    end function octant_sign
+  end subroutine accel_tree
+
+  subroutine compute_accel(x, m, a, n_objs, g, min_dist, theta, pot)
+    ! Compute the accelerations with the force engine selected by theta:
+    ! the Barnes-Hut tree for theta > 0, the direct pairwise sum for theta = 0
+    ! and the mixed-precision direct sum of accel_mixed for theta < 0.
+    ! If pot is present, the total potential energy is computed in the same pass.
+    !f2py threadsafe
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+
+    integer, intent(in) :: n_objs
+    real(kind=REAL_KIND), intent(in) :: x(DIMS,n_objs), m(n_objs), g, min_dist, theta
+    real(kind=REAL_KIND), intent(out) :: a(DIMS,n_objs)
+    real(kind=REAL_KIND), intent(out), optional :: pot
+
+    if (theta > 0) then
+      call accel_tree(x, m, a, n_objs, g, min_dist, theta, pot)
+    else if (theta < 0) then
+      call accel_mixed(x, m, a, n_objs, g, min_dist, pot)
+    else
+      call accel_all(x, m, a, n_objs, g, min_dist, pot)
+    end if
+  end subroutine compute_accel
+
+  real(kind=8) function potential_energy(x, m, n_objs, g, min_dist, theta)
+    ! Total potential energy for the integrators whose force passes are not at the saved states
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+
+    integer, intent(in) :: n_objs
+    real(kind=REAL_KIND), intent(in) :: x(DIMS,n_objs), m(n_objs), g, min_dist, theta
+
+    real(kind=REAL_KIND) :: a(DIMS,n_objs)
+
+    call compute_accel(x, m, a, n_objs, g, min_dist, theta, potential_energy)
+  end function potential_energy
+
+  subroutine compute_diagnostics(x, v, m, pot, n_objs, diag)
+    ! Conservation diagnostics of the state, which are in order:
+    ! kinetic energy, potential energy, momentum (3), angular momentum (3) and center of mass (3).
+    ! The potential energy pot is taken from a force pass.
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: N_DIAG = 11
+
+    integer, intent(in) :: n_objs
+    real(kind=REAL_KIND), intent(in) :: x(DIMS,n_objs), v(DIMS,n_objs), m(n_objs), pot
+    real(kind=REAL_KIND), intent(out) :: diag(N_DIAG)
+
+    integer :: i
+
+    diag = 0
+    do i=1,n_objs
+      diag(1) = diag(1) + m(i)*sum(v(:,i)**2) / 2
+      diag(3:5) = diag(3:5) + m(i)*v(:,i)
+      diag(6) = diag(6) + m(i)*(x(2,i)*v(3,i) - x(3,i)*v(2,i))
+      diag(7) = diag(7) + m(i)*(x(3,i)*v(1,i) - x(1,i)*v(3,i))
+      diag(8) = diag(8) + m(i)*(x(1,i)*v(2,i) - x(2,i)*v(1,i))
+      diag(9:11) = diag(9:11) + m(i)*x(:,i)
+    end do
+    diag(2) = pot
+    diag(9:11) = diag(9:11) / sum(m)
+  end subroutine compute_diagnostics
+
+  logical function energy_drifted(diag, energy_ref, max_drift)
+    ! Whether the relative error of the total energy in the diagnostics exceeds max_drift > 0
+    implicit none
+
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: N_DIAG = 11
+
+    real(kind=REAL_KIND), intent(in) :: diag(N_DIAG), energy_ref, max_drift
+
+    energy_drifted = max_drift > 0 .and. abs(diag(1) + diag(2) - energy_ref) > max_drift*abs(energy_ref)
+  end function energy_drifted
+
+  subroutine verlet_step(x, v, a, m, dt, n_objs, g, min_dist, theta, pot)
+    ! Advance the system by one velocity-Verlet step.
+    ! The accelerations a must correspond to the positions x at the beginning of the step.
+    ! If pot is present, it is set to the potential energy at the end of the step.
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+
+    integer, intent(in) :: n_objs
+    real(kind=REAL_KIND), intent(inout) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs)
+    real(kind=REAL_KIND), intent(in) :: m(n_objs), dt, g, min_dist, theta
+    real(kind=REAL_KIND), intent(out), optional :: pot
+
+    real(kind=REAL_KIND) :: a_prev(DIMS,n_objs)
+
+    x = x + v*dt + 0.5*a*dt**2
+    a_prev = a
+    call compute_accel(x, m, a, n_objs, g, min_dist, theta, pot)
+    v = v + 0.5*(a + a_prev)*dt
+  end subroutine verlet_step
+
+  subroutine symplectic_step(x, v, a, m, dt, n_objs, g, min_dist, theta, order, pot)
+    ! Advance the system by one step of a symplectic integrator of the given order.
+    ! Order 2 is a single velocity-Verlet step. The higher orders are compositions of velocity-Verlet steps:
+    ! order 4 is the three-stage scheme of Forest and Ruth (1990) and order 6 is the seven-stage
+    ! solution A of Yoshida (1990). The substeps share the force evaluations at their boundaries,
+    ! so a step costs 1, 3 or 7 force evaluations respectively.
+    ! The accelerations a must correspond to the positions x at the beginning of the step.
+    ! If pot is present, it is set to the potential energy at the end of the step.
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    ! Forest-Ruth
+    real(kind=REAL_KIND), parameter :: FR_W1 = 1 / (2 - 2**(1/3._REAL_KIND))
+    real(kind=REAL_KIND), parameter :: FR_W(3) = [FR_W1, 1 - 2*FR_W1, FR_W1]
+    ! Yoshida
+    real(kind=REAL_KIND), parameter :: Y6_W1 = -1.17767998417887_REAL_KIND, Y6_W2 = 0.235573213359357_REAL_KIND, &
+      Y6_W3 = 0.784513610477560_REAL_KIND
+    real(kind=REAL_KIND), parameter :: Y6_W(7) = [Y6_W3, Y6_W2, Y6_W1, 1 - 2*(Y6_W1 + Y6_W2 + Y6_W3), &
+      Y6_W1, Y6_W2, Y6_W3]
+
+    integer, intent(in) :: n_objs, order
+    real(kind=REAL_KIND), intent(inout) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs)
+    real(kind=REAL_KIND), intent(in) :: m(n_objs), dt, g, min_dist, theta
+    real(kind=REAL_KIND), intent(out), optional :: pot
+
+    integer :: i
+
+    ! The potential energy is computed only in the force pass of the last substep
+    select case (order)
+      case (4)
+        do i=1,size(FR_W)-1
+          call verlet_step(x, v, a, m, FR_W(i)*dt, n_objs, g, min_dist, theta)
+        end do
+        call verlet_step(x, v, a, m, FR_W(size(FR_W))*dt, n_objs, g, min_dist, theta, pot)
+      case (6)
+        do i=1,size(Y6_W)-1
+          call verlet_step(x, v, a, m, Y6_W(i)*dt, n_objs, g, min_dist, theta)
+        end do
+        call verlet_step(x, v, a, m, Y6_W(size(Y6_W))*dt, n_objs, g, min_dist, theta, pot)
+      case default
+        call verlet_step(x, v, a, m, dt, n_objs, g, min_dist, theta, pot)
+    end select
+  end subroutine symplectic_step
+
+  subroutine rk4_step(x, v, a, m, dt, n_objs, g, min_dist, theta)
+    ! Advance the system by one classical RK4 step.
+    ! The stages are evaluated for all objects together, so that each stage sees the stage positions
+    ! of the other objects, which makes the method fourth order for the coupled system.
+    ! On return a contains the accelerations at the beginning of the step.
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+
+    integer, intent(in) :: n_objs
+    real(kind=REAL_KIND), intent(inout) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs)
+    real(kind=REAL_KIND), intent(in) :: m(n_objs), dt, g, min_dist, theta
+
+    ! The position derivatives of the stages are the stage velocities, so only these are stored.
+    real(kind=REAL_KIND) :: k2r(DIMS,n_objs), k3r(DIMS,n_objs), k4r(DIMS,n_objs)
+    real(kind=REAL_KIND) :: k2v(DIMS,n_objs), k3v(DIMS,n_objs), k4v(DIMS,n_objs)
+
+    call compute_accel(x, m, a, n_objs, g, min_dist, theta)
+    k2r = v + a * dt/2
+    call compute_accel(x + v * dt/2, m, k2v, n_objs, g, min_dist, theta)
+    k3r = v + k2v * dt/2
+    call compute_accel(x + k2r * dt/2, m, k3v, n_objs, g, min_dist, theta)
+    k4r = v + k3v * dt
+    call compute_accel(x + k3r * dt, m, k4v, n_objs, g, min_dist, theta)
+
+    x = x + dt/6 * (v + 2*k2r + 2*k3r + k4r)
+    v = v + dt/6 * (a + 2*k2v + 2*k3v + k4v)
+  end subroutine rk4_step
+
+  subroutine iterate(x, v, a, m, dt, n_steps, n_objs, g, min_dist, print_interval, write_interval, path, theta, &
+      n_threads, output_format, order, print_format, checkpoint_interval, start_iter)
     ! Note that on Python side the argument n_objs is optional, since it can be automatically determined from the input arrays
+    ! If the opening angle theta > 0 is given, the forces are computed with the Barnes-Hut tree instead of the direct sum,
+    ! and theta < 0 selects the mixed-precision direct sum, see compute_accel.
+    ! The order of the symplectic integrator is 2 for velocity Verlet (default), 4 or 6, see symplectic_step.
+    ! If n_threads > 0 is given, it sets the number of OpenMP threads.
+    ! The output_format is 0 for a text file per write (default) or 1 for a single binary file, see write_output.
+    ! The print_format is 0 for the full state (default) or 1 for a progress counter, see print_status.
+    ! If checkpoint_interval > 0 is given, the state is written to checkpoint.bin in the output folder
+    ! every checkpoint_interval steps, see write_checkpoint.
+    ! A run that was resumed from a checkpoint continues from the iteration start_iter + 1 up to n_steps,
+    ! and the binary output file of the interrupted run is continued instead of replaced.
+    !f2py threadsafe
     implicit none
 
     integer, parameter :: DIMS = 3
@@ -58,10 +657,14 @@ contains
     character(len=*), intent(in), optional :: path
     real(kind=REAL_KIND), intent(inout) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs)
     real(kind=REAL_KIND), intent(in) :: m(n_objs), dt, g, min_dist
+    real(kind=REAL_KIND), intent(in), optional :: theta
+    integer, intent(in), optional :: n_threads, output_format, order, print_format, checkpoint_interval, start_iter
 
-    integer :: i, iter, print_interval_checked, write_interval_checked, written
+    integer :: iter, print_interval_checked, write_interval_checked, written, output_format_checked, order_checked, &
+      print_format_checked, checkpoint_interval_checked, start_iter_checked
+    integer(kind=8) :: start_count
     character(len=MAX_PATH_LEN) :: path_checked
-    real(kind=REAL_KIND) :: a_prev(DIMS)
+    real(kind=REAL_KIND) :: theta_checked
     written = 0
 
     ! Processing of optional arguments
@@ -80,30 +683,84 @@ contains
     else
       path_checked = DEFAULT_OUTPUT_PATH
     end if
+    if(present(theta)) then
+      theta_checked = theta
+    else
+      theta_checked = 0
+    end if
+    if(present(n_threads)) then
+      call set_threads(n_threads)
+    end if
+    if(present(output_format)) then
+      output_format_checked = output_format
+    else
+      output_format_checked = 0
+    end if
+    if(present(order)) then
+      order_checked = order
+    else
+      order_checked = 2
+    end if
+    if(present(print_format)) then
+      print_format_checked = print_format
+    else
+      print_format_checked = 0
+    end if
+    if(present(checkpoint_interval)) then
+      checkpoint_interval_checked = checkpoint_interval
+    else
+      checkpoint_interval_checked = 0
+    end if
+    if(present(start_iter)) then
+      start_iter_checked = start_iter
+    else
+      start_iter_checked = 0
+    end if
+    if (write_interval_checked /= 0) then
+      written = start_iter_checked / write_interval_checked
+      if (output_format_checked == 1) then
+        call open_binary_output(path_checked, n_objs, n_steps / write_interval_checked, write_interval_checked, dt, &
+          start_iter_checked > 0)
+      end if
+    end if
 
     ! Simulation loop
-    do iter=1,n_steps
-      x = x + v*dt + 0.5*a*dt**2
-      do i=1,n_objs
-        a_prev = a(:,i)
-        a(:,i) = accel(x, x(:,i), m, i, n_objs, g, min_dist)
-        v(:,i) = v(:,i) + 0.5*(a(:,i) + a_prev)*dt
-      end do
+    call system_clock(start_count)
+    do iter=start_iter_checked+1,n_steps
+      call symplectic_step(x, v, a, m, dt, n_objs, g, min_dist, theta_checked, order_checked)
 
       ! Writing and printing
       if (write_interval_checked /= 0 .and. mod(iter, write_interval_checked) == 0) then
-        call write_progress(x, v, a, iter, n_objs, path)
         written = written + 1
+        call write_output(x, v, a, iter, n_objs, path_checked, output_format_checked, written)
       end if
       if (print_interval_checked /= 0 .and. mod(iter, print_interval_checked) == 0) then
-        call print_progress(x, v, a, iter, dt, n_steps, n_objs)
+        call print_status(x, v, a, iter, dt, n_steps, n_objs, print_format_checked, start_count, start_iter_checked)
+      end if
+      ! The checkpoint is written after the output, so that a resumed run does not skip any records
+      if (checkpoint_interval_checked > 0 .and. mod(iter, checkpoint_interval_checked) == 0) then
+        call write_checkpoint(path_checked, x, v, a, m, iter, dt, n_objs)
       end if
     end do
+    if (write_interval_checked /= 0 .and. output_format_checked == 1) then
+      call close_binary_output()
+    end if
   end subroutine iterate
 
   ! This is a modified copy-paste of the velocity-Verlet function above
-  subroutine iterate_rk4(x, v, a, m, dt, n_steps, n_objs, g, min_dist, print_interval, write_interval, path)
+  subroutine iterate_rk4(x, v, a, m, dt, n_steps, n_objs, g, min_dist, print_interval, write_interval, path, n_threads, &
+      output_format, theta, print_format, checkpoint_interval, start_iter)
     ! Note that on Python side the argument n_objs is optional, since it can be automatically determined from the input arrays
+    ! If the opening angle theta > 0 is given, the forces are computed with the Barnes-Hut tree instead of the direct sum,
+    ! and theta < 0 selects the mixed-precision direct sum, see compute_accel.
+    ! If n_threads > 0 is given, it sets the number of OpenMP threads.
+    ! The output_format is 0 for a text file per write (default) or 1 for a single binary file, see write_output.
+    ! The print_format is 0 for the full state (default) or 1 for a progress counter, see print_status.
+    ! If checkpoint_interval > 0 is given, the state is written to checkpoint.bin in the output folder
+    ! every checkpoint_interval steps, see write_checkpoint.
+    ! A run that was resumed from a checkpoint continues from the iteration start_iter + 1 up to n_steps,
+    ! and the binary output file of the interrupted run is continued instead of replaced.
+    !f2py threadsafe
     implicit none
 
     integer, parameter :: DIMS = 3
@@ -117,11 +774,14 @@ contains
     character(len=*), intent(in), optional :: path
     real(kind=REAL_KIND), intent(inout) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs)
     real(kind=REAL_KIND), intent(in) :: m(n_objs), dt, g, min_dist
+    integer, intent(in), optional :: n_threads, output_format, print_format, checkpoint_interval, start_iter
+    real(kind=REAL_KIND), intent(in), optional :: theta
 
-    integer :: i, iter, print_interval_checked, write_interval_checked, written
+    integer :: iter, print_interval_checked, write_interval_checked, written, output_format_checked, print_format_checked, &
+      checkpoint_interval_checked, start_iter_checked
+    integer(kind=8) :: start_count
     character(len=MAX_PATH_LEN) :: path_checked
-    real(kind=REAL_KIND) :: k1r(DIMS), k2r(DIMS), k3r(DIMS), k4r(DIMS), k1v(DIMS), k2v(DIMS), k3v(DIMS), k4v(DIMS)
-    real(kind=REAL_KIND) :: x_new(DIMS,n_objs), v_new(DIMS,n_objs)
+    real(kind=REAL_KIND) :: theta_checked
     written = 0
 
     ! Processing of optional arguments
@@ -140,41 +800,835 @@ contains
     else
       path_checked = DEFAULT_OUTPUT_PATH
     end if
+    if(present(theta)) then
+      theta_checked = theta
+    else
+      theta_checked = 0
+    end if
+    if(present(n_threads)) then
+      call set_threads(n_threads)
+    end if
+    if(present(output_format)) then
+      output_format_checked = output_format
+    else
+      output_format_checked = 0
+    end if
+    if(present(print_format)) then
+      print_format_checked = print_format
+    else
+      print_format_checked = 0
+    end if
+    if(present(checkpoint_interval)) then
+      checkpoint_interval_checked = checkpoint_interval
+    else
+      checkpoint_interval_checked = 0
+    end if
+    if(present(start_iter)) then
+      start_iter_checked = start_iter
+    else
+      start_iter_checked = 0
+    end if
+    if (write_interval_checked /= 0) then
+      written = start_iter_checked / write_interval_checked
+      if (output_format_checked == 1) then
+        call open_binary_output(path_checked, n_objs, n_steps / write_interval_checked, write_interval_checked, dt, &
+          start_iter_checked > 0)
+      end if
+    end if
 
     ! Simulation loop
-    do iter=1,n_steps
-      do i=1,n_objs
-        ! Here h=dt
-        k1r = v(:,i)
-        k1v = accel(x, x(:,i), m, i, n_objs, g, min_dist)
-        k2r = v(:,i) + k1v * dt/2
-        k2v = accel(x, x(:,i) + k1r * dt/2, m, i, n_objs, g, min_dist)
-        k3r = v(:,i) + k2v * dt/2
-        k3v = accel(x, x(:,i) + k2r * dt/2, m, i, n_objs, g, min_dist)
-        k4r = v(:,i) + k3v * dt
-        k4v = accel(x, x(:,i) + k3r * dt, m, i, n_objs, g, min_dist)
-
-        ! Storing acceleration is not necessary in this algorithm but it may be useful for debugging.
-        a(:,i) = k1v
-
-        x_new(:,i) = x(:,i) + dt/6 * (k1r + 2*k2r + 2*k3r + k4r)
-        v_new(:,i) = v(:,i) + dt/6 * (k1v + 2*k2v + 2*k3v + k4v)
-      end do
-      x = x_new
-      ! call print_arr_2d(x, "x")
-      v = v_new
+    call system_clock(start_count)
+    do iter=start_iter_checked+1,n_steps
+      call rk4_step(x, v, a, m, dt, n_objs, g, min_dist, theta_checked)
 
       ! Writing and printing
       if (write_interval_checked /= 0 .and. mod(iter, write_interval_checked) == 0) then
-        call write_progress(x, v, a, iter, n_objs, path)
         written = written + 1
+        call write_output(x, v, a, iter, n_objs, path_checked, output_format_checked, written)
       end if
       if (print_interval_checked /= 0 .and. mod(iter, print_interval_checked) == 0) then
-        call print_progress(x, v, a, iter, dt, n_steps, n_objs)
+        call print_status(x, v, a, iter, dt, n_steps, n_objs, print_format_checked, start_count, start_iter_checked)
+      end if
+      ! The checkpoint is written after the output, so that a resumed run does not skip any records
+      if (checkpoint_interval_checked > 0 .and. mod(iter, checkpoint_interval_checked) == 0) then
+        call write_checkpoint(path_checked, x, v, a, m, iter, dt, n_objs)
       end if
     end do
+    if (write_interval_checked /= 0 .and. output_format_checked == 1) then
+      call close_binary_output()
+    end if
   end subroutine iterate_rk4
 
+  subroutine iterate_hist(x, v, a, m, dt, save_interval, n_objs, n_snaps, g, min_dist, x_hist, n_done, v_hist, &
+      x_scale, v_scale, use_rk4, theta, n_threads, order, diag, energy_ref, max_drift)
+    ! Advance the system by n_snaps*save_interval steps and write a snapshot after every save_interval steps
+    ! to the preallocated history arrays, which avoids a call from Python for each snapshot.
+    ! The histories have the indices (celestial, dim, snapshot), so that they correspond to C-ordered
+    ! NumPy arrays with the indices (snapshot, dim, celestial). The snapshots are multiplied by x_scale and v_scale.
+    ! Without use_rk4 the order of the symplectic integrator is 2 for velocity Verlet (default), 4 or 6.
+    ! Note that on Python side the arguments n_objs and n_snaps are optional.
+    !
+    ! If diag is given, the conservation diagnostics of each snapshot are written to it, see compute_diagnostics.
+    ! The symplectic integrators get the potential energy from the last force pass before the snapshot.
+    ! If the relative error of the total energy compared to energy_ref exceeds max_drift > 0, the integration
+    ! is stopped. n_done is the number of snapshots written.
+    !f2py threadsafe
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: N_DIAG = 11
+
+    integer, intent(in) :: save_interval, n_objs, n_snaps
+    real(kind=REAL_KIND), intent(inout) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs)
+    real(kind=REAL_KIND), intent(in) :: m(n_objs), dt, g, min_dist
+    real(kind=REAL_KIND), intent(inout) :: x_hist(n_objs,DIMS,n_snaps)
+    integer, intent(out) :: n_done
+    real(kind=REAL_KIND), intent(inout), optional :: v_hist(n_objs,DIMS,n_snaps), diag(N_DIAG,n_snaps)
+    real(kind=REAL_KIND), intent(in), optional :: x_scale, v_scale, theta, energy_ref, max_drift
+    logical, intent(in), optional :: use_rk4
+    integer, intent(in), optional :: n_threads, order
+
+    real(kind=REAL_KIND) :: x_scale_checked, v_scale_checked, theta_checked, max_drift_checked, energy_ref_checked, pot
+    logical :: use_rk4_checked
+    integer :: snap, iter, order_checked
+
+    ! Processing of optional arguments
+    if(present(x_scale)) then
+      x_scale_checked = x_scale
+    else
+      x_scale_checked = 1
+    end if
+    if(present(v_scale)) then
+      v_scale_checked = v_scale
+    else
+      v_scale_checked = 1
+    end if
+    if(present(theta)) then
+      theta_checked = theta
+    else
+      theta_checked = 0
+    end if
+    if(present(use_rk4)) then
+      use_rk4_checked = use_rk4
+    else
+      use_rk4_checked = .false.
+    end if
+    if(present(n_threads)) then
+      call set_threads(n_threads)
+    end if
+    if(present(order)) then
+      order_checked = order
+    else
+      order_checked = 2
+    end if
+    if(present(max_drift) .and. present(energy_ref)) then
+      max_drift_checked = max_drift
+      energy_ref_checked = energy_ref
+    else
+      max_drift_checked = 0
+      energy_ref_checked = 0
+    end if
+
+    n_done = 0
+    do snap=1,n_snaps
+      do iter=1,save_interval
+        if (use_rk4_checked) then
+          call rk4_step(x, v, a, m, dt, n_objs, g, min_dist, theta_checked)
+        else if (present(diag) .and. iter == save_interval) then
+          call symplectic_step(x, v, a, m, dt, n_objs, g, min_dist, theta_checked, order_checked, pot)
+        else
+          call symplectic_step(x, v, a, m, dt, n_objs, g, min_dist, theta_checked, order_checked)
+        end if
+      end do
+      x_hist(:,:,snap) = x_scale_checked*transpose(x)
+      if(present(v_hist)) then
+        v_hist(:,:,snap) = v_scale_checked*transpose(v)
+      end if
+      n_done = snap
+      if(present(diag)) then
+        if (use_rk4_checked) pot = potential_energy(x, m, n_objs, g, min_dist, theta_checked)
+        call compute_diagnostics(x, v, m, pot, n_objs, diag(:,snap))
+        if (energy_drifted(diag(:,snap), energy_ref_checked, max_drift_checked)) return
+      end if
+    end do
+  end subroutine iterate_hist
+
+  subroutine iterate_rk45(x, v, a, m, t_out, n_objs, n_snaps, g, min_dist, x_hist, rtol, atol, dt_try, n_evals, &
+      status, n_done, v_hist, x_scale, v_scale, theta, n_threads, diag, energy_ref, max_drift)
+    ! Adaptive Dormand-Prince 5(4) integrator with error control.
+    ! The system is integrated to each of the output times t_out (relative to the current time),
+    ! and the snapshots are written to the histories as in iterate_hist.
+    ! The steps are shortened to land exactly on the output times.
+    !
+    ! The error of each step is estimated from the difference of the embedded 5th and 4th order solutions,
+    ! and the step is accepted when the RMS of the error scaled by atol + rtol*|y| is at most 1.
+    ! dt_try is the initial step size, and on return it is the step size to be used for the next call.
+    ! n_evals is incremented by the number of force evaluations, and status is 0 on success and
+    ! 1 if the step size became too small.
+    ! The conservation diagnostics are written to diag and the drift of the energy is checked as in iterate_hist,
+    ! and n_done is the number of snapshots written.
+    !f2py threadsafe
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: N_DIAG = 11
+    integer, parameter :: STAGES = 7
+    ! Step size control
+    real(kind=REAL_KIND), parameter :: SAFETY = 0.9, MIN_FACTOR = 0.2, MAX_FACTOR = 5
+    ! Dormand-Prince coefficients, where the column DP_A(:,i) contains the coefficients of stage i
+    ! The system is autonomous, so the nodes are not needed, and the 5th order weights are the last column of DP_A,
+    ! since the last stage is evaluated at the new state.
+    ! Difference of the 5th and 4th order weights
+    real(kind=REAL_KIND), parameter :: DP_E(STAGES) = [71/57600._REAL_KIND, 0._REAL_KIND, -71/16695._REAL_KIND, &
+      71/1920._REAL_KIND, -17253/339200._REAL_KIND, 22/525._REAL_KIND, -1/40._REAL_KIND]
+    real(kind=REAL_KIND), parameter :: DP_A(STAGES,STAGES) = reshape([ &
+      0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, &
+      1/5._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, &
+      3/40._REAL_KIND, 9/40._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, &
+      44/45._REAL_KIND, -56/15._REAL_KIND, 32/9._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, 0._REAL_KIND, &
+      19372/6561._REAL_KIND, -25360/2187._REAL_KIND, 64448/6561._REAL_KIND, -212/729._REAL_KIND, 0._REAL_KIND, &
+      0._REAL_KIND, 0._REAL_KIND, &
+      9017/3168._REAL_KIND, -355/33._REAL_KIND, 46732/5247._REAL_KIND, 49/176._REAL_KIND, -5103/18656._REAL_KIND, &
+      0._REAL_KIND, 0._REAL_KIND, &
+      35/384._REAL_KIND, 0._REAL_KIND, 500/1113._REAL_KIND, 125/192._REAL_KIND, -2187/6784._REAL_KIND, &
+      11/84._REAL_KIND, 0._REAL_KIND &
+    ], [STAGES, STAGES])
+
+    integer, intent(in) :: n_objs, n_snaps
+    real(kind=REAL_KIND), intent(inout) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs)
+    real(kind=REAL_KIND), intent(in) :: m(n_objs), t_out(n_snaps), g, min_dist, rtol, atol
+    real(kind=REAL_KIND), intent(inout) :: x_hist(n_objs,DIMS,n_snaps), dt_try
+    integer, intent(inout) :: n_evals
+    integer, intent(out) :: status, n_done
+    real(kind=REAL_KIND), intent(inout), optional :: v_hist(n_objs,DIMS,n_snaps), diag(N_DIAG,n_snaps)
+    real(kind=REAL_KIND), intent(in), optional :: x_scale, v_scale, theta, energy_ref, max_drift
+    integer, intent(in), optional :: n_threads
+
+    real(kind=REAL_KIND) :: kx(DIMS,n_objs,STAGES), kv(DIMS,n_objs,STAGES)
+    real(kind=REAL_KIND) :: x_stage(DIMS,n_objs), v_stage(DIMS,n_objs), err_x(DIMS,n_objs), err_v(DIMS,n_objs)
+    real(kind=REAL_KIND) :: x_scale_checked, v_scale_checked, theta_checked, t, h, err, factor
+    real(kind=REAL_KIND) :: max_drift_checked, energy_ref_checked, pot
+    integer :: snap, stage, j
+    logical :: last
+
+    ! Processing of optional arguments
+    if(present(x_scale)) then
+      x_scale_checked = x_scale
+    else
+      x_scale_checked = 1
+    end if
+    if(present(v_scale)) then
+      v_scale_checked = v_scale
+    else
+      v_scale_checked = 1
+    end if
+    if(present(theta)) then
+      theta_checked = theta
+    else
+      theta_checked = 0
+    end if
+    if(present(n_threads)) then
+      call set_threads(n_threads)
+    end if
+    if(present(max_drift) .and. present(energy_ref)) then
+      max_drift_checked = max_drift
+      energy_ref_checked = energy_ref
+    else
+      max_drift_checked = 0
+      energy_ref_checked = 0
+    end if
+
+    status = 0
+    n_done = 0
+    t = 0
+    ! The first stage is the derivative at the current state. Later it is reused from the last stage (FSAL).
+    call compute_accel(x, m, a, n_objs, g, min_dist, theta_checked)
+    n_evals = n_evals + 1
+    kx(:,:,1) = v
+    kv(:,:,1) = a
+
+    do snap=1,n_snaps
+      do while (t < t_out(snap))
+        last = dt_try >= t_out(snap) - t
+        if (last) then
+          h = t_out(snap) - t
+        else
+          h = dt_try
+        end if
+        if (h <= 1e-14*max(abs(t), abs(t_out(snap)))) then
+          status = 1
+          return
+        end if
+
+        do stage=2,STAGES
+          x_stage = x
+          v_stage = v
+          do j=1,stage-1
+            if (DP_A(j,stage) == 0) cycle
+            x_stage = x_stage + h*DP_A(j,stage)*kx(:,:,j)
+            v_stage = v_stage + h*DP_A(j,stage)*kv(:,:,j)
+          end do
+          kx(:,:,stage) = v_stage
+          call compute_accel(x_stage, m, kv(:,:,stage), n_objs, g, min_dist, theta_checked)
+          n_evals = n_evals + 1
+        end do
+        ! The last stage is evaluated at the 5th order solution, which is now in x_stage and v_stage
+
+        err_x = 0
+        err_v = 0
+        do j=1,STAGES
+          err_x = err_x + h*DP_E(j)*kx(:,:,j)
+          err_v = err_v + h*DP_E(j)*kv(:,:,j)
+        end do
+        err = sqrt( &
+          (sum((err_x / (atol + rtol*max(abs(x), abs(x_stage))))**2) &
+          + sum((err_v / (atol + rtol*max(abs(v), abs(v_stage))))**2)) / (2*DIMS*n_objs))
+
+        if (err <= 1) then
+          x = x_stage
+          v = v_stage
+          a = kv(:,:,STAGES)
+          kx(:,:,1) = kx(:,:,STAGES)
+          kv(:,:,1) = kv(:,:,STAGES)
+          if (last) then
+            t = t_out(snap)
+          else
+            t = t + h
+          end if
+          if (err > 0) then
+            factor = min(MAX_FACTOR, max(MIN_FACTOR, SAFETY*err**(-0.2_REAL_KIND)))
+          else
+            factor = MAX_FACTOR
+          end if
+          ! A step shortened to land on an output time does not limit the following steps
+          if (.not. last .or. factor < 1) then
+            dt_try = h*factor
+          end if
+        else
+          dt_try = h*max(MIN_FACTOR, SAFETY*err**(-0.2_REAL_KIND))
+        end if
+      end do
+
+      x_hist(:,:,snap) = x_scale_checked*transpose(x)
+      if(present(v_hist)) then
+        v_hist(:,:,snap) = v_scale_checked*transpose(v)
+      end if
+      n_done = snap
+      if(present(diag)) then
+        pot = potential_energy(x, m, n_objs, g, min_dist, theta_checked)
+        call compute_diagnostics(x, v, m, pot, n_objs, diag(:,snap))
+        if (energy_drifted(diag(:,snap), energy_ref_checked, max_drift_checked)) return
+      end if
+    end do
+  end subroutine iterate_rk45
+
+  subroutine accel_jerk(x, v, m, a, jerk, active, n_objs, n_active, g, min_dist)
+    ! Compute the accelerations and their time derivatives (jerks) of the active objects due to all the objects.
+    ! The active objects are given by their indices, so the cost is O(n_active*n_objs).
+    ! Note that on Python side the arguments n_objs and n_active are optional.
+    !f2py threadsafe
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+
+    integer, intent(in) :: n_objs, n_active
+    integer, intent(in) :: active(n_active)
+    real(kind=REAL_KIND), intent(in) :: x(DIMS,n_objs), v(DIMS,n_objs), m(n_objs), g, min_dist
+    real(kind=REAL_KIND), intent(out) :: a(DIMS,n_active), jerk(DIMS,n_active)
+
+    real(kind=REAL_KIND) :: d(DIMS), w(DIMS), dist2, inv_dist3, min_dist2
+    integer :: k, i, j
+
+    min_dist2 = min_dist**2
+    !$omp parallel do private(i, j, d, w, dist2, inv_dist3) schedule(static)
+    do k=1,n_active
+      i = active(k)
+      a(:,k) = 0
+      jerk(:,k) = 0
+      do j=1,n_objs
+        d = x(:,j) - x(:,i)
+        dist2 = sum(d**2)
+        ! Clipping prevents overflow
+        if ((i /= j) .and. (dist2 > min_dist2)) then
+          w = v(:,j) - v(:,i)
+          inv_dist3 = 1 / (dist2*sqrt(dist2))
+          a(:,k) = a(:,k) + m(j)*inv_dist3*d
+          jerk(:,k) = jerk(:,k) + m(j)*inv_dist3*(w - 3*dot_product(d, w)/dist2*d)
+        end if
+      end do
+      a(:,k) = g*a(:,k)
+      jerk(:,k) = g*jerk(:,k)
+    end do
+    !$omp end parallel do
+  end subroutine accel_jerk
+
+  subroutine iterate_block(x, v, a, jerk, level, m, dt, save_interval, n_objs, n_snaps, g, min_dist, x_hist, eta, &
+      max_level, n_evals, n_evals_global, n_done, v_hist, x_scale, v_scale, n_threads, diag, energy_ref, max_drift)
+    ! Fourth order Hermite integrator with block hierarchical timesteps (Makino & Aarseth 1992).
+    ! Each object has its own timestep dt/2**level, where dt is the longest step, and only the objects
+    ! whose step ends at the current time are corrected, while the others are only predicted.
+    ! The steps are chosen with the criterion eta*sqrt(|a|/|jerk|), and they may be halved at any time
+    ! but doubled only when the doubled step stays aligned with the blocks. All the objects are synchronized
+    ! after each step of length dt, and the histories are written as in iterate_hist.
+    !
+    ! The accelerations a and the jerks must correspond to the current state, see accel_jerk.
+    ! The levels are carried over between calls, and negative levels are initialized from the criterion.
+    ! n_evals is incremented by the number of single-object force evaluations and n_evals_global by the number
+    ! that a global step equal to the shortest step used within each dt would have needed.
+    ! The conservation diagnostics are written to diag and the drift of the energy is checked as in iterate_hist,
+    ! and n_done is the number of snapshots written.
+    !f2py threadsafe
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: N_DIAG = 11
+
+    integer, intent(in) :: save_interval, n_objs, n_snaps, max_level
+    real(kind=REAL_KIND), intent(inout) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs), jerk(DIMS,n_objs)
+    integer, intent(inout) :: level(n_objs)
+    real(kind=REAL_KIND), intent(in) :: m(n_objs), dt, g, min_dist, eta
+    real(kind=REAL_KIND), intent(inout) :: x_hist(n_objs,DIMS,n_snaps)
+    integer(kind=8), intent(inout) :: n_evals, n_evals_global
+    integer, intent(out) :: n_done
+    real(kind=REAL_KIND), intent(inout), optional :: v_hist(n_objs,DIMS,n_snaps), diag(N_DIAG,n_snaps)
+    real(kind=REAL_KIND), intent(in), optional :: x_scale, v_scale, energy_ref, max_drift
+    integer, intent(in), optional :: n_threads
+
+    ! Predicted states and the new accelerations and jerks of the active objects
+    real(kind=REAL_KIND) :: x_pred(DIMS,n_objs), v_pred(DIMS,n_objs), a_new(DIMS,n_objs), jerk_new(DIMS,n_objs)
+    real(kind=REAL_KIND) :: x_scale_checked, v_scale_checked, tick_dt, tau, h
+    ! The times are counted in ticks of the shortest possible step, and t_last is the time of the last correction
+    integer :: t_last(n_objs), active(n_objs), n_ticks, tick, n_active, finest, new_level
+    real(kind=REAL_KIND) :: max_drift_checked, energy_ref_checked, pot
+    integer :: snap, iter, i, k
+
+    ! Processing of optional arguments
+    if(present(x_scale)) then
+      x_scale_checked = x_scale
+    else
+      x_scale_checked = 1
+    end if
+    if(present(v_scale)) then
+      v_scale_checked = v_scale
+    else
+      v_scale_checked = 1
+    end if
+    if(present(n_threads)) then
+      call set_threads(n_threads)
+    end if
+    if(present(max_drift) .and. present(energy_ref)) then
+      max_drift_checked = max_drift
+      energy_ref_checked = energy_ref
+    else
+      max_drift_checked = 0
+      energy_ref_checked = 0
+    end if
+
+    n_done = 0
+    n_ticks = 2**max_level
+    tick_dt = dt / n_ticks
+    do i=1,n_objs
+      if (level(i) < 0) level(i) = criterion_level(a(:,i), jerk(:,i))
+    end do
+
+    do snap=1,n_snaps
+      do iter=1,save_interval
+        t_last = 0
+        finest = maxval(level)
+        tick = 0
+        do while (tick < n_ticks)
+          tick = minval(t_last + 2**(max_level - level))
+          n_active = 0
+          do i=1,n_objs
+            if (t_last(i) + 2**(max_level - level(i)) == tick) then
+              n_active = n_active + 1
+              active(n_active) = i
+            end if
+          end do
+
+          !$omp parallel do private(tau) schedule(static)
+          do i=1,n_objs
+            tau = (tick - t_last(i))*tick_dt
+            x_pred(:,i) = x(:,i) + tau*(v(:,i) + tau*(a(:,i)/2 + tau*jerk(:,i)/6))
+            v_pred(:,i) = v(:,i) + tau*(a(:,i) + tau*jerk(:,i)/2)
+          end do
+          !$omp end parallel do
+          call accel_jerk(x_pred, v_pred, m, a_new, jerk_new, active, n_objs, n_active, g, min_dist)
+          n_evals = n_evals + n_active
+
+          ! Hermite corrector
+          do k=1,n_active
+            i = active(k)
+            h = (tick - t_last(i))*tick_dt
+            v_pred(:,i) = v(:,i) + h/2*(a(:,i) + a_new(:,k)) + h**2/12*(jerk(:,i) - jerk_new(:,k))
+            x(:,i) = x(:,i) + h/2*(v(:,i) + v_pred(:,i)) + h**2/12*(a(:,i) - a_new(:,k))
+            v(:,i) = v_pred(:,i)
+            a(:,i) = a_new(:,k)
+            jerk(:,i) = jerk_new(:,k)
+            t_last(i) = tick
+
+            new_level = criterion_level(a(:,i), jerk(:,i))
+            if (new_level > level(i)) then
+              level(i) = new_level
+            else if (new_level < level(i) .and. mod(tick, 2**(max_level - level(i) + 1)) == 0) then
+              level(i) = level(i) - 1
+            end if
+            finest = max(finest, level(i))
+          end do
+        end do
+        n_evals_global = n_evals_global + int(n_objs, kind=8)*2**finest
+      end do
+
+      x_hist(:,:,snap) = x_scale_checked*transpose(x)
+      if(present(v_hist)) then
+        v_hist(:,:,snap) = v_scale_checked*transpose(v)
+      end if
+      n_done = snap
+      if(present(diag)) then
+        pot = potential_energy(x, m, n_objs, g, min_dist, 0._REAL_KIND)
+        call compute_diagnostics(x, v, m, pot, n_objs, diag(:,snap))
+        if (energy_drifted(diag(:,snap), energy_ref_checked, max_drift_checked)) return
+      end if
+    end do
+
+  contains
+    integer function criterion_level(acc, jrk)
+      ! The smallest level whose step is at most eta*sqrt(|a|/|jerk|)
+      real(kind=REAL_KIND), intent(in) :: acc(DIMS), jrk(DIMS)
+      real(kind=REAL_KIND) :: dt_crit
+
+      criterion_level = 0
+      if (norm2(jrk) == 0) return
+      dt_crit = eta*sqrt(norm2(acc) / norm2(jrk))
+      if (dt_crit < dt) then
+        criterion_level = min(max_level, ceiling(log(dt / dt_crit) / log(2._REAL_KIND)))
+      end if
+    end function criterion_level
+  end subroutine iterate_block
+
+  subroutine stumpff(z, c2, c3)
+    ! Stumpff functions c2(z) = (1 - cos(sqrt(z))) / z and c3(z) = (sqrt(z) - sin(sqrt(z))) / sqrt(z)**3
+    ! and their continuations to z <= 0. Near zero the series are used to avoid cancellation.
+    implicit none
+
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: N_TERMS = 8
+    real(kind=REAL_KIND), parameter :: SERIES_LIMIT = 0.1
+
+    real(kind=REAL_KIND), intent(in) :: z
+    real(kind=REAL_KIND), intent(out) :: c2, c3
+
+    real(kind=REAL_KIND) :: sqrt_z, term2, term3
+    integer :: k
+
+    if (abs(z) < SERIES_LIMIT) then
+      term2 = 1/2._REAL_KIND
+      term3 = 1/6._REAL_KIND
+      c2 = term2
+      c3 = term3
+      do k=1,N_TERMS
+        term2 = -term2*z / ((2*k + 1)*(2*k + 2))
+        term3 = -term3*z / ((2*k + 2)*(2*k + 3))
+        c2 = c2 + term2
+        c3 = c3 + term3
+      end do
+    else if (z > 0) then
+      sqrt_z = sqrt(z)
+      c2 = (1 - cos(sqrt_z)) / z
+      c3 = (sqrt_z - sin(sqrt_z)) / (z*sqrt_z)
+    else
+      sqrt_z = sqrt(-z)
+      c2 = (cosh(sqrt_z) - 1) / (-z)
+      c3 = (sinh(sqrt_z) - sqrt_z) / (-z*sqrt_z)
+    end if
+  end subroutine stumpff
+
+  subroutine kepler_drift(x, v, mu, dt)
+    ! Advance a body on a Kepler orbit around a fixed center with the gravitational parameter mu by dt.
+    ! The universal-variable Kepler equation is solved with the Laguerre-Conway iteration,
+    ! which converges for elliptic, parabolic and hyperbolic orbits alike, and the state is then
+    ! advanced with the f and g functions. For elliptic orbits whole periods are removed from dt first.
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: MAX_ITER = 50
+    ! Order of the Laguerre-Conway iteration
+    real(kind=REAL_KIND), parameter :: LC_N = 5
+    real(kind=REAL_KIND), parameter :: PI = 4*atan(1._REAL_KIND)
+
+    real(kind=REAL_KIND), intent(inout) :: x(DIMS), v(DIMS)
+    real(kind=REAL_KIND), intent(in) :: mu, dt
+
+    real(kind=REAL_KIND) :: r0, r, eta, zeta, alpha, sqrt_mu, dt_eff, period, chi, z, c2, c3, f, df, ddf, delta
+    real(kind=REAL_KIND) :: f_lagrange, g_lagrange, df_lagrange, dg_lagrange, x_new(DIMS)
+    integer :: iter
+
+    r0 = norm2(x)
+    if (r0 == 0 .or. dt == 0) return
+    sqrt_mu = sqrt(mu)
+    alpha = 2/r0 - dot_product(v, v)/mu
+    eta = dot_product(x, v)/sqrt_mu
+    zeta = 1 - alpha*r0
+
+    dt_eff = dt
+    if (alpha > 0) then
+      period = 2*PI / (sqrt_mu*alpha**1.5_REAL_KIND)
+      dt_eff = dt - period*anint(dt/period)
+      ! The initial guess is exact for circular orbits
+      chi = sqrt_mu*alpha*dt_eff
+    else
+      chi = sqrt_mu*dt_eff/r0
+      ! For long hyperbolic drifts the linear guess is far too large, and the asymptotic guess of Vallado is used
+      ! instead when it is smaller.
+      if (alpha < 0) then
+        f = -2*mu*alpha*dt_eff / (sqrt_mu*eta + sign(sqrt(-mu/alpha), dt_eff)*zeta)
+        if (f > 1) then
+          f = sign(sqrt(-1/alpha)*log(f), dt_eff)
+          if (abs(f) < abs(chi)) chi = f
+        end if
+      end if
+    end if
+
+    ! Solve F(chi) = r0*chi + eta*chi**2*c2 + zeta*chi**3*c3 - sqrt(mu)*dt = 0, where F'(chi) is the radius
+    do iter=1,MAX_ITER
+      z = alpha*chi**2
+      call stumpff(z, c2, c3)
+      f = r0*chi + eta*chi**2*c2 + zeta*chi**3*c3 - sqrt_mu*dt_eff
+      df = r0 + eta*chi*(1 - z*c3) + zeta*chi**2*c2
+      ddf = eta*(1 - z*c2) + zeta*chi*(1 - z*c3)
+      delta = LC_N*f / (df + sign(sqrt(abs((LC_N - 1)**2*df**2 - LC_N*(LC_N - 1)*f*ddf)), df))
+      chi = chi - delta
+      if (abs(delta) <= 4*epsilon(chi)*abs(chi)) exit
+    end do
+
+    z = alpha*chi**2
+    call stumpff(z, c2, c3)
+    r = r0 + eta*chi*(1 - z*c3) + zeta*chi**2*c2
+    f_lagrange = 1 - chi**2*c2/r0
+    g_lagrange = dt_eff - chi**3*c3/sqrt_mu
+    df_lagrange = sqrt_mu*chi*(z*c3 - 1) / (r*r0)
+    dg_lagrange = 1 - chi**2*c2/r
+
+    x_new = f_lagrange*x + g_lagrange*v
+    v = df_lagrange*x + dg_lagrange*v
+    x = x_new
+  end subroutine kepler_drift
+
+  subroutine iterate_wh(x, v, a, m, dt, save_interval, n_objs, n_snaps, g, min_dist, x_hist, central, n_done, v_hist, &
+      x_scale, v_scale, theta, n_threads, diag, energy_ref, max_drift)
+    ! Wisdom-Holman integrator in democratic heliocentric coordinates (Duncan, Levison & Lee 1998)
+    ! for systems dominated by the central object with the given index.
+    ! The orbits around the central object are advanced analytically with kepler_drift,
+    ! so the timestep has to resolve only the interactions of the other objects, not their orbits.
+    ! A step consists of half a kick by the interactions, half a drift by the momentum of the central object,
+    ! the Kepler drift, and the same halves in the reverse order. The kicks at the ends of consecutive steps
+    ! share a force evaluation.
+    ! The histories are written as in iterate_hist. On return a contains the accelerations of the full system.
+    ! The conservation diagnostics are written to diag and the drift of the energy is checked as in iterate_hist,
+    ! and n_done is the number of snapshots written.
+    !f2py threadsafe
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: N_DIAG = 11
+
+    integer, intent(in) :: save_interval, n_objs, n_snaps, central
+    real(kind=REAL_KIND), intent(inout) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs)
+    real(kind=REAL_KIND), intent(in) :: m(n_objs), dt, g, min_dist
+    real(kind=REAL_KIND), intent(inout) :: x_hist(n_objs,DIMS,n_snaps)
+    integer, intent(out) :: n_done
+    real(kind=REAL_KIND), intent(inout), optional :: v_hist(n_objs,DIMS,n_snaps), diag(N_DIAG,n_snaps)
+    real(kind=REAL_KIND), intent(in), optional :: x_scale, v_scale, theta, energy_ref, max_drift
+    integer, intent(in), optional :: n_threads
+
+    ! Heliocentric positions, barycentric velocities and the accelerations by the interactions
+    real(kind=REAL_KIND) :: q(DIMS,n_objs), u(DIMS,n_objs), a_int(DIMS,n_objs), m_int(n_objs)
+    real(kind=REAL_KIND) :: x_cm(DIMS), v_cm(DIMS), m_total, mu, t
+    real(kind=REAL_KIND) :: x_scale_checked, v_scale_checked, theta_checked
+    real(kind=REAL_KIND) :: max_drift_checked, energy_ref_checked, pot
+    integer :: snap, iter, i
+
+    ! Processing of optional arguments
+    if(present(x_scale)) then
+      x_scale_checked = x_scale
+    else
+      x_scale_checked = 1
+    end if
+    if(present(v_scale)) then
+      v_scale_checked = v_scale
+    else
+      v_scale_checked = 1
+    end if
+    if(present(theta)) then
+      theta_checked = theta
+    else
+      theta_checked = 0
+    end if
+    if(present(n_threads)) then
+      call set_threads(n_threads)
+    end if
+    if(present(max_drift) .and. present(energy_ref)) then
+      max_drift_checked = max_drift
+      energy_ref_checked = energy_ref
+    else
+      max_drift_checked = 0
+      energy_ref_checked = 0
+    end if
+
+    ! Conversion to democratic heliocentric coordinates.
+    ! The central object has no mass in the interactions, so the planet-planet forces can be computed
+    ! with the usual force engines.
+    m_total = sum(m)
+    mu = g*m(central)
+    x_cm = matmul(x, m) / m_total
+    v_cm = matmul(v, m) / m_total
+    do i=1,n_objs
+      q(:,i) = x(:,i) - x(:,central)
+      u(:,i) = v(:,i) - v_cm
+    end do
+    q(:,central) = 0
+    u(:,central) = 0
+    m_int = m
+    m_int(central) = 0
+    t = 0
+    n_done = 0
+
+    call compute_accel(q, m_int, a_int, n_objs, g, min_dist, theta_checked)
+    do snap=1,n_snaps
+      do iter=1,save_interval
+        u = u + a_int*dt/2
+        call wh_central_drift(dt/2)
+        !$omp parallel do schedule(static)
+        do i=1,n_objs
+          if (i /= central) call kepler_drift(q(:,i), u(:,i), mu, dt)
+        end do
+        !$omp end parallel do
+        call wh_central_drift(dt/2)
+        call compute_accel(q, m_int, a_int, n_objs, g, min_dist, theta_checked)
+        u = u + a_int*dt/2
+        t = t + dt
+      end do
+
+      ! Conversion back to the barycentric coordinates of the input
+      x(:,central) = x_cm + v_cm*t - matmul(q, m_int) / m_total
+      v(:,central) = v_cm - matmul(u, m_int) / m(central)
+      do i=1,n_objs
+        if (i /= central) then
+          x(:,i) = q(:,i) + x(:,central)
+          v(:,i) = u(:,i) + v_cm
+        end if
+      end do
+      x_hist(:,:,snap) = x_scale_checked*transpose(x)
+      if(present(v_hist)) then
+        v_hist(:,:,snap) = v_scale_checked*transpose(v)
+      end if
+      n_done = snap
+      if(present(diag)) then
+        call compute_accel(x, m, a, n_objs, g, min_dist, theta_checked, pot)
+        call compute_diagnostics(x, v, m, pot, n_objs, diag(:,snap))
+        if (energy_drifted(diag(:,snap), energy_ref_checked, max_drift_checked)) return
+      end if
+    end do
+    ! With the diagnostics the accelerations have already been computed for the potential energy
+    if (.not. present(diag)) then
+      call compute_accel(x, m, a, n_objs, g, min_dist, theta_checked)
+    end if
+
+  contains
+    subroutine wh_central_drift(h)
+      ! Drift of the heliocentric positions by the momentum of the central object
+      real(kind=REAL_KIND), intent(in) :: h
+      real(kind=REAL_KIND) :: shift(DIMS)
+      integer :: j
+
+      shift = h * matmul(u, m_int) / m(central)
+      do j=1,n_objs
+        q(:,j) = q(:,j) + shift
+      end do
+      q(:,central) = 0
+    end subroutine wh_central_drift
+  end subroutine iterate_wh
+
+  subroutine iterate_ensemble(x, v, a, m, dt, save_interval, n_objs, n_systems, n_snaps, g, min_dist, x_hist, &
+      x_scale, use_rk4, n_threads)
+    ! Advance a batch of independent systems with the same number of objects in a single call
+    ! by n_snaps*save_interval steps, and write a snapshot of each system after every save_interval steps.
+    ! The last index of the state arrays is the system, and each system has its own timestep.
+    ! The history has the indices (system, celestial, dim, snapshot), so that it corresponds to a C-ordered
+    ! NumPy array with the indices (snapshot, dim, celestial, system). The snapshots are multiplied by x_scale.
+    ! The systems are distributed to the OpenMP threads, so the force loops of each system run serially.
+    ! Note that on Python side the arguments n_objs, n_systems and n_snaps are optional.
+    !f2py threadsafe
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+
+    integer, intent(in) :: save_interval, n_objs, n_systems, n_snaps
+    real(kind=REAL_KIND), intent(inout) :: x(DIMS,n_objs,n_systems), v(DIMS,n_objs,n_systems), a(DIMS,n_objs,n_systems)
+    real(kind=REAL_KIND), intent(in) :: m(n_objs,n_systems), dt(n_systems), g(n_systems), min_dist(n_systems)
+    real(kind=REAL_KIND), intent(inout) :: x_hist(n_systems,n_objs,DIMS,n_snaps)
+    real(kind=REAL_KIND), intent(in), optional :: x_scale
+    logical, intent(in), optional :: use_rk4
+    integer, intent(in), optional :: n_threads
+
+    real(kind=REAL_KIND) :: x_scale_checked
+    logical :: use_rk4_checked
+    integer :: k, snap, iter
+
+    if(present(x_scale)) then
+      x_scale_checked = x_scale
+    else
+      x_scale_checked = 1
+    end if
+    if(present(use_rk4)) then
+      use_rk4_checked = use_rk4
+    else
+      use_rk4_checked = .false.
+    end if
+    if(present(n_threads)) then
+      call set_threads(n_threads)
+    end if
+
+    !$omp parallel do private(snap, iter) schedule(dynamic)
+    do k=1,n_systems
+      do snap=1,n_snaps
+        do iter=1,save_interval
+          if (use_rk4_checked) then
+            call rk4_step(x(:,:,k), v(:,:,k), a(:,:,k), m(:,k), dt(k), n_objs, g(k), min_dist(k), 0._REAL_KIND)
+          else
+            call verlet_step(x(:,:,k), v(:,:,k), a(:,:,k), m(:,k), dt(k), n_objs, g(k), min_dist(k), 0._REAL_KIND)
+          end if
+        end do
+        x_hist(k,:,:,snap) = x_scale_checked * transpose(x(:,:,k))
+      end do
+    end do
+    !$omp end parallel do
+  end subroutine iterate_ensemble
+
+  subroutine set_threads(n_threads)
+    ! Set the number of OpenMP threads used by the force loops.
+    ! Values below 1 leave the current setting, which defaults to the OMP_NUM_THREADS environment variable.
+    !$ use omp_lib
+    implicit none
+    integer, intent(in) :: n_threads
+    !$ if (n_threads > 0) call omp_set_num_threads(n_threads)
+  end subroutine set_threads
+
+  integer function get_threads()
+    ! Get the number of OpenMP threads that the force loops will use. This is 1 if OpenMP is not enabled.
+    !$ use omp_lib
+    implicit none
+    get_threads = 1
+    !$ get_threads = omp_get_max_threads()
+  end function get_threads
+
   subroutine print_arr_1d(arr, name, unit)
     implicit none
     integer, parameter :: REAL_KIND = 8
@@ -246,6 +1700,36 @@ contains
     call print_arr_2d(a, "a")
   end subroutine print_progress
 
+  subroutine print_status(x, v, a, i, dt, n_steps, n_objs, print_format, start_count, start_iter)
+    ! Print the full state with print_format 0 or a single line of progress with print_format 1,
+    ! which is cheap also for large numbers of objects.
+    ! start_count is the value of system_clock at the beginning of the simulation loop,
+    ! which started after the iteration start_iter.
+    implicit none
+
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+
+    integer, intent(in) :: i, n_steps, n_objs, print_format, start_iter
+    real(kind=REAL_KIND), intent(in) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs)
+    real(kind=REAL_KIND), intent(in) :: dt
+    integer(kind=8), intent(in) :: start_count
+
+    integer(kind=8) :: count, count_rate
+    real(kind=REAL_KIND) :: elapsed
+
+    if (print_format /= 1) then
+      call print_progress(x, v, a, i, dt, n_steps, n_objs)
+      return
+    end if
+    call system_clock(count, count_rate)
+    elapsed = max(real(count - start_count, REAL_KIND) / count_rate, tiny(elapsed))
+    write(*, "(a, i0, a, i0, a, f5.1, a, es10.3, a, es10.3, a, es10.3, a)") &
+      "Iteration ", i, "/", n_steps, " (", 100._REAL_KIND*i/n_steps, " %), ", elapsed, " s, ", &
+      (i - start_iter) / elapsed, " steps/s, ", &
+      real(i - start_iter, REAL_KIND) * n_objs * (n_objs - 1) / (2*elapsed), " pairs/s"
+  end subroutine print_status
+
   subroutine write_progress(x, v, a, i, n_objs, path)
     implicit none
     integer, parameter :: DIMS = 3
@@ -265,7 +1749,8 @@ contains
       print *,"Failed to create full path for output file: ", full_path
       stop
     end if
-    open(OUTPUT_FILE_UNIT, file=full_path, iostat=ios, status="new", form="formatted")
+    ! A resumed run replaces the files that the interrupted run wrote after its last checkpoint
+    open(OUTPUT_FILE_UNIT, file=full_path, iostat=ios, status="replace", form="formatted")
     if (ios /= 0) then
       print *, "Failed to create output file to path: ", full_path
     end if
@@ -275,4 +1760,193 @@ contains
 
     close(OUTPUT_FILE_UNIT)
   end subroutine write_progress
+
+  subroutine write_output(x, v, a, i, n_objs, path, output_format, record)
+    ! Write the state after iteration i as the given record number in the selected output format:
+    ! 0 = a formatted text file per write, 1 = a record in the binary file opened with open_binary_output
+    implicit none
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+
+    integer, intent(in) :: i, n_objs, output_format, record
+    real(kind=REAL_KIND), intent(in) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs)
+    character(len=*), intent(in) :: path
+
+    if (output_format == 1) then
+      call write_binary_progress(x, v, a, i, n_objs, record)
+    else
+      call write_progress(x, v, a, i, n_objs, path)
+    end if
+  end subroutine write_output
+
+  subroutine open_binary_output(path, n_objs, n_records, write_interval, dt, resume)
+    ! Create the binary output file trajectory.bin in the output folder and preallocate it for n_records records.
+    ! If resume is true, the existing file of an interrupted run is opened instead,
+    ! and the records after the checkpoint are overwritten.
+    !
+    ! The file is written with stream access in the native byte order, and it begins with a header of 64 bytes:
+    ! magic "planetary-motion" (16 chars), version, n_objs, n_records, n_written, write_interval, padding (int32)
+    ! and dt (float64), followed by zero padding.
+    ! Each record consists of the iteration (int64) and the arrays x, v and a (float64, 3 x n_objs each).
+    ! The records can be read without copying with NumPy, see store.read_cli_output.
+    implicit none
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: OUTPUT_FILE_UNIT = 11
+    integer, parameter :: MAX_PATH_LEN = 200
+    integer, parameter :: HEADER_SIZE = 64
+    integer, parameter :: VERSION = 1
+
+    character(len=*), intent(in) :: path
+    integer, intent(in) :: n_objs, n_records, write_interval
+    real(kind=REAL_KIND), intent(in) :: dt
+    logical, intent(in) :: resume
+
+    integer :: ios, file_version, file_n_objs, file_n_records
+    integer(kind=8) :: file_size
+    character(len=MAX_PATH_LEN) :: full_path
+    character(len=HEADER_SIZE) :: header
+    character(len=16) :: magic
+
+    full_path = trim(path) // "/trajectory.bin"
+    if (resume) then
+      open(OUTPUT_FILE_UNIT, file=full_path, iostat=ios, status="old", access="stream", form="unformatted")
+      if (ios /= 0) then
+        print *, "Failed to open the output file of the resumed run: ", full_path
+        stop
+      end if
+      read(OUTPUT_FILE_UNIT, pos=1, iostat=ios) magic, file_version, file_n_objs, file_n_records
+      if (ios /= 0 .or. magic /= "planetary-motion" .or. file_version /= VERSION &
+          .or. file_n_objs /= n_objs .or. file_n_records /= n_records) then
+        print *, "The output file does not match the resumed run: ", full_path
+        stop
+      end if
+      return
+    end if
+    open(OUTPUT_FILE_UNIT, file=full_path, iostat=ios, status="replace", access="stream", form="unformatted")
+    if (ios /= 0) then
+      print *, "Failed to create output file to path: ", full_path
+      stop
+    end if
+    header = repeat(achar(0), HEADER_SIZE)
+    write(OUTPUT_FILE_UNIT, pos=1) header
+    write(OUTPUT_FILE_UNIT, pos=1) "planetary-motion", VERSION, n_objs, n_records, 0, write_interval, 0, dt
+
+    ! Writing the last byte allocates the full file at once
+    ! Each record has the iteration and three arrays of 3 x n_objs doubles
+    file_size = HEADER_SIZE + int(n_records, kind=8)*(8 + 3*3*8*int(n_objs, kind=8))
+    if (n_records > 0) then
+      write(OUTPUT_FILE_UNIT, pos=file_size) achar(0)
+    end if
+  end subroutine open_binary_output
+
+  subroutine write_binary_progress(x, v, a, i, n_objs, record)
+    implicit none
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: OUTPUT_FILE_UNIT = 11
+    integer, parameter :: HEADER_SIZE = 64
+    ! Position of n_written in the header
+    integer, parameter :: N_WRITTEN_POS = 29
+
+    integer, intent(in) :: i, n_objs, record
+    real(kind=REAL_KIND), intent(in) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs)
+
+    integer(kind=8) :: pos
+
+    pos = HEADER_SIZE + (record - 1)*(8 + 3*3*8*int(n_objs, kind=8)) + 1
+    write(OUTPUT_FILE_UNIT, pos=pos) int(i, kind=8), x, v, a
+    ! The number of written records is updated after the record so that an interrupted run leaves a valid file
+    write(OUTPUT_FILE_UNIT, pos=N_WRITTEN_POS) record
+  end subroutine write_binary_progress
+
+  subroutine close_binary_output()
+    implicit none
+    integer, parameter :: OUTPUT_FILE_UNIT = 11
+    close(OUTPUT_FILE_UNIT)
+  end subroutine close_binary_output
+
+  subroutine write_checkpoint(path, x, v, a, m, i, dt, n_objs)
+    ! Write the state after iteration i to checkpoint.bin in the output folder, from which read_checkpoint resumes the run.
+    !
+    ! The file is written with stream access in the native byte order: magic "pm-checkpoint" (16 chars),
+    ! version, n_objs (int32), iteration (int64) and dt (float64), followed by the arrays x, v, a (3 x n_objs)
+    ! and m (n_objs) as float64.
+    ! The checkpoint is first written to a temporary file, which then replaces the previous checkpoint,
+    ! so that an interrupted write leaves the previous checkpoint intact.
+    implicit none
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: CHECKPOINT_FILE_UNIT = 12
+    integer, parameter :: MAX_PATH_LEN = 200
+    integer, parameter :: VERSION = 1
+    character(len=16), parameter :: MAGIC = "pm-checkpoint"
+
+    character(len=*), intent(in) :: path
+    integer, intent(in) :: i, n_objs
+    real(kind=REAL_KIND), intent(in) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs), m(n_objs), dt
+
+    integer :: ios
+    character(len=MAX_PATH_LEN) :: full_path, tmp_path
+
+    full_path = trim(path) // "/checkpoint.bin"
+    tmp_path = trim(full_path) // ".tmp"
+    open(CHECKPOINT_FILE_UNIT, file=tmp_path, iostat=ios, status="replace", access="stream", form="unformatted")
+    if (ios /= 0) then
+      print *, "Failed to create checkpoint file to path: ", tmp_path
+      stop
+    end if
+    write(CHECKPOINT_FILE_UNIT) MAGIC, VERSION, n_objs, int(i, kind=8), dt, x, v, a, m
+    close(CHECKPOINT_FILE_UNIT)
+    ! The GNU extension rename replaces the old file atomically on POSIX systems
+    call rename(tmp_path, full_path, ios)
+    if (ios /= 0) then
+      print *, "Failed to replace the checkpoint file: ", full_path
+      stop
+    end if
+  end subroutine write_checkpoint
+
+  subroutine read_checkpoint(path, x, v, a, m, i, dt, n_objs)
+    ! Read the state of a checkpoint written by write_checkpoint to the output folder.
+    ! The number of objects must match that of the configuration.
+    implicit none
+    integer, parameter :: DIMS = 3
+    integer, parameter :: REAL_KIND = 8
+    integer, parameter :: CHECKPOINT_FILE_UNIT = 12
+    integer, parameter :: MAX_PATH_LEN = 200
+    integer, parameter :: VERSION = 1
+    character(len=16), parameter :: MAGIC = "pm-checkpoint"
+
+    character(len=*), intent(in) :: path
+    integer, intent(in) :: n_objs
+    integer, intent(out) :: i
+    real(kind=REAL_KIND), intent(out) :: x(DIMS,n_objs), v(DIMS,n_objs), a(DIMS,n_objs), m(n_objs), dt
+
+    integer :: ios, file_version, file_n_objs
+    integer(kind=8) :: iteration
+    character(len=MAX_PATH_LEN) :: full_path
+    character(len=16) :: file_magic
+
+    full_path = trim(path) // "/checkpoint.bin"
+    open(CHECKPOINT_FILE_UNIT, file=full_path, iostat=ios, status="old", access="stream", form="unformatted")
+    if (ios /= 0) then
+      print *, "Failed to open checkpoint file: ", full_path
+      stop
+    end if
+    read(CHECKPOINT_FILE_UNIT, iostat=ios) file_magic, file_version, file_n_objs
+    if (ios /= 0 .or. file_magic /= MAGIC .or. file_version /= VERSION) then
+      print *, "Not a valid checkpoint file: ", full_path
+      stop
+    end if
+    if (file_n_objs /= n_objs) then
+      print *, "The checkpoint has ", file_n_objs, " objects instead of the configured ", n_objs
+      stop
+    end if
+    read(CHECKPOINT_FILE_UNIT, iostat=ios) iteration, dt, x, v, a, m
+    if (ios /= 0) then
+      print *, "Failed to read checkpoint file: ", full_path
+      stop
+    end if
+    close(CHECKPOINT_FILE_UNIT)
+    i = int(iteration)
+  end subroutine read_checkpoint
 end module core
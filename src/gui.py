@@ -1,3 +1,7 @@
+import logging
+import queue
+import threading
+import time
 import typing as tp
 
 import numpy as np
@@ -9,14 +13,30 @@ except ImportError:
     print("Warning: PySide6 not found. Falling back to PySide2.")
     from PySide2 import QtCore, QtGui, QtWidgets
 
+from observers import QueueObserver, RunStopped
 from sim import Simulation
 
+logger = logging.getLogger(__name__)
+
+# Number of segments in the trail of each object
+TRAIL_SEGMENTS = 256
+# Number of snapshots of a finished history that are converted to the drawing format and cached around the drawn one
+FRAME_WINDOW = 1024
+# Duration of the playback of a finished history with the default speed (s)
+PLAYBACK_DURATION = 30
+
 
 class NBodyWidget(gl.GLViewWidget):
+    # Emitted when the camera is zoomed, which changes the level of detail of the trails
+    zoomed = QtCore.Signal()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.pos: tp.Optional[gl.GLScatterPlotItem] = None
         self.color = (1, 1, 1, .5)
+        # The colors and sizes that have been given to the scatter plot
+        self._color = None
+        self._size = None
         # self.create_grids()
 
         # Apparently setting the default camera position does not work
@@ -40,12 +60,22 @@ class NBodyWidget(gl.GLViewWidget):
         # gz.translate(0, 0, -10)
         self.addItem(gz)
 
+    def wheelEvent(self, ev):
+        super().wheelEvent(ev)
+        self.zoomed.emit()
+
     def set_pos(self, pos, color=None, size=None):
-        kwargs = {
-            "color": color if color is not None else self.color
-        }
-        if size is not None:
-            kwargs["size"] = size
+        """
+        Set the positions with the indices (celestial, dim).
+        The colors and sizes are given to the scatter plot only when they change,
+        and float32 positions are used by the plot without a conversion.
+        """
+        kwargs = {}
+        color = color if color is not None else self.color
+        if color is not self._color:
+            kwargs["color"] = self._color = color
+        if size is not None and size is not self._size:
+            kwargs["size"] = self._size = size
         if self.pos is None:
             self.pos = gl.GLScatterPlotItem(pos=pos, **kwargs)
             self.addItem(self.pos)
@@ -53,6 +83,109 @@ class NBodyWidget(gl.GLViewWidget):
             self.pos.setData(pos=pos, **kwargs)
 
 
+class Frames:
+    def __init__(self, n_objs: int, unit_mult: float = 1, hist: np.ndarray = None, window: int = FRAME_WINDOW):
+        """
+        Unit-scaled float32 positions with the indices (snapshot, celestial, dim), which are drawn without conversions.
+        A finished history is converted on demand: a window of snapshots from the drawn one onwards is cached,
+        so that a history mapped from a TrajectoryStore is neither loaded nor copied as a whole.
+        The snapshots of a live run are not stored elsewhere, so they are kept in a buffer that grows by doubling.
+        :param hist: finished history with the indices (snapshot, dim, celestial), or None for a live run
+        :param window: number of snapshots of the history that are cached
+        """
+        self.unit_mult = unit_mult
+        self.hist = hist
+        self.window = window
+        # The live snapshots or the cached window of the history
+        self._buffer = np.empty((0, n_objs, 3), dtype=np.float32)
+        self._n_live = 0
+        # First snapshot of the cached window
+        self._start = 0
+
+    def __len__(self) -> int:
+        return self._n_live if self.hist is None else self.hist.shape[0]
+
+    def _convert(self, x: np.ndarray) -> np.ndarray:
+        return (np.swapaxes(x, 1, 2) / self.unit_mult).astype(np.float32)
+
+    def append(self, x: np.ndarray):
+        """Convert the snapshots of a live run with the indices (snapshot, dim, celestial) and append them"""
+        n_snaps = x.shape[0]
+        if self._n_live + n_snaps > self._buffer.shape[0]:
+            buffer = np.empty(
+                (max(2 * self._buffer.shape[0], self._n_live + n_snaps), *self._buffer.shape[1:]), dtype=np.float32)
+            buffer[:self._n_live] = self._buffer[:self._n_live]
+            self._buffer = buffer
+        self._buffer[self._n_live:self._n_live + n_snaps] = self._convert(x)
+        self._n_live += n_snaps
+
+    def __getitem__(self, snap: int) -> np.ndarray:
+        """Positions of a snapshot with the indices (celestial, dim)"""
+        if self.hist is None:
+            return self._buffer[snap]
+        if not self._start <= snap < self._start + self._buffer.shape[0]:
+            # The window starts a little before the snapshot, so that small moves back do not convert it again
+            self._start = max(0, min(snap - self.window // 8, len(self) - self.window))
+            self._buffer = self._convert(self.hist[self._start:self._start + self.window])
+        return self._buffer[snap - self._start]
+
+    def take(self, snaps: np.ndarray) -> np.ndarray:
+        """Positions of the given snapshots with the indices (snapshot, celestial, dim)"""
+        if self.hist is None:
+            return self._buffer[snaps]
+        if self._start <= np.min(snaps) and np.max(snaps) < self._start + self._buffer.shape[0]:
+            return self._buffer[snaps - self._start]
+        # Snapshots that are spread over the history are read individually instead of through the window
+        return self._convert(self.hist[snaps])
+
+
+class Trails:
+    def __init__(self, colors: np.ndarray, n_segments: int = TRAIL_SEGMENTS):
+        """
+        Orbit trails of all the objects, which are drawn as line segments by a single GLLinePlotItem.
+        The segments are stored in a ring buffer, where a new segment of each object replaces its oldest one.
+        Advancing the trails therefore writes only the new segments instead of rebuilding the vertex array,
+        and since the segments are drawn independently, their order in the buffer does not matter.
+        :param colors: RGBA color of each object
+        """
+        n_objs = colors.shape[0]
+        self.n_segments = n_segments
+        # Indices: (segment, celestial, end, dim)
+        self.pos = np.zeros((n_segments, n_objs, 2, 3), dtype=np.float32)
+        color = np.empty((n_segments, n_objs, 2, 4), dtype=np.float32)
+        color[:] = colors[np.newaxis, :, np.newaxis, :]
+        # The buffer is updated in place and given back to the item with setData, which does not copy
+        # a contiguous float32 array but marks the positions to be uploaded again.
+        # Newer pyqtgraph versions upload the vertices only then, so update() alone would draw stale trails.
+        self.item = gl.GLLinePlotItem(pos=self.pos.reshape(-1, 3), color=color.reshape(-1, 4), mode="lines")
+        self._head = 0
+        # Snapshot at the end of the newest segment, and the number of snapshots per segment
+        self.end: tp.Optional[int] = None
+        self.stride = 1
+
+    def reset(self, frames: Frames, end: int, stride: int):
+        """Rebuild the trails so that they end at the given snapshot"""
+        # The segments before the first snapshot collapse to points, which are not visible
+        snaps = np.maximum(end - stride * np.arange(self.n_segments, -1, -1), 0)
+        points = frames.take(snaps)
+        self.pos[:, :, 0] = points[:-1]
+        self.pos[:, :, 1] = points[1:]
+        self._head = 0
+        self.end = end
+        self.stride = stride
+        self.item.setData(pos=self.pos.reshape(-1, 3))
+
+    def advance(self, frames: Frames, end: int):
+        """Extend the trails to a later snapshot, which must be a multiple of the stride"""
+        points = frames.take(np.arange(self.end, end + 1, self.stride))
+        for i in range(points.shape[0] - 1):
+            self.pos[self._head, :, 0] = points[i]
+            self.pos[self._head, :, 1] = points[i + 1]
+            self._head = (self._head + 1) % self.n_segments
+        self.end = end
+        self.item.setData(pos=self.pos.reshape(-1, 3))
+
+
 class NBodyWidget2D(pg.GraphicsWidget):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -60,8 +193,71 @@ class NBodyWidget2D(pg.GraphicsWidget):
         self.color = (1, 1, 1, .5)
 
 
+class SimulationThread(threading.Thread):
+    def __init__(
+            self,
+            sim: Simulation,
+            steps: int,
+            save_interval: int,
+            chunk_size: int = 10,
+            maxsize: int = 16,
+            **run_kwargs):
+        """
+        Run a simulation in the background and stream its snapshots to the GUI through a QueueObserver.
+        The Fortran core releases the GIL, so the GUI stays responsive while the integrator runs.
+        The simulation does not store the history, since the GUI collects it from the queue.
+        :param chunk_size: number of snapshots per chunk, which sets the latency of the live view
+        :param maxsize: number of chunks that can wait for the GUI before new chunks are dropped
+        :param run_kwargs: further arguments of Simulation.run
+        """
+        super().__init__(daemon=True)
+        self.sim = sim
+        self.steps = steps
+        self.save_interval = save_interval
+        self.chunk_size = chunk_size
+        self.run_kwargs = run_kwargs
+        self.observer = QueueObserver(maxsize)
+        self.error: tp.Optional[Exception] = None
+
+    def run(self):
+        try:
+            self.sim.run(
+                self.steps, self.save_interval, chunk_size=self.chunk_size,
+                observers=[self.observer], store_history=False, **self.run_kwargs)
+        except RunStopped:
+            logger.info("The simulation was stopped at t=%s", self.sim.t * self.sim.t_scale)
+        except Exception as e:
+            self.error = e
+            logger.exception("The simulation failed")
+
+    def stop(self):
+        """Stop the simulation after its current chunk"""
+        self.observer.stop()
+
+
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self, sim: Simulation, *args, unit_mult: float = 1, **kwargs):
+    def __init__(
+            self,
+            sim: Simulation,
+            *args,
+            unit_mult: float = 1,
+            live: SimulationThread = None,
+            fps: float = 30,
+            trails: bool = True,
+            trail_segments: int = TRAIL_SEGMENTS,
+            playback_speed: float = None,
+            **kwargs):
+        """
+        3D view of a simulation with a slider for the snapshots and a playback mode
+        :param live: show the snapshots of a running simulation as they arrive instead of its finished history.
+            The slider follows the newest snapshot unless it has been moved back.
+        :param fps: target frame rate of the live view and the playback. Only the newest snapshot is drawn on each frame.
+        :param trails: draw the orbit trails
+        :param trail_segments: number of segments in each trail.
+            When zoomed out, each segment covers more snapshots, so the trails get longer at the same cost.
+        :param playback_speed: snapshots per second in the playback,
+            defaults to playing a finished history in PLAYBACK_DURATION seconds
+        """
         super().__init__(*args, **kwargs)
 
         # UI creation
@@ -73,36 +269,159 @@ class MainWindow(QtWidgets.QMainWindow):
         cw.setLayout(layout)
 
         self.nbody = NBodyWidget()
-        layout.addWidget(self.nbody, 0, 0)
+        layout.addWidget(self.nbody, 0, 0, 1, 2)
 
         self.slider = QtWidgets.QSlider(QtCore.Qt.Orientation.Horizontal)
         self.slider.setTickPosition(QtWidgets.QSlider.TickPosition.TicksBelow)
         layout.addWidget(self.slider, 1, 0)
-        self.slider.sliderMoved.connect(self.redraw)
-        self.slider.setRange(1, 50)
-        self.slider.setSingleStep(10)
-        self.slider.setTickInterval(10)
+        self.slider.setSingleStep(1)
+        self.slider.valueChanged.connect(self.request_frame)
+
+        self.play_button = QtWidgets.QPushButton("Play")
+        self.play_button.setCheckable(True)
+        self.play_button.toggled.connect(self.set_playing)
+        layout.addWidget(self.play_button, 1, 1)
 
         # Simulation
         self.sim = sim
         self.unit_mult = unit_mult
-        self.colors = np.array([[*cel.color, 255] for cel in sim.celestials]) / 255
+        # A simulation created from arrays has no celestials, and its objects are drawn in white
+        if sim.celestials:
+            self.colors = np.array([[*cel.color, 255] for cel in sim.celestials]) / 255
+        else:
+            self.colors = np.ones((sim.m.size, 4))
         self.sizes = 1
 
         self.nbody.create_grids(1)
         self.nbody.setCameraPosition(distance=1)
-        sim_len = len(self.sim.x_hist)
-        self.slider.setRange(0, sim_len-1)
-        self.slider.setRange(0, sim_len-1)
-        self.slider.setSingleStep(1)
-        self.slider.setTickInterval(1)
-        self.slider.setSliderPosition(0)
+        # The level of detail of the trails is relative to the initial zoom
+        self._base_distance = self.nbody.opts["distance"]
+        self.trails: tp.Optional[Trails] = None
+        if trails:
+            self.trails = Trails(self.colors, trail_segments)
+            self.nbody.addItem(self.trails.item)
+            self.nbody.zoomed.connect(lambda: self.request_frame(self.slider.value()))
+
+        self.frames = Frames(sim.m.size, unit_mult, hist=sim.x_hist if live is None else None)
+
+        # Redraws are coalesced, so that only the latest of the requests made during a frame is drawn
+        self._requested = 0
+        self._draw_timer = QtCore.QTimer()
+        self._draw_timer.setSingleShot(True)
+        self._draw_timer.timeout.connect(lambda: self.redraw(self._requested))
 
-        self.redraw(0)
+        self.playback_timer = QtCore.QTimer()
+        self.playback_timer.setInterval(round(1000 / fps))
+        self.playback_timer.timeout.connect(self._play_step)
+        self._play_pos = 0.
+        self._play_clock = 0.
+
+        self.live = live
+        if live is None:
+            self._set_range()
+            self.redraw(0)
+        else:
+            self.slider.setRange(0, 0)
+            self.timer = QtCore.QTimer()
+            self.timer.timeout.connect(self.poll)
+            self.timer.start(round(1000 / fps))
+        self.playback_speed = max(1., self.n_frames / PLAYBACK_DURATION) if playback_speed is None else playback_speed
+
+    @property
+    def n_frames(self) -> int:
+        return len(self.frames)
+
+    def _set_range(self):
+        self.slider.setRange(0, max(0, self.n_frames - 1))
+        # A tick for each snapshot would make the slider slow to draw for long histories
+        self.slider.setTickInterval(max(1, self.n_frames // 100))
+
+    def poll(self):
+        """Collect the chunks that the simulation thread has produced and draw the newest snapshot"""
+        following = self.slider.value() == self.slider.maximum()
+        # Checked before emptying the queue, so that the chunks of a thread that just finished are not lost
+        alive = self.live.is_alive()
+        t = None
+        while True:
+            try:
+                x, t = self.live.observer.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.frames.append(x)
+        if t is not None:
+            self._set_range()
+            if following:
+                self.slider.setValue(self.slider.maximum())
+            self.statusBar().showMessage(
+                f"t = {t[-1]:.6g} s, {self.n_frames} snapshots, {self.live.observer.n_dropped} dropped")
+        elif not alive:
+            self.timer.stop()
+            self.statusBar().showMessage(
+                f"Finished: {self.n_frames} snapshots, {self.live.observer.n_dropped} dropped"
+                + ("" if self.live.error is None else f", error: {self.live.error}"))
+
+    def set_playing(self, playing: bool):
+        self.play_button.setText("Pause" if playing else "Play")
+        if not playing:
+            self.playback_timer.stop()
+            return
+        if self.slider.value() >= self.n_frames - 1:
+            self.slider.setValue(0)
+        self._play_pos = self.slider.value()
+        self._play_clock = time.perf_counter()
+        self.playback_timer.start()
+
+    def _play_step(self):
+        # The slider may have been moved during the playback
+        if self.slider.value() != int(self._play_pos):
+            self._play_pos = self.slider.value()
+        # The position follows the wall clock, so slow frames skip snapshots instead of slowing down the playback
+        now = time.perf_counter()
+        self._play_pos += (now - self._play_clock) * self.playback_speed
+        self._play_clock = now
+        if self._play_pos >= self.n_frames - 1:
+            self._play_pos = max(0, self.n_frames - 1)
+            # A live run continues to play as new snapshots arrive
+            if self.live is None or not self.live.is_alive():
+                self.play_button.setChecked(False)
+        self.slider.setValue(int(self._play_pos))
+
+    def closeEvent(self, event: QtGui.QCloseEvent):
+        if self.live is not None:
+            self.live.stop()
+        super().closeEvent(event)
+
+    def request_frame(self, hist_ind: int):
+        """Draw the given snapshot when the event loop is next idle"""
+        self._requested = hist_ind
+        if not self._draw_timer.isActive():
+            self._draw_timer.start(0)
+
+    def _trail_stride(self) -> int:
+        """
+        Number of snapshots per trail segment at the current zoom.
+        When zoomed out, the segments get shorter on the screen, so they can cover more snapshots.
+        The stride is a power of two, so that small changes of the zoom do not rebuild the trails.
+        """
+        zoom = self.nbody.opts["distance"] / self._base_distance
+        # The trails need not be longer than the history
+        max_stride = max(1, self.n_frames // self.trails.n_segments)
+        if zoom <= 1:
+            return 1
+        return 2 ** min(int(np.log2(zoom)), int(np.log2(max_stride)))
 
     def redraw(self, hist_ind: int):
-        x = self.sim.x_hist[hist_ind] / self.unit_mult
-        # self.nbody.set_pos(x, color=self.colors, size=self.sizes)
-        # print("x", hist_ind)
-        # print(x.T)
-        self.nbody.set_pos(x.T, color=self.colors)
+        if hist_ind >= self.n_frames:
+            return
+        self.nbody.set_pos(self.frames[hist_ind], color=self.colors)
+        if self.trails is None:
+            return
+        stride = self._trail_stride()
+        end = hist_ind // stride * stride
+        trails = self.trails
+        # Playing forward extends the trails, and other moves rebuild them
+        if trails.end is not None and stride == trails.stride \
+                and trails.end <= end <= trails.end + stride * trails.n_segments // 4:
+            trails.advance(self.frames, end)
+        else:
+            trails.reset(self.frames, end, stride)
@@ -0,0 +1,232 @@
+"""
+Initial conditions for large systems
+
+The generators return the positions, velocities and masses as arrays instead of Celestial objects,
+so that systems of millions of objects can be created in a fraction of a second.
+The positions and velocities have the indices (celestial, dim), and can be given to Simulation.from_arrays.
+
+The initial conditions can also be saved to a file that both Simulation and the Fortran CLI read in bulk.
+The file is a NumPy .npy file of little-endian float64 with the shape (n_objs, 7),
+where the columns of each object are x, y, z, v_x, v_y, v_z and m.
+"""
+
+import typing as tp
+
+import numpy as np
+
+# Number of columns of an initial-conditions file
+ICS_COLUMNS = 7
+# Largest number of Newton iterations for Kepler's equation, which suffices for eccentricities below about 0.9
+KEPLER_ITERATIONS = 20
+# Convergence tolerance of the eccentric anomaly (rad)
+KEPLER_TOL = 1e-14
+
+Arrays = tp.Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def _rng(seed: tp.Union[int, np.random.Generator, None]) -> np.random.Generator:
+    return seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+
+
+def _directions(rng: np.random.Generator, n: int) -> np.ndarray:
+    """Isotropically distributed unit vectors with the indices (celestial, dim)"""
+    vec = rng.normal(size=(n, 3))
+    vec /= np.linalg.norm(vec, axis=1)[:, np.newaxis]
+    return vec
+
+
+def plummer(
+        n: int,
+        m_total: float = 1,
+        a: float = 1,
+        g: float = 1,
+        r_max: float = 10,
+        seed: tp.Union[int, np.random.Generator] = None) -> Arrays:
+    """
+    Plummer sphere of equal masses in virial equilibrium, sampled as in Aarseth, Henon & Wielen (1974)
+    :param m_total: total mass
+    :param a: Plummer radius
+    :param g: gravitational constant
+    :param r_max: truncation radius in the units of a, which excludes the few distant outliers
+    :param seed: seed or generator of the random numbers
+    :return: x, v, m
+    """
+    rng = _rng(seed)
+    # The radii are sampled by inverting the enclosed mass fraction r^3 / (r^2 + a^2)^(3/2)
+    frac_max = r_max**3 / (r_max**2 + 1)**1.5
+    frac = rng.uniform(0, frac_max, n)
+    r = a / np.sqrt(frac**(-2 / 3) - 1)
+    x = r[:, np.newaxis] * _directions(rng, n)
+
+    # The speeds in the units of the escape velocity have the distribution q^2 (1 - q^2)^(7/2),
+    # which is sampled by rejection below its maximum of about 0.092
+    q = np.empty(n)
+    todo = np.arange(n)
+    while todo.size:
+        q_try = rng.random(todo.size)
+        accept = 0.1 * rng.random(todo.size) < q_try**2 * (1 - q_try**2)**3.5
+        q[todo[accept]] = q_try[accept]
+        todo = todo[~accept]
+    v_escape = np.sqrt(2 * g * m_total / a) * (1 + (r / a)**2)**-0.25
+    v = (q * v_escape)[:, np.newaxis] * _directions(rng, n)
+    m = np.full(n, m_total / n)
+    return x, v, m
+
+
+def disk(
+        n: int,
+        r_min: float = 0,
+        r_max: float = 1,
+        m_total: float = 1,
+        m_central: float = 0,
+        thickness: float = 0,
+        g: float = 1,
+        seed: tp.Union[int, np.random.Generator] = None) -> Arrays:
+    """
+    Disk of equal masses with a uniform surface density in the xy plane, rotating counterclockwise.
+    Each object is given the circular velocity of the mass enclosed by its radius,
+    which is approximated as spherically distributed.
+    :param r_min: inner radius
+    :param r_max: outer radius
+    :param m_total: total mass of the disk
+    :param m_central: mass of a central object, which is added at the origin as the first object if it is positive
+    :param thickness: the heights are distributed uniformly between -thickness/2 and thickness/2
+    :param g: gravitational constant
+    :param seed: seed or generator of the random numbers
+    :return: x, v, m
+    """
+    rng = _rng(seed)
+    r = np.sqrt(rng.uniform(r_min**2, r_max**2, n))
+    phi = rng.uniform(0, 2 * np.pi, n)
+    cos_phi = np.cos(phi)
+    sin_phi = np.sin(phi)
+    x = np.column_stack([r * cos_phi, r * sin_phi, thickness * (rng.random(n) - 0.5)])
+    m_enclosed = m_central + m_total * (r**2 - r_min**2) / (r_max**2 - r_min**2)
+    v_circ = np.sqrt(g * m_enclosed / r)
+    v = np.column_stack([-v_circ * sin_phi, v_circ * cos_phi, np.zeros(n)])
+    m = np.full(n, m_total / n)
+    if m_central > 0:
+        return _add_central(x, v, m, m_central)
+    return x, v, m
+
+
+def kepler_to_cartesian(
+        a: np.ndarray,
+        e: np.ndarray,
+        inc: np.ndarray,
+        node: np.ndarray,
+        peri: np.ndarray,
+        mean_anomaly: np.ndarray,
+        mu: tp.Union[float, np.ndarray]) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """
+    Positions and velocities of elliptic orbits relative to the central object
+    :param a: semi-major axes
+    :param e: eccentricities
+    :param inc: inclinations (rad)
+    :param node: longitudes of the ascending node (rad)
+    :param peri: arguments of the periapsis (rad)
+    :param mean_anomaly: (rad)
+    :param mu: gravitational parameter G (M + m)
+    :return: x, v with the indices (celestial, dim)
+    """
+    ecc_anomaly = np.array(mean_anomaly, dtype=np.float64)
+    for _ in range(KEPLER_ITERATIONS):
+        step = (ecc_anomaly - e * np.sin(ecc_anomaly) - mean_anomaly) / (1 - e * np.cos(ecc_anomaly))
+        ecc_anomaly -= step
+        if np.max(np.abs(step)) < KEPLER_TOL:
+            break
+    cos_e = np.cos(ecc_anomaly)
+    sin_e = np.sin(ecc_anomaly)
+    sqrt_1me2 = np.sqrt(1 - e**2)
+    # Coordinates and their rates of change in the orbital plane, with the periapsis on the first axis
+    e_dot = np.sqrt(mu / a**3) / (1 - e * cos_e)
+    x_orb = a * (cos_e - e)
+    y_orb = a * sqrt_1me2 * sin_e
+    vx_orb = -a * sin_e * e_dot
+    vy_orb = a * sqrt_1me2 * cos_e * e_dot
+
+    cos_n, sin_n = np.cos(node), np.sin(node)
+    cos_p, sin_p = np.cos(peri), np.sin(peri)
+    cos_i, sin_i = np.cos(inc), np.sin(inc)
+    # Unit vectors towards the periapsis and 90 degrees ahead of it
+    p = np.column_stack([cos_n * cos_p - sin_n * sin_p * cos_i, sin_n * cos_p + cos_n * sin_p * cos_i, sin_p * sin_i])
+    q = np.column_stack([-cos_n * sin_p - sin_n * cos_p * cos_i, -sin_n * sin_p + cos_n * cos_p * cos_i, cos_p * sin_i])
+    x = x_orb[:, np.newaxis] * p + y_orb[:, np.newaxis] * q
+    v = vx_orb[:, np.newaxis] * p + vy_orb[:, np.newaxis] * q
+    return x, v
+
+
+def belt(
+        n: int,
+        a_min: float = 1,
+        a_max: float = 2,
+        e_max: float = 0.1,
+        inc_max: float = 0.1,
+        m_total: float = 1e-3,
+        m_central: float = 1,
+        g: float = 1,
+        seed: tp.Union[int, np.random.Generator] = None) -> Arrays:
+    """
+    Belt of equal masses on Keplerian orbits around a central object, which is the first object at the origin.
+    The semi-major axes, the eccentricities and the inclinations are distributed uniformly within their limits,
+    and the orientations and the phases of the orbits are random.
+    :param a_min: smallest semi-major axis
+    :param a_max: largest semi-major axis
+    :param e_max: largest eccentricity, below 1
+    :param inc_max: largest inclination relative to the xy plane (rad)
+    :param m_total: total mass of the belt, which may be zero for test particles
+    :param m_central: mass of the central object
+    :param g: gravitational constant
+    :param seed: seed or generator of the random numbers
+    :return: x, v, m
+    """
+    if not 0 <= e_max < 1:
+        raise ValueError(f"The eccentricities must be below 1, got: {e_max}")
+    rng = _rng(seed)
+    m = np.full(n, m_total / n)
+    x, v = kepler_to_cartesian(
+        a=rng.uniform(a_min, a_max, n),
+        e=rng.uniform(0, e_max, n),
+        inc=rng.uniform(0, inc_max, n),
+        node=rng.uniform(0, 2 * np.pi, n),
+        peri=rng.uniform(0, 2 * np.pi, n),
+        mean_anomaly=rng.uniform(0, 2 * np.pi, n),
+        mu=g * (m_central + m),
+    )
+    return _add_central(x, v, m, m_central)
+
+
+def _add_central(x: np.ndarray, v: np.ndarray, m: np.ndarray, m_central: float) -> Arrays:
+    return (
+        np.concatenate([np.zeros((1, 3)), x]),
+        np.concatenate([np.zeros((1, 3)), v]),
+        np.concatenate([[m_central], m]),
+    )
+
+
+def save(path: str, x: np.ndarray, v: np.ndarray, m: np.ndarray):
+    """
+    Save initial conditions to a .npy file, which can be given to the Fortran CLI with initial_conditions = path
+    :param x: positions with the indices (celestial, dim)
+    :param v: velocities with the indices (celestial, dim)
+    :param m: masses
+    """
+    m = np.asarray(m)
+    data = np.empty((m.size, ICS_COLUMNS), dtype="<f8")
+    data[:, 0:3] = x
+    data[:, 3:6] = v
+    data[:, 6] = m
+    np.save(path, data)
+
+
+def load(path: str) -> Arrays:
+    """
+    Map initial conditions saved by save() without copying
+    :return: x, v, m as views to the file
+    """
+    data = np.load(path, mmap_mode="r")
+    if data.ndim != 2 or data.shape[1] != ICS_COLUMNS or data.dtype != np.dtype("<f8"):
+        raise ValueError(
+            f"Not an initial-conditions file of float64 with {ICS_COLUMNS} columns: {path}, "
+            f"got {data.dtype} with the shape {data.shape}")
+    return data[:, 0:3], data[:, 3:6], data[:, 6]
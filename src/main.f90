@@ -9,7 +9,9 @@ program main
   character(len=MAX_PATH_LEN) :: config_path, output_path
   real(kind=REAL_KIND), allocatable :: m(:), x(:, :), v(:, :), a(:, :)
   real(kind=REAL_KIND) :: dt, g, min_dist
-  integer :: n_steps, n_objs, print_interval, write_interval, ios
+  integer :: n_steps, n_objs, print_interval, write_interval, n_threads, output_format, print_format, ios, &
+    checkpoint_interval, resume, start_iter
+  logical :: checkpoint_exists
 
   ! Argument processing
   call get_paths(config_path, output_path)
@@ -17,7 +19,8 @@ program main
   ! Config processing
   print *, "Using configuration file: ", trim(config_path)
   print *, "Output will be written to: ", trim(output_path)
-  call read_config(config_path, x, v, m, dt, n_steps, n_objs, g, min_dist, print_interval, write_interval)
+  call read_config(config_path, x, v, m, dt, n_steps, n_objs, g, min_dist, print_interval, write_interval, n_threads, &
+    output_format, print_format, checkpoint_interval, resume)
   print *, "n_objs: ", n_objs
   print *, "n_steps: ", n_steps
   print *, "dt: ", dt
@@ -25,24 +28,53 @@ program main
   print *, "min_dist: ", min_dist
   print *, "print_interval: ", print_interval
   print *, "write_interval: ", write_interval
-  call print_arr_2d(x, "x")
-  call print_arr_2d(v, "v")
-  call print_arr_1d(m, "m")
+  print *, "n_threads: ", n_threads
+  print *, "output_format: ", output_format
+  print *, "print_format: ", print_format
+  print *, "checkpoint_interval: ", checkpoint_interval
+  print *, "resume: ", resume
+  ! The initial conditions of large systems would flood the terminal
+  if (n_objs <= MAX_PRINT_OBJS) then
+    call print_arr_2d(x, "x")
+    call print_arr_2d(v, "v")
+    call print_arr_1d(m, "m")
+  end if
 
   allocate(a(DIMS, n_objs))
 
+  ! A resumed run continues from the checkpoint of the output folder, if there is one
+  start_iter = 0
+  if (resume == 1) then
+    inquire(file=trim(output_path) // "/checkpoint.bin", exist=checkpoint_exists)
+    if (checkpoint_exists) then
+      call read_checkpoint(output_path, x, v, a, m, start_iter, dt, n_objs)
+      print *, "Resuming from the checkpoint at iteration ", start_iter
+    else
+      print *, "No checkpoint found, starting from the beginning"
+    end if
+  end if
+  ! The velocity-Verlet steps expect the accelerations at the initial positions, as in the Python version
+  if (start_iter == 0) then
+    call compute_accel(x, m, a, n_objs, g, min_dist, 0.0_REAL_KIND)
+  end if
+
   ! Output directory processing
   call system("mkdir -p " // trim(output_path), status=ios)
   if (ios /= 0) then
     print *, "Failed to create output directory"
     stop
   end if
-  call system("rm -f " // trim(output_path) // "/*.txt", status=ios)
-  if (ios /= 0) then
-    print *, "Failed to clean output directory"
-    stop
+  ! The binary output file is replaced when opened, and the output of a resumed run is continued
+  if (output_format == 0 .and. start_iter == 0) then
+    call system("rm -f " // trim(output_path) // "/*.txt", status=ios)
+    if (ios /= 0) then
+      print *, "Failed to clean output directory"
+      stop
+    end if
   end if
 
   print *, "Simulating"
-  call iterate(x, v, a, m, dt, n_steps, n_objs, g, min_dist, print_interval, write_interval, output_path)
+  call iterate(x, v, a, m, dt, n_steps, n_objs, g, min_dist, print_interval, write_interval, output_path, &
+    n_threads=n_threads, output_format=output_format, print_format=print_format, &
+    checkpoint_interval=checkpoint_interval, start_iter=start_iter)
 end program main
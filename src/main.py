@@ -6,44 +6,59 @@ It should be noted that specifying the configuration for a Fortran-based simulat
 is a rather common practice. For other examples please see the CSC cluster configurations in
 https://gitlab.com/AgenttiX/fys-4096
 """
+# Matplotlib and the GUI libraries are slow to import, so the functions that use them import them.
+# pylint: disable=import-outside-toplevel
+# The project modules import the Fortran core, so they are imported after it has been built.
+# pylint: disable=wrong-import-position
 
+from __future__ import annotations
+
+import argparse
 import logging
 import os.path
 import subprocess
 import time
 import typing as tp
 
-import matplotlib.cm
-import matplotlib.pyplot as plt
 import numpy as np
-import pyqtgraph as pg
-
-log_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logs")
-os.makedirs(log_path, exist_ok=True)
-logging.basicConfig(
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(os.path.join(log_path, "log_{}.txt".format(time.strftime("%Y-%m-%d_%H-%M-%S"))))
-    ],
-    level=logging.DEBUG,
-    format="%(asctime)s %(levelname)-8s %(message)s"
-)
-logging.getLogger("OpenGL").setLevel(logging.INFO)
-logging.getLogger("matplotlib").setLevel(logging.INFO)
-logger = logging.getLogger(__name__)
-
-# Compilation is done automatically here to speed up development
-print("Compiling Fortran code")
-subprocess.run(["make", "all"], check=True)
-print("Fortran code compiled")
-print("\n\n")
 
-# Your IDE may complain that the module does not exist, since the generated Python module is found dynamically
-import core
+import build
 
+logger = logging.getLogger(__name__)
 
+# Compilation is done automatically here to speed up development.
+# The Fortran code is compiled only when it or the compiler flags have changed.
+try:
+    build.ensure_core()
+except (OSError, subprocess.CalledProcessError) as e:
+    # The simulations fall back to the NumPy backend
+    logger.warning("Could not compile the Fortran core: %s", e)
+
+import analysis
+import observers
+import plotting
 import sim
-from gui import MainWindow
+import sweep
+
+# Matplotlib and the GUI libraries are slow to import, so they are imported only when needed.
+if tp.TYPE_CHECKING:
+    import matplotlib.pyplot as plt
+
+
+def setup_logging():
+    log_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logs")
+    os.makedirs(log_path, exist_ok=True)
+    logging.basicConfig(
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler(
+                os.path.join(log_path, "log_{}.txt".format(time.strftime("%Y-%m-%d_%H-%M-%S"))))
+        ],
+        level=logging.DEBUG,
+        format="%(asctime)s %(levelname)-8s %(message)s"
+    )
+    logging.getLogger("OpenGL").setLevel(logging.INFO)
+    logging.getLogger("matplotlib").setLevel(logging.INFO)
 
 
 # Solar system
@@ -154,38 +169,37 @@ solar_system = [sun, mercury, venus, earth, mars, jupiter, saturn, uranus, neptu
 
 # Utility methods
 
-def period_from_crossings(signal: np.ndarray, dt: float) -> float:
-    """
-    Based on
-    https://gist.github.com/endolith/255291
-    """
-    # Find all indices right before a rising-edge zero crossing
-    indices = np.nonzero((signal[1:] >= 0) & (signal[:-1] < 0))[0]
-    crossings = [i - signal[i] / (signal[i + 1] - signal[i]) for i in indices]
-    logger.debug("Crossing indices: %s", indices)
-    logger.debug("Crossings: %s", crossings)
-    return dt*np.mean(np.diff(crossings))
-
-
-def period_from_pos(pos: np.ndarray, dt: float, save_interval: int) -> float:
-    sin = sin_from_pos(pos)
-    return period_from_crossings(sin, dt * save_interval) / sim.YEAR_IN_S
-
-
 def plot_object(pos: np.ndarray, ax: plt.Axes = None):
+    import matplotlib.pyplot as plt
+
     if ax is None:
         fig: plt.Figure = plt.figure()
         ax: plt.Axes = fig.add_subplot()
-    ax.plot(pos[:, 0], pos[:, 1])
+    plotting.plot(ax, pos[:, 0], pos[:, 1])
     return ax
 
 
-def plot_system(objects: tp.List[sim.Celestial], pos: np.ndarray, ax: plt.Axes = None, log: bool = False) -> plt.Axes:
+def plot_system(
+        objects: tp.List[sim.Celestial],
+        pos: np.ndarray,
+        ax: plt.Axes = None,
+        log: bool = False,
+        rasterized: bool = False) -> plt.Axes:
+    """
+    Plot the orbits in the xy plane.
+    The orbits are decimated to the resolution of the axes,
+    so the cost does not grow with the length of the run.
+    :param rasterized: draw the orbits as a bitmap when the figure is saved in a vector format
+    """
+    import matplotlib.pyplot as plt
+
     if ax is None:
         fig: plt.Figure = plt.figure()
         ax: plt.Axes = fig.add_subplot()
     for i, obj in enumerate(objects):
-        ax.plot(pos[:, 0, i] / sim.AU, pos[:, 1, i] / sim.AU, color=obj.color_matplotlib, label=obj.name)
+        plotting.plot(
+            ax, pos[:, 0, i] / sim.AU, pos[:, 1, i] / sim.AU,
+            rasterized=rasterized, color=obj.color_matplotlib, label=obj.name)
     if log:
         ax.set_xscale("log")
         ax.set_yscale("log")
@@ -196,6 +210,9 @@ def plot_system(objects: tp.List[sim.Celestial], pos: np.ndarray, ax: plt.Axes =
 
 
 def show_simulation(sim: sim.Simulation, unit_mult: float = 1):
+    import pyqtgraph as pg
+    from gui import MainWindow
+
     sim.print()
     app = pg.mkQApp()
     win = MainWindow(sim, unit_mult=unit_mult)
@@ -203,19 +220,26 @@ def show_simulation(sim: sim.Simulation, unit_mult: float = 1):
     app.exec()
 
 
-def sin_from_pos(pos: np.ndarray) -> np.ndarray:
-    arr = pos[:, 1] / np.linalg.norm(pos, axis=1)
-
-    # Replace possible nan values from the ends with the nearest values
-    # https://stackoverflow.com/a/9537766/
-    ind = np.where(~np.isnan(arr))[0]
-    first, last = ind[0], ind[-1]
-    arr[:first] = arr[first]
-    arr[last + 1:] = arr[last]
+def show_live(
+        sim: sim.Simulation,
+        steps: int,
+        save_interval: int,
+        unit_mult: float = 1,
+        chunk_size: int = 10,
+        **run_kwargs):
+    """
+    Run the simulation in a background thread and show its snapshots in the GUI as they are computed
+    """
+    import pyqtgraph as pg
+    from gui import MainWindow, SimulationThread
 
-    if np.any(np.isnan(arr)):
-        raise ValueError("The computed sines should not contain nan values.")
-    return arr
+    app = pg.mkQApp()
+    thread = SimulationThread(sim, steps, save_interval, chunk_size=chunk_size, **run_kwargs)
+    win = MainWindow(sim, unit_mult=unit_mult, live=thread)
+    win.show()
+    thread.start()
+    app.exec()
+    logger.debug("Live run: %s", sim.stats)
 
 
 # Problem solutions
@@ -227,38 +251,25 @@ def simulate_binary_pair(
         dts: np.ndarray,
         period_true: float,
         save_interval: int = 100,
-        steps: int = 10000
+        steps: int = 10000,
+        jobs: int = 1
 ):
-    periods = np.zeros_like(dts)
-    periods_center = np.zeros_like(dts)
-    radii_center_au = []
-
-    for i in range(dts.size):
-        dt = dts[i]
-        simulation = sim.Simulation([center, satellite], dt=dt, g=sim.G, fix_scale=True)
-        # show_simulation(sim, unit_mult=AU)
-        simulation.run(steps=steps, save_interval=save_interval)
-        satellite_pos = np.array(simulation.x_hist)[:, :, 1]
-        satellite_angle = sin_from_pos(satellite_pos)
-        center_pos = np.array(simulation.x_hist)[:, :, 0]
-        center_angle = sin_from_pos(center_pos)
-        # t_arr = dt*save_interval*np.arange(len(sim.x_hist)) / sim.YEAR_IN_S
-        period = period_from_crossings(satellite_angle, dt * save_interval) / sim.YEAR_IN_S
-        period_center = period_from_crossings(center_angle, dt * save_interval) / sim.YEAR_IN_S
-        periods[i] = period
-        periods_center[i] = period_center
-        radii_center_au.append(np.linalg.norm(center_pos, axis=1) / sim.AU)
-        logger.debug("dt = %s years", dt / sim.YEAR_IN_S)
-        logger.debug("True period: %s years", period_true)
-        logger.debug("Simulated period: %s years", period)
-
-        # fig: plt.Figure = plt.figure()
-        # ax: plt.Axes = fig.add_subplot()
-        # ax.plot(t_arr, satellite_angle)
-        # ax.set_xlabel("t (years)")
-        # ax.set_ylabel(r"$\sin(\theta)$")
-
-        # plot_system(pos, ax)
+    import matplotlib.pyplot as plt
+
+    # Indices: (timestep, snapshot, dim, celestial)
+    x_hist = sweep.run_sweep(
+        [center, satellite], dts=dts, steps=steps, save_interval=save_interval, jobs=jobs)
+
+    # Indices: (timestep, celestial)
+    all_periods = analysis.periods(x_hist, dts, save_interval) / sim.YEAR_IN_S
+    periods = all_periods[:, 1]
+    periods_center = all_periods[:, 0]
+    radius_mean, radius_std = analysis.radii(x_hist)
+    eccentricities = analysis.eccentricities(x_hist, center=0)[:, 1]
+    logger.debug("dt: %s years", dts / sim.YEAR_IN_S)
+    logger.debug("True period: %s years", period_true)
+    logger.debug("Simulated periods: %s years", periods)
+    logger.debug("Eccentricities (%s): %s", satellite.name, eccentricities)
 
     fig1: plt.Figure = plt.figure()
     fig1_log: plt.Figure = plt.figure()
@@ -290,8 +301,8 @@ def simulate_binary_pair(
     ax3: plt.Axes = fig3.add_subplot()
     ax3.errorbar(
         dts / sim.YEAR_IN_S,
-        np.mean(radii_center_au, axis=1) * sim.AU,
-        yerr=np.std(radii_center_au, axis=1) * sim.AU,
+        radius_mean[:, 0],
+        yerr=radius_std[:, 0],
         fmt=".",
         capsize=3
     )
@@ -302,10 +313,11 @@ def simulate_binary_pair(
     logger.debug("Periods (%s): %s", center.name, periods_center)
 
 
-def part_1ac():
+def part_1ac(jobs: int = 1):
     dts = np.linspace(0.01, 0.1, 100)*sim.YEAR_IN_S
     period_true = 2 * np.pi * jupiter.x[0] / jupiter.v[1] / sim.YEAR_IN_S
-    simulate_binary_pair(name="1a", center=sun, satellite=jupiter, dts=dts, period_true=period_true)
+    simulate_binary_pair(
+        name="1a", center=sun, satellite=jupiter, dts=dts, period_true=period_true, jobs=jobs)
 
 
 def part_1b():
@@ -327,9 +339,9 @@ def part_1b():
 
         simulation = sim.Simulation([sun, jupiter], dt=dt, g=sim.G, fix_scale=True)
         simulation.run(steps=steps, save_interval=save_interval)
-        jupiter_pos = np.array(simulation.x_hist)[:, :, 1]
+        jupiter_pos = simulation.x_hist[:, :, 1]
         jupiter_angle = jupiter_pos[:, 1] / jupiter.x[0]
-        sun_pos = np.array(simulation.x_hist)[:, :, 0]
+        sun_pos = simulation.x_hist[:, :, 0]
         sun_angle = sun_pos[:, 1] / np.linalg.norm(sun_pos[:, :], axis=1)
         # print(jupiter_angle)
         t_arr = dt * save_interval * np.arange(len(simulation.x_hist)) / sim.YEAR_IN_S
@@ -341,6 +353,9 @@ def part_1b():
 
 
 def part1b_plot(steps_arr, t_arrs, angles):
+    import matplotlib.cm
+    import matplotlib.pyplot as plt
+
     n = len(steps_arr)
 
     fig: plt.Figure = plt.figure()
@@ -368,36 +383,43 @@ def part1b_plot(steps_arr, t_arrs, angles):
     fig2.savefig("../report/fig_1b_2.eps")
 
 
-def part_2a():
+def part_2a(jobs: int = 1):
     dts = np.linspace(1e-4, 0.05, 100)*sim.YEAR_IN_S
-    simulate_binary_pair(name="2a", center=sun, satellite=earth, dts=dts, period_true=1)
+    simulate_binary_pair(name="2a", center=sun, satellite=earth, dts=dts, period_true=1, jobs=jobs)
 
 
-def part_2b():
+def part_2b(jobs: int = 1):
     dts = np.linspace(1e-4, 0.05, 100) * sim.SIDEREAL_MONTH_IN_S
-    simulate_binary_pair(name="2b", center=earth, satellite=moon, dts=dts, period_true=sim.SIDEREAL_MONTH_IN_S/sim.YEAR_IN_S)
+    simulate_binary_pair(
+        name="2b", center=earth, satellite=moon, dts=dts,
+        period_true=sim.SIDEREAL_MONTH_IN_S/sim.YEAR_IN_S, jobs=jobs)
 
 
-def part_3(use_rk4: bool = False, plot: bool = True, interactive: bool = False):
+def part_3(use_rk4: bool = False, plot: bool = True, interactive: bool = False, jobs: int = 1):
     dts = np.logspace(-4, -1, 50) * sim.YEAR_IN_S
-    periods = np.zeros((len(solar_system), len(dts)))
     save_interval = 10
-    for i, dt in enumerate(dts):
-        simulation = sim.Simulation(solar_system, dt=dt, g=sim.G, fix_scale=True)
-        # For faster simulations use 10**5.
-        simulation.run(steps=10**6, save_interval=save_interval, use_rk4=use_rk4)
-        x_hist = np.array(simulation.x_hist)
-
-        if i == 3:
-            ax = plot_system(solar_system, x_hist)
-            ax.set_title(f"dt = {dt}")
+    # For faster simulations use 10**5.
+    steps = 10**6
+
+    # The full histories of the sweep would not fit in memory,
+    # so the periods are computed on the fly.
+    period_observers = sweep.observe_sweep(
+        solar_system, dts=dts, steps=steps, save_interval=save_interval,
+        observer_factory=observers.PeriodObserver, integrator="rk4" if use_rk4 else "verlet",
+        jobs=jobs
+    )
+    periods = np.array([observer.periods for observer in period_observers]).T / sim.YEAR_IN_S
 
-            # 3D analysis
-            if interactive:
-                show_simulation(simulation, unit_mult=sim.AU)
+    # The example run is simulated again to get its history
+    dt = dts[3]
+    simulation = sim.Simulation(solar_system, dt=dt, g=sim.G, fix_scale=True)
+    simulation.run(steps=steps, save_interval=save_interval, use_rk4=use_rk4)
+    ax = plot_system(solar_system, simulation.x_hist)
+    ax.set_title(f"dt = {dt}")
 
-        for j in range(len(solar_system)):
-            periods[j, i] = period_from_pos(x_hist[:, :, j], dt=dt, save_interval=save_interval)
+    # 3D analysis
+    if interactive:
+        show_simulation(simulation, unit_mult=sim.AU)
 
     if plot:
         part3_plot(dts, periods, use_rk4)
@@ -405,6 +427,8 @@ def part_3(use_rk4: bool = False, plot: bool = True, interactive: bool = False):
 
 
 def part3_plot(dts: np.ndarray, periods: np.ndarray, use_rk4: bool, cut: float = None):
+    import matplotlib.pyplot as plt
+
     if cut:
         inds = dts < cut
         dts = dts[inds]
@@ -419,7 +443,9 @@ def part3_plot(dts: np.ndarray, periods: np.ndarray, use_rk4: bool, cut: float =
         print("dts", dts)
         print("periods:", periods[j, :])
         ax.plot(dts / sim.YEAR_IN_S, periods[j, :], label=obj.name, color=obj.color_matplotlib)
-        ax2.plot(dts / sim.YEAR_IN_S, periods[j, :] / obj.period, label=obj.name, color=obj.color_matplotlib)
+        ax2.plot(
+            dts / sim.YEAR_IN_S, periods[j, :] / obj.period,
+            label=obj.name, color=obj.color_matplotlib)
 
     ax.set_xlabel("dt (yr)")
     ax2.set_xlabel("dt (yr)")
@@ -495,22 +521,28 @@ def nbody_test2():
     ) for _ in range(10)]
 
     simulation = sim.Simulation(celestials, dt=1e-3, g=1e-3, fix_scale=False, com_frame=True)
-    simulation.run(steps=10**6, save_interval=100)
-
-    # 3D analysis
-    show_simulation(simulation)
+    # The snapshots are shown as they are computed
+    show_live(simulation, steps=10**6, save_interval=100)
 
 
 if __name__ == "__main__":
-    part_1ac()
+    setup_logging()
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="number of processes for the timestep sweeps")
+    args = parser.parse_args()
+
+    part_1ac(jobs=args.jobs)
     part_1b()
-    part_2a()
-    part_2b()
-    part_3()
-    part_3(use_rk4=True)
+    part_2a(jobs=args.jobs)
+    part_2b(jobs=args.jobs)
+    part_3(jobs=args.jobs)
+    part_3(use_rk4=True, jobs=args.jobs)
 
     # 3D visualizations
     # nbody_test2()
     # part_3(interactive=True, plot=False)
 
+    import matplotlib.pyplot as plt
     plt.show()
@@ -0,0 +1,156 @@
+"""
+Streaming observers, which analyze the snapshots of a simulation as they are computed
+
+An observer is given to Simulation.run, which calls it with each chunk of snapshots.
+The observers keep only running statistics, so long runs can be analyzed without storing their histories.
+"""
+
+import abc
+import queue
+import threading
+import typing as tp
+
+import numpy as np
+
+
+class Observer(abc.ABC):
+    @abc.abstractmethod
+    def update(self, x: np.ndarray, v: tp.Optional[np.ndarray], t: np.ndarray):
+        """
+        Process a chunk of snapshots
+        :param x: positions with the indices (snapshot, dim, celestial) in the units of Simulation.x_hist
+        :param v: velocities in the same layout, if the simulation saves them
+        :param t: times of the snapshots (s)
+        """
+        raise NotImplementedError
+
+
+class PeriodObserver(Observer):
+    def __init__(self):
+        """
+        Orbital periods from the rising-edge zero crossings of the sine of the angle of each object in the xy plane,
+        which are interpolated linearly between the snapshots as in analysis.crossing_times.
+        The mean and the standard deviation of the intervals between the crossings are updated for each chunk.
+        """
+        self.n_objs = None
+        self._t_last = -np.inf
+        self._sin_last: tp.Optional[np.ndarray] = None
+        self.n_crossings: tp.Optional[np.ndarray] = None
+        self.last_crossing: tp.Optional[np.ndarray] = None
+        # Running statistics of the intervals
+        self._n_intervals: tp.Optional[np.ndarray] = None
+        self._mean: tp.Optional[np.ndarray] = None
+        self._m2: tp.Optional[np.ndarray] = None
+
+    def _init(self, n_objs: int):
+        self.n_objs = n_objs
+        self._sin_last = np.full(n_objs, np.nan)
+        self.n_crossings = np.zeros(n_objs, dtype=int)
+        self.last_crossing = np.full(n_objs, np.nan)
+        self._n_intervals = np.zeros(n_objs, dtype=int)
+        self._mean = np.zeros(n_objs)
+        self._m2 = np.zeros(n_objs)
+
+    def update(self, x: np.ndarray, v: tp.Optional[np.ndarray], t: np.ndarray):
+        if self.n_objs is None:
+            self._init(x.shape[-1])
+        # Snapshots that have already been seen, e.g. the starting point of a continued run, are skipped
+        new = t > self._t_last
+        x = x[new]
+        t = t[new]
+        if t.size == 0:
+            return
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sin = x[:, 1, :] / np.linalg.norm(x, axis=1)
+        sin = np.concatenate([self._sin_last[np.newaxis], sin])
+        t = np.concatenate([[self._t_last], t])
+
+        # Comparisons with nan are false, so an object at the origin does not produce crossings
+        snaps, objs = np.nonzero((sin[1:] >= 0) & (sin[:-1] < 0))
+        if snaps.size:
+            frac = -sin[snaps, objs] / (sin[snaps + 1, objs] - sin[snaps, objs])
+            times = t[snaps] + frac * (t[snaps + 1] - t[snaps])
+            # Order the crossings by object while keeping them in time order
+            order = np.argsort(objs, kind="stable")
+            objs = objs[order]
+            times = times[order]
+
+            first = np.ones(objs.size, dtype=bool)
+            first[1:] = objs[1:] != objs[:-1]
+            prev = np.empty_like(times)
+            prev[first] = self.last_crossing[objs[first]]
+            prev[~first] = times[:-1][~first[1:]]
+            intervals = times - prev
+            valid = ~np.isnan(intervals)
+            self._add_intervals(objs[valid], intervals[valid])
+
+            self.n_crossings += np.bincount(objs, minlength=self.n_objs)
+            last = np.ones(objs.size, dtype=bool)
+            last[:-1] = objs[:-1] != objs[1:]
+            self.last_crossing[objs[last]] = times[last]
+
+        self._sin_last = sin[-1]
+        self._t_last = t[-1]
+
+    def _add_intervals(self, objs: np.ndarray, intervals: np.ndarray):
+        """Combine the statistics of a chunk with the running statistics (Chan et al.)"""
+        n_chunk = np.bincount(objs, minlength=self.n_objs)
+        has = n_chunk > 0
+        mean_chunk = np.zeros(self.n_objs)
+        mean_chunk[has] = np.bincount(objs, weights=intervals, minlength=self.n_objs)[has] / n_chunk[has]
+        m2_chunk = np.bincount(objs, weights=(intervals - mean_chunk[objs])**2, minlength=self.n_objs)
+
+        n_total = self._n_intervals + n_chunk
+        delta = mean_chunk - self._mean
+        self._mean[has] += delta[has] * n_chunk[has] / n_total[has]
+        self._m2[has] += m2_chunk[has] + delta[has]**2 * self._n_intervals[has] * n_chunk[has] / n_total[has]
+        self._n_intervals = n_total
+
+    @property
+    def periods(self) -> np.ndarray:
+        """Mean period of each object (s), nan if less than two crossings have been observed"""
+        return np.where(self._n_intervals > 0, self._mean, np.nan)
+
+    @property
+    def period_std(self) -> np.ndarray:
+        """Standard deviation of the intervals between the crossings (s)"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self._n_intervals > 1, np.sqrt(self._m2 / (self._n_intervals - 1)), np.nan)
+
+
+class RunStopped(Exception):
+    """Raised by QueueObserver to stop the run when its consumer has requested it"""
+
+
+class QueueObserver(Observer):
+    def __init__(self, maxsize: int = 16):
+        """
+        Pass the snapshots to another thread, e.g. the live GUI, through a bounded queue of chunks.
+        The items of the queue are tuples of the positions and the times of a chunk as given to update.
+        When the queue is full, the chunk is dropped instead of waiting for the consumer,
+        so a slow consumer loses snapshots but never stalls the integrator.
+        :param maxsize: maximum number of chunks in the queue
+        """
+        self.queue: "queue.Queue[tp.Tuple[np.ndarray, np.ndarray]]" = queue.Queue(maxsize)
+        self.n_dropped = 0
+        self._t_last = -np.inf
+        self._stop = threading.Event()
+
+    def update(self, x: np.ndarray, v: tp.Optional[np.ndarray], t: np.ndarray):
+        if self._stop.is_set():
+            raise RunStopped()
+        # The starting point of a continued run has already been sent
+        new = t > self._t_last
+        if not np.any(new):
+            return
+        self._t_last = t[-1]
+        try:
+            # The chunks are views to buffers that the simulation reuses,
+            # and indexing with the mask copies them, so the consumer gets arrays of its own.
+            self.queue.put_nowait((x[new], t[new]))
+        except queue.Full:
+            self.n_dropped += int(np.count_nonzero(new))
+
+    def stop(self):
+        """Stop the run at its next chunk by raising RunStopped in the simulation thread"""
+        self._stop.set()
@@ -0,0 +1,154 @@
+"""
+Decimated plotting of long series with Matplotlib
+
+A line with more points than the axes have pixels looks the same as a suitably decimated line,
+but it makes drawing and saving slow and vector figures large.
+The decimation methods select a subset of the original points, which preserves the extrema and the shape:
+"minmax" keeps the minimum and the maximum of each bucket and is suited for time series,
+and "lttb" (largest triangle three buckets, Steinarsson 2013) keeps the visually most significant point of each bucket
+and is suited also for curves such as orbits, where neither coordinate is monotonic.
+The decimated series are cached by their contents, so figures of the same data are regenerated quickly.
+"""
+
+import collections
+import hashlib
+import os
+import typing as tp
+
+import numpy as np
+
+if tp.TYPE_CHECKING:
+    import matplotlib.pyplot as plt
+
+METHODS = ("lttb", "minmax")
+# Points per pixel of the axes width
+POINTS_PER_PIXEL = 4
+# Number of decimated series kept in memory
+CACHE_SIZE = 64
+# Increment this when the decimation changes, so that the disk caches are not used
+CACHE_VERSION = 1
+
+_cache: "collections.OrderedDict[str, tp.Tuple[np.ndarray, np.ndarray]]" = collections.OrderedDict()
+
+
+def minmax_indices(y: np.ndarray, n_buckets: int) -> np.ndarray:
+    """
+    Indices of the minimum and the maximum of y in each of n_buckets buckets of consecutive points,
+    and of the first and the last point, in their original order
+    """
+    n = y.size
+    if 2 * n_buckets + 2 >= n:
+        return np.arange(n)
+    bucket = np.arange(n) * n_buckets // n
+    # Within each bucket the points are sorted by y, so the minimum is the first and the maximum the last
+    order = np.lexsort((y, bucket))
+    starts = np.searchsorted(bucket[order], np.arange(n_buckets))
+    ends = np.append(starts[1:], n) - 1
+    return np.unique(np.concatenate([[0, n - 1], order[starts], order[ends]]))
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Indices of n_out points selected with the largest-triangle-three-buckets algorithm.
+    The first and the last point are kept, and the rest are divided into n_out - 2 buckets of consecutive points.
+    From each bucket the point that forms the largest triangle with the previously selected point
+    and the mean of the next bucket is selected.
+    """
+    n = x.size
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    sizes = np.diff(edges)
+    # The anchor of the last bucket is the last point
+    mean_x = np.append(np.add.reduceat(x[:-1], edges[:-1])[1:] / sizes[1:], x[-1])
+    mean_y = np.append(np.add.reduceat(y[:-1], edges[:-1])[1:] / sizes[1:], y[-1])
+
+    inds = np.empty(n_out, dtype=int)
+    inds[0] = 0
+    inds[-1] = n - 1
+    prev = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Twice the area of the triangle
+        area = np.abs(
+            (x[prev] - mean_x[i]) * (y[start:end] - y[prev]) - (x[prev] - x[start:end]) * (mean_y[i] - y[prev]))
+        prev = start + int(np.argmax(area))
+        inds[i + 1] = prev
+    return inds
+
+
+def _key(x: np.ndarray, y: np.ndarray, n_out: int, method: str) -> str:
+    digest = hashlib.sha256()
+    for arr in (x, y):
+        digest.update(str(arr.shape).encode())
+        digest.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    digest.update(f"{n_out} {method} {CACHE_VERSION}".encode())
+    return digest.hexdigest()
+
+
+def decimate(
+        x: np.ndarray,
+        y: np.ndarray,
+        n_out: int,
+        method: str = "lttb",
+        cache_dir: str = None) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """
+    Decimate a series to about n_out points, or return it as such if it is shorter
+    :param method: one of METHODS
+    :param cache_dir: also cache the decimated series to files in this directory, so that they persist between runs
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown decimation method: {method}. Available: {METHODS}")
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if x.size <= n_out:
+        return x, y
+    key = _key(x, y, n_out, method)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    path = None if cache_dir is None else os.path.join(cache_dir, f"{key}.npy")
+    if path is not None and os.path.isfile(path):
+        result = tuple(np.load(path))
+    else:
+        if method == "minmax":
+            inds = minmax_indices(y, n_out // 2)
+        else:
+            inds = lttb_indices(x, y, n_out)
+        result = x[inds], y[inds]
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(path, np.array(result))
+    _cache[key] = result
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return result
+
+
+def pixels(ax: "plt.Axes") -> int:
+    """Width of the axes in pixels at the resolution of the figure"""
+    return max(1, round(ax.get_window_extent().width))
+
+
+def plot(
+        ax: "plt.Axes",
+        x: np.ndarray,
+        y: np.ndarray,
+        *args,
+        n_out: int = None,
+        method: str = "lttb",
+        rasterized: bool = False,
+        cache_dir: str = None,
+        **kwargs):
+    """
+    Plot a decimated series with ax.plot
+    :param n_out: number of points, defaults to POINTS_PER_PIXEL times the width of the axes in pixels
+    :param rasterized: draw the line as a bitmap in vector figures, which keeps the file size constant.
+        The axes and the text remain vector graphics, and the resolution is set by the dpi of savefig.
+    :param cache_dir: see decimate
+    :return: the lines of ax.plot
+    """
+    if n_out is None:
+        n_out = POINTS_PER_PIXEL * pixels(ax)
+    x, y = decimate(x, y, n_out, method=method, cache_dir=cache_dir)
+    return ax.plot(x, y, *args, rasterized=rasterized, **kwargs)
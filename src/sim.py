@@ -1,9 +1,13 @@
 import logging
+import os
+import time
 import typing as tp
 
 import numpy as np
 
-import core
+import backends
+import observers as obs
+import store
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +28,109 @@ ORBIT_R_EARTH = 149598023e3
 V_EARTH = 29.78e3
 
 
+# Force engines
+FORCES = ("direct", "tree", "mixed")
+# Integrators
+INTEGRATORS = ("verlet", "forest_ruth", "yoshida6", "rk4", "rk45", "wh", "block")
+# Order of the symplectic integrators, which the core composes of velocity-Verlet steps
+SYMPLECTIC_ORDERS = {
+    "verlet": 2,
+    "forest_ruth": 4,
+    "yoshida6": 6,
+}
+# Cost of the fixed-step integrators in evaluations of all the forces
+FORCE_EVALS_PER_STEP = {
+    "verlet": 1,
+    "forest_ruth": 3,
+    "yoshida6": 7,
+    "rk4": 4,
+    "wh": 1,
+}
+# Amount of history written to a trajectory store at a time
+STORE_CHUNK_BYTES = 2**26
+# Number of snapshots given to the observers at a time when the history is not stored
+STREAM_CHUNK_SNAPS = 1000
+# Format version of the checkpoints written by Simulation.checkpoint
+CHECKPOINT_VERSION = 1
+# Conservation diagnostics of a snapshot, see core.compute_diagnostics
+DIAGNOSTICS_DTYPE = np.dtype([
+    ("kinetic", np.float64),
+    ("potential", np.float64),
+    ("momentum", np.float64, 3),
+    ("angular_momentum", np.float64, 3),
+    ("center_of_mass", np.float64, 3),
+])
+
+
+def extend_hist(hist: np.ndarray, n_snaps: int) -> np.ndarray:
+    """Return a history array with room for n_snaps more snapshots after the existing ones"""
+    if hist.shape[0] == 0:
+        return np.empty((n_snaps, *hist.shape[1:]), dtype=hist.dtype)
+    new_hist = np.empty((hist.shape[0] + n_snaps, *hist.shape[1:]), dtype=hist.dtype)
+    new_hist[:hist.shape[0]] = hist
+    return new_hist
+
+
+class RunStats:
+    def __init__(self, integrator: str, n_objs: int):
+        """
+        Performance statistics of a call to Simulation.run, which are updated after each batch of snapshots.
+        A run in memory is a single batch, and the runs to a store or to observers have a batch for each chunk.
+        The kernel time is spent in the compute backend, and the rest of the wall time in Python,
+        e.g. in copying the histories and in the observers.
+        """
+        self.integrator = integrator
+        self.n_objs = n_objs
+        self.n_steps = 0
+        self.n_snaps = 0
+        self.n_force_evals = 0
+        self.kernel_time = 0.
+        self.wall_time = 0.
+        # Wall time of each batch (s)
+        self.batch_times: tp.List[float] = []
+        # Largest size of the history arrays held in memory (bytes)
+        self.peak_hist_bytes = 0
+        self._start = time.perf_counter()
+        self._last = self._start
+
+    def add_batch(self, n_snaps: int, n_steps: int, n_force_evals: int, kernel_time: float):
+        now = time.perf_counter()
+        self.batch_times.append(now - self._last)
+        self._last = now
+        self.n_snaps += n_snaps
+        self.n_steps += n_steps
+        self.n_force_evals += n_force_evals
+        self.kernel_time += kernel_time
+        self.wall_time = now - self._start
+
+    def add_memory(self, *arrays: tp.Optional[np.ndarray]):
+        """Update the peak memory with the sizes of history arrays that are held in memory at the same time"""
+        self.peak_hist_bytes = max(self.peak_hist_bytes, sum(arr.nbytes for arr in arrays if arr is not None))
+
+    def finish(self):
+        self.wall_time = time.perf_counter() - self._start
+
+    @property
+    def python_time(self) -> float:
+        return self.wall_time - self.kernel_time
+
+    @property
+    def steps_per_s(self) -> float:
+        return self.n_steps / self.wall_time if self.wall_time > 0 else 0
+
+    @property
+    def force_evals_per_s(self) -> float:
+        return self.n_force_evals / self.wall_time if self.wall_time > 0 else 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.integrator}, N={self.n_objs}: {self.n_steps} steps, {self.n_snaps} snapshots "
+            f"in {self.wall_time:.3g} s ({self.kernel_time:.3g} s in the kernel, {self.python_time:.3g} s in Python), "
+            f"{self.steps_per_s:.3g} steps/s, {self.force_evals_per_s:.3g} force evaluations/s, "
+            f"peak history memory {self.peak_hist_bytes / 2**20:.3g} MiB"
+        )
+
+
 class Celestial:
     def __init__(
             self,
@@ -79,23 +186,77 @@ class Celestial:
 class Simulation:
     def __init__(
             self,
-            celestials: tp.List[Celestial],
+            celestials: tp.Optional[tp.List[Celestial]],
             dt: float,
             g: float = 1,
             fix_scale: bool = False,
             # Center-of-momentum frame
-            com_frame: bool = True):
+            com_frame: bool = True,
+            force: str = "direct",
+            theta: float = 0.5,
+            n_threads: int = None,
+            save_velocities: bool = False,
+            save_diagnostics: bool = False,
+            central: int = None,
+            backend: str = "auto",
+            min_dist: float = None,
+            x: np.ndarray = None,
+            v: np.ndarray = None,
+            m: np.ndarray = None):
+        """
+        An N-body simulation
+        :param celestials: the objects, or None to give their positions, velocities and masses as arrays,
+            see from_arrays
+        :param force: force engine, "direct" for the O(N^2) direct sum, "tree" for the O(N log N) Barnes-Hut tree
+            or "mixed" for the direct sum with the pairwise interactions in single precision, see core.accel_mixed.
+            It is about twice as fast as the direct sum, but its relative force error of about 1e-7 limits the energy
+            conservation to a similar level, see bench.bench_precision. The state is always kept in double precision.
+        :param theta: opening angle of the Barnes-Hut tree, smaller is more accurate
+        :param n_threads: number of OpenMP threads, defaults to the OMP_NUM_THREADS environment variable
+        :param save_velocities: save also the velocities to v_hist
+        :param save_diagnostics: save the conservation diagnostics of each snapshot to diagnostics
+        :param central: index of the dominant object for the Wisdom-Holman integrator, defaults to the most massive
+        :param backend: compute backend, one of backends.BACKENDS. "auto" uses the Fortran core if it is available.
+        :param min_dist: softening length in the internal units,
+            which defaults to 1e-4 times the smallest absolute value of the initial coordinates
+        :param x: positions with the indices (celestial, dim), when the celestials are not given
+        :param v: velocities with the indices (celestial, dim), when the celestials are not given
+        :param m: masses, when the celestials are not given
+        """
+        if celestials is not None:
+            x = np.array([cel.x for cel in celestials])
+            v = np.array([cel.v for cel in celestials])
+            m = np.array([cel.m for cel in celestials])
+        elif x is None or v is None or m is None:
+            raise ValueError("Either the celestials or the arrays x, v and m must be given.")
+        else:
+            celestials = []
+        if force not in FORCES:
+            raise ValueError(f"Unknown force engine: {force}. Available: {FORCES}")
+        self.backend = backends.get_backend(backend)
+        if force not in self.backend.forces:
+            raise ValueError(f"The {self.backend.name} backend does not support the force engine: {force}")
+        if force == "tree" and theta <= 0:
+            raise ValueError("The opening angle of the tree must be positive.")
         self.celestials = celestials
         self.g = g
         self.dt = dt
         self.fix_scale = fix_scale
         self.com_frame = com_frame
+        self.force = force
+        self.theta = theta
+        self.n_threads = n_threads
+        self.central = int(np.argmax(m)) if central is None else central
 
         # Indices: (dim, celestial)
-        self.x = np.asfortranarray(np.array([cel.x for cel in celestials]).T)
-        self.v = np.asfortranarray(np.array([cel.v for cel in celestials]).T)
-        self.m = np.array([cel.m for cel in celestials], order="F")
-        self.a = np.zeros_like(self.x)
+        # The arrays are copied, so that the unit scaling does not modify those of the caller.
+        self.x = np.array(x, dtype=np.float64, order="C").T
+        self.v = np.array(v, dtype=np.float64, order="C").T
+        self.m = np.array(m, dtype=np.float64, order="F")
+        if self.x.shape != (3, self.m.size) or self.v.shape != self.x.shape:
+            raise ValueError(
+                f"The positions and velocities must have the shape ({self.m.size}, 3), "
+                f"got {self.x.T.shape} and {self.v.T.shape}")
 
         # The simulation did not work with the astrophysical values,
         # probably due to some floating-point errors, so this conversion was added as a fix.
@@ -119,13 +280,56 @@ class Simulation:
             total_m = np.sum(self.m)
             total_p = np.sum(self.m * self.v, axis=1)
             self.v = (self.v.T - total_p.T / total_m).T
-            print("Total momentum:", np.sum(self.m * self.v, axis=1))
+            logger.debug("Total momentum: %s", np.sum(self.m * self.v, axis=1))
             center_of_mass = np.sum(self.m * self.x, axis=1) / total_m
             self.x = (self.x.T - center_of_mass).T
-            print("Center of mass:", np.sum(self.m * self.x, axis=1) / total_m)
+            logger.debug("Center of mass: %s", np.sum(self.m * self.x, axis=1) / total_m)
 
-        self.min_dist = 1e-4*np.min(np.abs(self.x))
-        self.x_hist = []
+        self.min_dist = 1e-4*np.min(np.abs(self.x)) if min_dist is None else min_dist
+        # Accelerations with the indices (dim, celestial), which are computed when they are first needed, see a
+        self._a: tp.Optional[np.ndarray] = None
+        # Indices: (snapshot, dim, celestial)
+        self.x_hist = np.empty((0, *self.x.shape))
+        self.v_hist = np.empty((0, *self.v.shape)) if save_velocities else None
+        # Times of the snapshots (s)
+        self.t_hist = np.empty(0)
+        # Conservation diagnostics of each snapshot with DIAGNOSTICS_DTYPE in the internal units
+        self.diagnostics = np.empty(0, dtype=DIAGNOSTICS_DTYPE) if save_diagnostics else None
+        self.max_drift: tp.Optional[float] = None
+        # Number of rows of the diagnostics that have been filled
+        self._diag_done = 0
+        # Total energy of the first snapshot, which is kept when the run is resumed from a checkpoint
+        self._energy_ref: tp.Optional[float] = None
+        self.store: tp.Optional[store.TrajectoryStore] = None
+        self.integrator = "verlet"
+        self.rtol = 1e-9
+        self.atol = 1e-12
+        self.eta = 0.02
+        self.max_level = 10
+        # The step size of the adaptive integrator is carried over between runs
+        self.dt_adaptive = np.array(self.dt)
+        self._rk45_status = 0
+        # Number of evaluations of the forces of all the objects
+        self.n_force_evals = 0
+        # Simulated time in the internal units and the number of steps taken
+        self.t = 0.
+        self.n_steps = 0
+        # Time, step and timestep from which the times are counted, see _time
+        self._time_origin = (0., 0, self.dt)
+        # State of the block timestep integrator, which is initialized on its first run
+        self.jerk: tp.Optional[np.ndarray] = None
+        self.block_levels: tp.Optional[np.ndarray] = None
+        # Evaluations of the forces of single objects by the block timestep integrator,
+        # and the number that a global timestep would have needed
+        self.n_block_evals = np.array(0, dtype=np.int64)
+        self.n_block_evals_global = np.array(0, dtype=np.int64)
+        # Performance statistics of the latest run
+        self.stats: tp.Optional[RunStats] = None
+        self._callback: tp.Optional[tp.Callable[[RunStats], None]] = None
+        # Periodic checkpoints of the current run
+        self._checkpoint_path: tp.Optional[str] = None
+        self._checkpoint_interval = 0
+        self._snaps_since_checkpoint = 0
 
         # print("SIMULATION LOAD")
         # print("dt", self.dt)
@@ -140,33 +344,657 @@ class Simulation:
         # print(self.m.T)
         # print("LOAD DEBUG PRINT END")
 
-    def run(self, steps: int, save_interval: int, use_rk4: bool = False):
+    @classmethod
+    def from_arrays(cls, x: np.ndarray, v: np.ndarray, m: np.ndarray, dt: float, **kwargs) -> "Simulation":
+        """
+        Create a simulation from the arrays of the positions, velocities and masses,
+        e.g. of the generators of the ics module, without creating a Celestial for each object.
+        The celestials of the simulation are then empty.
+        :param x: positions with the indices (celestial, dim)
+        :param v: velocities with the indices (celestial, dim)
+        :param m: masses
+        :param kwargs: the other arguments of Simulation
+        """
+        return cls(None, dt, x=x, v=v, m=m, **kwargs)
+
+    @property
+    def theta_core(self) -> float:
+        """
+        The opening angle in the form used by the Fortran core,
+        where 0 selects the direct sum and a negative value the mixed-precision direct sum
+        """
+        if self.force == "tree":
+            return self.theta
+        return -1 if self.force == "mixed" else 0
+
+    @property
+    def n_threads_core(self) -> int:
+        """The number of threads in the form used by the Fortran core, where 0 keeps the default"""
+        return 0 if self.n_threads is None else self.n_threads
+
+    def force_error(self, n_sample: int = None) -> tp.Tuple[float, float]:
+        """
+        Relative error of the accelerations given by the selected force engine compared to the direct sum
+        :param n_sample: compare only this many randomly chosen objects to limit the cost of the direct sum for large N
+        :return: mean and maximum of the relative error
+        """
+        self.backend.set_threads(self.n_threads_core)
+        a, _ = self.backend.compute_accel(self.x, self.m, self.g, self.min_dist, self.theta_core)
+        if n_sample is None or n_sample >= self.m.size:
+            inds = np.arange(self.m.size)
+            a_direct = self.backend.accel_direct(self.x, self.m, self.g, self.min_dist)
+        else:
+            inds = np.random.default_rng().choice(self.m.size, size=n_sample, replace=False)
+            a_direct = self.backend.accel_direct(self.x, self.m, self.g, self.min_dist, inds)
+        a_norm = np.linalg.norm(a_direct, axis=0)
+        error = np.linalg.norm(a[:, inds] - a_direct, axis=0)
+        error = np.divide(error, a_norm, out=np.zeros_like(error), where=a_norm > 0)
+        logger.debug("Force error with theta=%s: mean %s, max %s", self.theta_core, np.mean(error), np.max(error))
+        return float(np.mean(error)), float(np.max(error))
+
+    @property
+    def a(self) -> np.ndarray:
+        """
+        Accelerations at the current positions with the indices (dim, celestial).
+        The velocity-Verlet steps and their compositions expect them, since starting from zero accelerations
+        would make the first step only first order accurate.
+        They are computed at the first use instead of in the constructor,
+        so that creating a large system does not wait for a force evaluation, which is O(N^2) for the direct sum.
+        """
+        if self._a is None:
+            self.backend.set_threads(self.n_threads_core)
+            self._a, _ = self.backend.compute_accel(self.x, self.m, self.g, self.min_dist, self.theta_core)
+        return self._a
+
+    @a.setter
+    def a(self, a: np.ndarray):
+        self._a = a
+
+    @property
+    def x_scale(self) -> float:
+        """Multiplier from the internal units of the positions to metres"""
+        return AU if self.fix_scale else 1
+
+    @property
+    def v_scale(self) -> float:
+        """Multiplier from the internal units of the velocities to metres per second"""
+        return AU / YEAR_IN_S if self.fix_scale else 1
+
+    @property
+    def t_scale(self) -> float:
+        """Multiplier from the internal units of time to seconds"""
+        return YEAR_IN_S if self.fix_scale else 1
+
+    def run(
+            self,
+            steps: int,
+            save_interval: int,
+            use_rk4: bool = False,
+            integrator: str = None,
+            rtol: float = 1e-9,
+            atol: float = 1e-12,
+            eta: float = 0.02,
+            max_level: int = 10,
+            max_drift: float = None,
+            store_path: str = None,
+            chunk_size: int = None,
+            observers: tp.Sequence[obs.Observer] = (),
+            store_history: bool = True,
+            callback: tp.Callable[[RunStats], None] = None,
+            checkpoint_path: str = None,
+            checkpoint_interval: int = None,
+            verbose: bool = False):
+        """
+        Simulate the given number of steps and save a snapshot after every save_interval steps.
+        The history is preallocated and filled by a single call to the Fortran core.
+        A further call continues the histories from the last snapshot.
+        :param use_rk4: shorthand for integrator="rk4"
+        :param integrator: one of INTEGRATORS, defaults to that of the previous run or of the resumed checkpoint,
+            and initially to velocity Verlet.
+            With the adaptive "rk45" the steps define only the total time and the times of the snapshots,
+            and dt is the initial step size.
+            The Wisdom-Holman "wh" solves the orbits around the central object analytically,
+            so that dt can be much longer than with the others for systems dominated by a single object.
+            With the "block" timesteps each object has its own step of dt/2**k for k <= max_level,
+            and only the objects whose step ends are evaluated. There dt is the longest step.
+        :param rtol: relative error tolerance of the adaptive integrator
+        :param atol: absolute error tolerance of the adaptive integrator in the internal units
+        :param eta: accuracy parameter of the block timesteps, which are at most eta*sqrt(|a|/|jerk|)
+        :param max_level: number of times the block timestep may be halved
+        :param max_drift: requires save_diagnostics. Stop the run with a RuntimeError when the relative error
+            of the total energy compared to the first snapshot exceeds this.
+            The histories then end at the first snapshot that exceeded it.
+        :param store_path: write the history of this run to a memory-mapped trajectory store instead of memory.
+            The history is written in chunks as the run progresses, and x_hist becomes a view to the store.
+        :param chunk_size: number of snapshots written to the store or given to the observers at a time
+        :param observers: streaming observers, which are given the snapshots as they are computed
+        :param store_history: if False, the snapshots are given only to the observers, and the memory use
+            does not grow with the number of snapshots
+        :param callback: called with the performance statistics after each batch of snapshots, see RunStats.
+            The statistics of the latest run are also available as stats.
+        :param checkpoint_path: write a checkpoint to this file at the end of the run, see checkpoint()
+        :param checkpoint_interval: write the checkpoint also after every this many snapshots.
+            The run is then advanced in batches that end at the checkpoints, which does not change the results
+            of the fixed-step integrators. The "rk45" and "wh" integrators restart at each batch,
+            so their results change within their accuracy.
+        :param verbose: print the state before the run
+        """
+        if integrator is None:
+            integrator = "rk4" if use_rk4 else self.integrator
+        if integrator not in INTEGRATORS:
+            raise ValueError(f"Unknown integrator: {integrator}. Available: {INTEGRATORS}")
+        if integrator not in self.backend.integrators:
+            raise ValueError(f"The {self.backend.name} backend does not support the integrator: {integrator}")
         if steps % save_interval != 0:
             raise ValueError("Steps must be a multiple of the save interval")
-        start_x = self.x.copy()
-        if self.fix_scale:
-            start_x *= AU
-        self.x_hist.append(start_x)
-        batches = steps // save_interval
-        self.print()
-        for i in range(batches):
-            print("Batch", i, "of", batches)
-            if use_rk4:
-                core.core.iterate_rk4(
-                    self.x, self.v, self.a, self.m, self.dt,
-                    n_steps=save_interval,
-                    g=self.g,
-                    min_dist=self.min_dist)
+        if store_path is not None and not store_history:
+            raise ValueError("A trajectory store cannot be used without storing the history")
+        if checkpoint_interval is not None and (checkpoint_path is None or checkpoint_interval < 1):
+            raise ValueError("The checkpoint interval must be positive and requires a checkpoint path")
+        if max_drift is not None and self.diagnostics is None:
+            raise ValueError("max_drift requires save_diagnostics")
+        self.integrator = integrator
+        self.rtol = rtol
+        self.atol = atol
+        self.eta = eta
+        self.max_level = max_level
+        self.max_drift = max_drift
+        self._update_time_origin()
+        if integrator == "block":
+            self._init_block()
+        else:
+            # Other integrators leave the jerks outdated
+            self.jerk = None
+            self.block_levels = None
+        n_snaps = steps // save_interval
+        self.stats = RunStats(integrator, self.m.size)
+        self._callback = callback
+        self._checkpoint_path = checkpoint_path
+        self._checkpoint_interval = 0 if checkpoint_interval is None else checkpoint_interval
+        self._snaps_since_checkpoint = 0
+        try:
+            self._run(n_snaps, save_interval, store_path, chunk_size, observers, store_history, verbose)
+            if checkpoint_path is not None:
+                self.checkpoint(checkpoint_path)
+        finally:
+            self.stats.finish()
+            self._callback = None
+            self._checkpoint_path = None
+            logger.debug("Run: %s", self.stats)
+
+    def _run(
+            self,
+            n_snaps: int,
+            save_interval: int,
+            store_path: tp.Optional[str],
+            chunk_size: tp.Optional[int],
+            observers: tp.Sequence[obs.Observer],
+            store_history: bool,
+            verbose: bool):
+        if store_path is not None:
+            self._run_to_store(store_path, n_snaps, save_interval, chunk_size, observers)
+            return
+        if not store_history:
+            self._observe(observers, self.x_scale * self.x[np.newaxis], self.v_scale * self.v[np.newaxis], self.t)
+            self._extend_diagnostics(n_snaps)
+            done = self._run_chunks(n_snaps, save_interval, chunk_size, observers)
+            if done < n_snaps:
+                self._abort()
+            return
+
+        # A continued run starts from the last snapshot of the previous run, which is not saved again
+        new = self.x_hist.shape[0] == 0
+        start = self.x_hist.shape[0] - (not new)
+        self.x_hist = extend_hist(self.x_hist, n_snaps + new)
+        self.t_hist = extend_hist(self.t_hist, n_snaps + new)
+        self.t_hist[start:] = self._time(self.n_steps + np.arange(n_snaps + 1) * save_interval) * self.t_scale
+        if new:
+            self.x_hist[start] = self.x_scale * self.x
+        v_hist = None
+        if self.v_hist is not None:
+            self.v_hist = extend_hist(self.v_hist, n_snaps + new)
+            if new:
+                self.v_hist[start] = self.v_scale * self.v
+            v_hist = self.v_hist[start + 1:]
+        if verbose:
+            self.print()
+        self._extend_diagnostics(n_snaps)
+        self.stats.add_memory(self.x_hist, self.v_hist, self.diagnostics)
+        t_start = self.t
+        n_done = self._advance(self.x_hist[start + 1:], v_hist, save_interval)
+        end = start + 1 + n_done
+        self._observe(
+            observers, self.x_hist[start:end], None if v_hist is None else self.v_hist[start:end],
+            t_start, save_interval)
+        if n_done < n_snaps:
+            self.x_hist = self.x_hist[:end]
+            self.t_hist = self.t_hist[:end]
+            if self.v_hist is not None:
+                self.v_hist = self.v_hist[:end]
+            self._abort()
+
+    def _observe(
+            self,
+            observers: tp.Sequence[obs.Observer],
+            x: np.ndarray,
+            v: tp.Optional[np.ndarray],
+            t_start: float,
+            save_interval: int = 0):
+        """Give snapshots to the observers, where the first snapshot is at t_start and the rest follow it"""
+        if not observers:
+            return
+        t = (t_start + np.arange(x.shape[0]) * save_interval * self.dt) * self.t_scale
+        for observer in observers:
+            observer.update(x, v, t)
+
+    def _run_chunks(
+            self,
+            n_snaps: int,
+            save_interval: int,
+            chunk_size: int,
+            observers: tp.Sequence[obs.Observer],
+            traj: store.TrajectoryStore = None) -> int:
+        """
+        Advance the simulation in chunks of snapshots, which are written to the trajectory store
+        or to a temporary buffer, and given to the observers
+        :return: number of snapshots written, which is smaller than requested if the run was aborted
+        """
+        if traj is None:
+            chunk_size = min(n_snaps, STREAM_CHUNK_SNAPS if chunk_size is None else chunk_size)
+            x_buf = np.empty((chunk_size, *self.x.shape))
+            v_buf = None if self.v_hist is None else np.empty((chunk_size, *self.v.shape))
+            self.stats.add_memory(x_buf, v_buf, self.diagnostics)
+        elif chunk_size is None:
+            chunk_size = max(1, STORE_CHUNK_BYTES // self.x.nbytes)
+        done = 0
+        while done < n_snaps:
+            n_chunk = min(chunk_size, n_snaps - done)
+            if traj is None:
+                x_slot = x_buf[:n_chunk]
+                v_slot = None if v_buf is None else v_buf[:n_chunk]
             else:
-                core.core.iterate(
-                    self.x, self.v, self.a, self.m, self.dt,
-                    n_steps=save_interval,
-                    g=self.g,
-                    min_dist=self.min_dist)
-            new_x = self.x.copy()
-            if self.fix_scale:
-                new_x *= AU
-            self.x_hist.append(new_x)
+                x_slot, v_slot = traj.slots(n_chunk)
+            t_start = self.t
+            n_done = self._advance(x_slot, v_slot, save_interval)
+            if traj is not None:
+                # An aborted run leaves a valid store that ends at the last completed snapshot
+                traj.commit(n_done)
+            self._observe(
+                observers, x_slot[:n_done], None if v_slot is None else v_slot[:n_done],
+                t_start + save_interval * self.dt, save_interval)
+            done += n_done
+            if n_done < n_chunk:
+                break
+        return done
+
+    def _diagnostics_row(self) -> np.ndarray:
+        """Conservation diagnostics of the current state"""
+        _, pot = self.backend.compute_accel(self.x, self.m, self.g, self.min_dist, self.theta_core)
+        row = np.zeros(1, dtype=DIAGNOSTICS_DTYPE)
+        row.view(np.float64)[:] = self.backend.diagnostics(self.x, self.v, self.m, pot)
+        return row[0]
+
+    def _extend_diagnostics(self, n_snaps: int):
+        """
+        Make room for the diagnostics of the next n_snaps snapshots,
+        after adding those of the current state if it is the first snapshot
+        """
+        if self.diagnostics is None:
+            return
+        self.diagnostics = extend_hist(self.diagnostics, n_snaps + (self._diag_done == 0))
+        if self._diag_done == 0:
+            self.diagnostics[0] = self._diagnostics_row()
+            self._diag_done = 1
+            if self._energy_ref is None:
+                self._energy_ref = float(self.diagnostics[0]["kinetic"] + self.diagnostics[0]["potential"])
+
+    def _abort(self):
+        """Raise the error of an aborted run, after which the diagnostics end at the last completed snapshot"""
+        if self.diagnostics is not None:
+            self.diagnostics = self.diagnostics[:self._diag_done]
+        if self.integrator == "rk45" and self._rk45_status != 0:
+            raise RuntimeError("The step size of the adaptive integrator became too small.")
+        diag = self.diagnostics[-1]
+        raise RuntimeError(
+            f"The relative energy drift exceeded {self.max_drift}: "
+            f"{(diag['kinetic'] + diag['potential']) / self.energy_ref - 1}")
+
+    @property
+    def energy_ref(self) -> float:
+        """Total energy of the first snapshot, which the energy drift is compared to"""
+        return self._energy_ref
+
+    def _advance(self, x_hist: np.ndarray, v_hist: tp.Optional[np.ndarray], save_interval: int) -> int:
+        """
+        Advance the simulation by one snapshot for each row of the given C-ordered history views.
+        With periodic checkpoints the snapshots are advanced in batches that end at the checkpoints.
+        :return: number of snapshots written, which is smaller than requested if the run was aborted
+        """
+        n_snaps = x_hist.shape[0]
+        done = 0
+        while done < n_snaps:
+            n_batch = n_snaps - done
+            if self._checkpoint_interval:
+                n_batch = min(n_batch, self._checkpoint_interval - self._snaps_since_checkpoint)
+            n_done = self._advance_batch(
+                x_hist[done:done + n_batch], None if v_hist is None else v_hist[done:done + n_batch], save_interval)
+            done += n_done
+            if n_done < n_batch:
+                break
+            self._snaps_since_checkpoint += n_done
+            if self._checkpoint_interval and self._snaps_since_checkpoint == self._checkpoint_interval:
+                self.checkpoint(self._checkpoint_path)
+                self._snaps_since_checkpoint = 0
+        return done
+
+    def _advance_batch(self, x_hist: np.ndarray, v_hist: tp.Optional[np.ndarray], save_interval: int) -> int:
+        """Advance the simulation as in _advance and record the batch in the statistics"""
+        n_force_evals = self.n_force_evals
+        start = time.perf_counter()
+        n_done = self._integrate(x_hist, v_hist, save_interval)
+        self.stats.add_batch(
+            n_done, n_done * save_interval, self.n_force_evals - n_force_evals, time.perf_counter() - start)
+        if self._callback is not None:
+            self._callback(self.stats)
+        return n_done
+
+    def _integrate(self, x_hist: np.ndarray, v_hist: tp.Optional[np.ndarray], save_interval: int) -> int:
+        """Call the compute backend for _advance_batch"""
+        n_snaps = x_hist.shape[0]
+        diag = None
+        if self.diagnostics is not None:
+            diag = self.diagnostics[self._diag_done:self._diag_done + n_snaps].view(np.float64).reshape(n_snaps, -1)
+        if self.integrator in ("rk45", "block", "wh"):
+            return self._advance_core(x_hist, v_hist, diag, save_interval)
+
+        n_done = self.backend.iterate_hist(
+            self.x, self.v, self.a, self.m, self.dt,
+            save_interval=save_interval,
+            g=self.g,
+            min_dist=self.min_dist,
+            x_hist=x_hist,
+            v_hist=v_hist,
+            x_scale=self.x_scale,
+            v_scale=self.v_scale,
+            use_rk4=self.integrator == "rk4",
+            theta=self.theta_core,
+            n_threads=self.n_threads_core,
+            order=SYMPLECTIC_ORDERS.get(self.integrator, 2),
+            diag=diag,
+            energy_ref=self.energy_ref if diag is not None else 0,
+            max_drift=0 if self.max_drift is None else self.max_drift)
+        self.n_force_evals += FORCE_EVALS_PER_STEP[self.integrator] * n_done * save_interval
+        # The symplectic integrators get the potential energy from their last force pass
+        return self._advanced(n_done, save_interval, potential_passes=self.integrator not in SYMPLECTIC_ORDERS)
+
+    def _advance_core(
+            self,
+            x_hist: np.ndarray,
+            v_hist: tp.Optional[np.ndarray],
+            diag: tp.Optional[np.ndarray],
+            save_interval: int) -> int:
+        """_integrate for the integrators that only the Fortran core provides"""
+        n_snaps = x_hist.shape[0]
+        core = self.backend.core
+        kwargs = {}
+        if v_hist is not None:
+            kwargs["v_hist"] = v_hist.T
+        if diag is not None:
+            kwargs["diag"] = diag.T
+            kwargs["energy_ref"] = self.energy_ref
+            kwargs["max_drift"] = 0 if self.max_drift is None else self.max_drift
+        # The transposes are Fortran-ordered views, which the core fills in place.
+        if self.integrator == "rk45":
+            n_evals = np.array(0, dtype=np.int32)
+            status, n_done = core.iterate_rk45(
+                self.x, self.v, self.a, self.m,
+                t_out=np.arange(1, n_snaps + 1) * save_interval * self.dt,
+                g=self.g,
+                min_dist=self.min_dist,
+                x_hist=x_hist.T,
+                rtol=self.rtol,
+                atol=self.atol,
+                dt_try=self.dt_adaptive,
+                n_evals=n_evals,
+                x_scale=self.x_scale,
+                v_scale=self.v_scale,
+                theta=self.theta_core,
+                n_threads=self.n_threads_core,
+                **kwargs)
+            self.n_force_evals += int(n_evals)
+            self._rk45_status = status
+            return self._advanced(n_done, save_interval, potential_passes=True)
+        if self.integrator == "block":
+            n_evals = self.n_block_evals.copy()
+            n_done = core.iterate_block(
+                self.x, self.v, self.a, self.jerk, self.block_levels, self.m, self.dt,
+                save_interval=save_interval,
+                g=self.g,
+                min_dist=self.min_dist,
+                x_hist=x_hist.T,
+                eta=self.eta,
+                max_level=self.max_level,
+                n_evals=self.n_block_evals,
+                n_evals_global=self.n_block_evals_global,
+                x_scale=self.x_scale,
+                v_scale=self.v_scale,
+                n_threads=self.n_threads_core,
+                **kwargs)
+            self.n_force_evals += round((self.n_block_evals - n_evals) / self.m.size)
+            return self._advanced(n_done, save_interval, potential_passes=True)
+        n_done = core.iterate_wh(
+            self.x, self.v, self.a, self.m, self.dt,
+            save_interval=save_interval,
+            g=self.g,
+            min_dist=self.min_dist,
+            x_hist=x_hist.T,
+            # The Fortran indexing starts from 1
+            central=self.central + 1,
+            x_scale=self.x_scale,
+            v_scale=self.v_scale,
+            theta=self.theta_core,
+            n_threads=self.n_threads_core,
+            **kwargs)
+        # The accelerations of the full system are computed at each snapshot with the diagnostics
+        # and otherwise once at the end
+        self.n_force_evals += FORCE_EVALS_PER_STEP[self.integrator] * n_done * save_interval
+        if self.diagnostics is None:
+            self.n_force_evals += 1
+        return self._advanced(n_done, save_interval, potential_passes=True)
+
+    def _advanced(self, n_done: int, save_interval: int, potential_passes: bool) -> int:
+        """Bookkeeping after advancing by n_done snapshots"""
+        self.n_steps += n_done * save_interval
+        self.t = float(self._time(self.n_steps))
+        if self.diagnostics is not None:
+            self._diag_done += n_done
+            if potential_passes:
+                self.n_force_evals += n_done
+        return n_done
+
+    def _update_time_origin(self):
+        """Count the times from the current state if the timestep has been changed"""
+        if self.dt != self._time_origin[2]:
+            self._time_origin = (self.t, self.n_steps, self.dt)
+
+    def _time(self, n_steps: tp.Union[int, np.ndarray]) -> tp.Union[float, np.ndarray]:
+        """
+        Time after the given numbers of steps in the internal units.
+        The times are computed from the step counter instead of being accumulated,
+        so that they do not depend on how a run was split into calls or resumed from a checkpoint.
+        """
+        t_origin, n_origin, _ = self._time_origin
+        return t_origin + (n_steps - n_origin) * self.dt
+
+    def _init_block(self):
+        if self.force != "direct":
+            raise ValueError("The block timesteps support only the direct force")
+        if self.jerk is None:
+            # The Fortran indexing starts from 1
+            self.a, self.jerk = self.backend.core.accel_jerk(
+                self.x, self.v, self.m, np.arange(1, self.m.size + 1, dtype=np.int32), self.g, self.min_dist)
+            self.block_levels = np.full(self.m.size, -1, dtype=np.int32)
+            self.n_force_evals += 1
+
+    @property
+    def block_savings(self) -> float:
+        """Fraction of the force evaluations that the block timesteps saved compared to a global timestep"""
+        if self.n_block_evals_global == 0:
+            return 0
+        return 1 - float(self.n_block_evals / self.n_block_evals_global)
+
+    def _run_to_store(
+            self,
+            path: str,
+            n_snaps: int,
+            save_interval: int,
+            chunk_size: int = None,
+            observers: tp.Sequence[obs.Observer] = ()):
+        traj = store.TrajectoryStore.create(
+            path,
+            n_objs=self.m.size,
+            capacity=n_snaps + 1,
+            dt=self.dt * self.t_scale,
+            save_interval=save_interval,
+            integrator=self.integrator,
+            units="m" if self.fix_scale else "simulation",
+            velocities=self.v_hist is not None,
+            t_start=self.t * self.t_scale
+        )
+        x_slot, v_slot = traj.slots(1)
+        x_slot[0] = self.x_scale * self.x
+        if v_slot is not None:
+            v_slot[0] = self.v_scale * self.v
+        traj.commit(1)
+        self._observe(observers, traj.x[-1:], None if traj.v is None else traj.v[-1:], self.t)
+        self._extend_diagnostics(n_snaps)
+        done = self._run_chunks(n_snaps, save_interval, chunk_size, observers, traj)
+
+        self.store = traj
+        self.x_hist = traj.x
+        self.t_hist = traj.t
+        if self.v_hist is not None:
+            self.v_hist = traj.v
+        if done < n_snaps:
+            self._abort()
+
+    def load_history(self, path: str):
+        """
+        Use the history of a trajectory store, e.g. for the GUI or plotting.
+        The store is mapped lazily, so it can be larger than the memory.
+        """
+        traj = store.TrajectoryStore(path)
+        if traj.header["n_objs"] != self.m.size:
+            raise ValueError("The trajectory store has a different number of objects than the simulation.")
+        self.store = traj
+        self.x_hist = traj.x
+        self.v_hist = traj.v
+        self.t_hist = traj.t
+
+    def checkpoint(self, path: str):
+        """
+        Write the state of the simulation to a checkpoint file, from which resume() continues the run.
+        The checkpoint is an uncompressed NumPy .npz archive. It is written to a temporary file,
+        which then replaces the previous checkpoint, so that an interrupted write leaves the previous one intact.
+        """
+        self._update_time_origin()
+        state = {
+            "version": CHECKPOINT_VERSION,
+            "x": self.x,
+            "v": self.v,
+            "a": self.a,
+            "m": self.m,
+            "t": self.t,
+            "n_steps": self.n_steps,
+            "t_origin": self._time_origin[0],
+            "n_origin": self._time_origin[1],
+            "dt": self.dt,
+            "g": self.g,
+            "min_dist": self.min_dist,
+            "fix_scale": self.fix_scale,
+            "force": self.force,
+            "theta": self.theta,
+            "central": self.central,
+            "integrator": self.integrator,
+            "rtol": self.rtol,
+            "atol": self.atol,
+            "eta": self.eta,
+            "max_level": self.max_level,
+            "dt_adaptive": self.dt_adaptive,
+            "n_force_evals": self.n_force_evals,
+            "n_block_evals": self.n_block_evals,
+            "n_block_evals_global": self.n_block_evals_global,
+            "energy_ref": np.nan if self._energy_ref is None else self._energy_ref,
+        }
+        if self.jerk is not None:
+            state["jerk"] = self.jerk
+            state["block_levels"] = self.block_levels
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as file:
+            np.savez(file, **state)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+        logger.debug("Checkpoint at step %s: %s", self.n_steps, path)
+
+    def resume(self, path: str):
+        """
+        Continue from a checkpoint written by checkpoint() or by run() with a checkpoint path.
+        The simulation should have been created with the same celestials.
+        The state, the time, the step counter, the integrator with its parameters and the unit scaling are restored,
+        so that run() gives bit-identical results to continuing the checkpointed simulation with the same backend.
+        The histories and the diagnostics start again from the checkpointed state, and their times carry on from it.
+        """
+        with np.load(path) as data:
+            if int(data["version"]) != CHECKPOINT_VERSION:
+                raise ValueError(f"Unsupported checkpoint version: {int(data['version'])}")
+            if data["m"].size != self.m.size:
+                raise ValueError("The checkpoint has a different number of objects than the simulation.")
+            force = str(data["force"])
+            if force not in self.backend.forces:
+                raise ValueError(f"The {self.backend.name} backend does not support the force engine: {force}")
+            self.x = np.asfortranarray(data["x"])
+            self.v = np.asfortranarray(data["v"])
+            self.a = np.asfortranarray(data["a"])
+            self.m = np.asfortranarray(data["m"])
+            self.t = float(data["t"])
+            self.n_steps = int(data["n_steps"])
+            self.dt = float(data["dt"])
+            self._time_origin = (float(data["t_origin"]), int(data["n_origin"]), self.dt)
+            self.g = float(data["g"])
+            self.min_dist = float(data["min_dist"])
+            self.fix_scale = bool(data["fix_scale"])
+            self.force = force
+            self.theta = float(data["theta"])
+            self.central = int(data["central"])
+            self.integrator = str(data["integrator"])
+            self.rtol = float(data["rtol"])
+            self.atol = float(data["atol"])
+            self.eta = float(data["eta"])
+            self.max_level = int(data["max_level"])
+            # The core updates these in place
+            self.dt_adaptive = np.array(data["dt_adaptive"])
+            self.n_force_evals = int(data["n_force_evals"])
+            self.n_block_evals = np.array(data["n_block_evals"], dtype=np.int64)
+            self.n_block_evals_global = np.array(data["n_block_evals_global"], dtype=np.int64)
+            energy_ref = float(data["energy_ref"])
+            self._energy_ref = None if np.isnan(energy_ref) else energy_ref
+            if "jerk" in data:
+                self.jerk = np.asfortranarray(data["jerk"])
+                self.block_levels = np.array(data["block_levels"], dtype=np.int32)
+            else:
+                self.jerk = None
+                self.block_levels = None
+        self._rk45_status = 0
+        self.store = None
+        self.x_hist = np.empty((0, *self.x.shape))
+        if self.v_hist is not None:
+            self.v_hist = np.empty((0, *self.v.shape))
+        self.t_hist = np.empty(0)
+        if self.diagnostics is not None:
+            self.diagnostics = np.empty(0, dtype=DIAGNOSTICS_DTYPE)
+        self._diag_done = 0
+        logger.debug("Resumed from the checkpoint at step %s: %s", self.n_steps, path)
 
     def print(self):
         print("Start:")
@@ -179,3 +1007,68 @@ class Simulation:
         print(self.v.T)
         print("a")
         print(self.a.T)
+
+
+class Ensemble:
+    def __init__(
+            self,
+            systems: tp.Union[tp.List[Celestial], tp.List[tp.List[Celestial]]],
+            dts: tp.Union[np.ndarray, tp.List[float]],
+            g: float = 1,
+            fix_scale: bool = False,
+            com_frame: bool = True,
+            n_threads: int = None):
+        """
+        A batch of independent simulations with the same number of objects,
+        which are all advanced by a single call to the Fortran core.
+        This avoids the Python overhead of running many small simulations such as timestep sweeps.
+        :param systems: a list of celestials for each system, or a single list of celestials for all the systems
+        :param dts: timestep of each system
+        """
+        dts = np.asarray(dts, dtype=float)
+        if systems and isinstance(systems[0], Celestial):
+            systems = [systems] * dts.size
+        if len(systems) != dts.size:
+            raise ValueError("There must be a timestep for each system.")
+        if len({len(system) for system in systems}) != 1:
+            raise ValueError("All systems must have the same number of objects.")
+
+        self.fix_scale = fix_scale
+        self.n_threads = n_threads
+        self.core = backends.FortranBackend().core
+        self.simulations = [
+            Simulation(system, dt=dt, g=g, fix_scale=fix_scale, com_frame=com_frame, backend="fortran")
+            for system, dt in zip(systems, dts)
+        ]
+        # Indices: (dim, celestial, system)
+        self.x = np.asfortranarray(np.stack([simulation.x for simulation in self.simulations], axis=-1))
+        self.v = np.asfortranarray(np.stack([simulation.v for simulation in self.simulations], axis=-1))
+        self.a = np.asfortranarray(np.stack([simulation.a for simulation in self.simulations], axis=-1))
+        self.m = np.asfortranarray(np.stack([simulation.m for simulation in self.simulations], axis=-1))
+        self.dts = np.array([simulation.dt for simulation in self.simulations])
+        self.g = np.array([simulation.g for simulation in self.simulations])
+        self.min_dist = np.array([simulation.min_dist for simulation in self.simulations])
+        # Indices: (snapshot, dim, celestial, system)
+        self.x_hist = np.empty((0, *self.x.shape))
+
+    def run(self, steps: int, save_interval: int, use_rk4: bool = False):
+        if steps % save_interval != 0:
+            raise ValueError("Steps must be a multiple of the save interval")
+        n_snaps = steps // save_interval
+        # A continued run starts from the last snapshot of the previous run, which is not saved again
+        new = self.x_hist.shape[0] == 0
+        start = self.x_hist.shape[0] - (not new)
+        self.x_hist = extend_hist(self.x_hist, n_snaps + new)
+        x_scale = AU if self.fix_scale else 1
+        if new:
+            self.x_hist[start] = x_scale * self.x
+        logger.debug("Running %s systems for %s snapshots", self.dts.size, n_snaps)
+        self.core.iterate_ensemble(
+            self.x, self.v, self.a, self.m, self.dts,
+            save_interval=save_interval,
+            g=self.g,
+            min_dist=self.min_dist,
+            x_hist=self.x_hist[start + 1:].T,
+            x_scale=x_scale,
+            use_rk4=use_rk4,
+            n_threads=0 if self.n_threads is None else self.n_threads)
@@ -0,0 +1,171 @@
+"""
+Memory-mapped on-disk storage for trajectories that do not fit in memory
+
+The file begins with a JSON header, which is padded to HEADER_SIZE bytes.
+It is followed by the positions as float64 with the indices (snapshot, dim, celestial),
+and optionally by the velocities in the same layout.
+"""
+
+import json
+import logging
+import os
+import typing as tp
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = "planetary-motion trajectory"
+VERSION = 1
+HEADER_SIZE = 4096
+
+
+class TrajectoryStore:
+    def __init__(self, path: str, mode: str = "r"):
+        """
+        Open an existing trajectory store. The data is mapped lazily, so only the accessed snapshots are read.
+        :param mode: "r" for read-only or "r+" for writing
+        """
+        self.path = path
+        self.mode = mode
+        with open(path, "rb") as file:
+            self.header = json.loads(file.read(HEADER_SIZE).rstrip(b"\0 ").decode())
+        if self.header.get("magic") != MAGIC:
+            raise ValueError(f"Not a trajectory store: {path}")
+        if self.header["version"] != VERSION:
+            raise ValueError(f"Unsupported trajectory store version: {self.header['version']}")
+
+        shape = (self.header["capacity"], 3, self.header["n_objs"])
+        self._x = np.memmap(path, dtype=np.float64, mode=mode, offset=HEADER_SIZE, shape=shape)
+        self._v = None
+        if self.header["velocities"]:
+            self._v = np.memmap(
+                path, dtype=np.float64, mode=mode, offset=HEADER_SIZE + self._x.nbytes, shape=shape)
+
+    @classmethod
+    def create(
+            cls,
+            path: str,
+            n_objs: int,
+            capacity: int,
+            dt: float,
+            save_interval: int,
+            integrator: str,
+            units: str = "m",
+            velocities: bool = False,
+            t_start: float = 0) -> "TrajectoryStore":
+        """
+        Create a store with room for the given number of snapshots
+        :param dt: timestep in the time unit corresponding to the units
+        :param units: unit of the positions, "m" for SI units
+        :param t_start: time of the first snapshot, e.g. of a run that was resumed from a checkpoint
+        """
+        header = {
+            "magic": MAGIC,
+            "version": VERSION,
+            "n_objs": n_objs,
+            "capacity": capacity,
+            "n_snaps": 0,
+            "dt": dt,
+            "save_interval": save_interval,
+            "units": units,
+            "integrator": integrator,
+            "velocities": velocities,
+            "t_start": t_start,
+        }
+        size = HEADER_SIZE + (2 if velocities else 1) * capacity * 3 * n_objs * np.dtype(np.float64).itemsize
+        with open(path, "wb") as file:
+            file.write(cls._encode_header(header))
+            # The file is extended to its full size without writing the data, which creates a sparse file.
+            file.truncate(size)
+        return cls(path, mode="r+")
+
+    @staticmethod
+    def _encode_header(header: tp.Dict[str, tp.Any]) -> bytes:
+        data = json.dumps(header).encode()
+        if len(data) > HEADER_SIZE:
+            raise ValueError("The header is too large.")
+        return data.ljust(HEADER_SIZE, b" ")
+
+    @property
+    def n_snaps(self) -> int:
+        """Number of snapshots written"""
+        return self.header["n_snaps"]
+
+    @property
+    def capacity(self) -> int:
+        return self.header["capacity"]
+
+    @property
+    def x(self) -> np.ndarray:
+        """Positions of the written snapshots with the indices (snapshot, dim, celestial)"""
+        return self._x[:self.n_snaps]
+
+    @property
+    def v(self) -> tp.Optional[np.ndarray]:
+        """Velocities of the written snapshots with the indices (snapshot, dim, celestial)"""
+        return None if self._v is None else self._v[:self.n_snaps]
+
+    @property
+    def t(self) -> np.ndarray:
+        """Times of the written snapshots in the units of dt"""
+        # The stores written before the resumable runs start from zero
+        t_start = self.header.get("t_start", 0)
+        return t_start + np.arange(self.n_snaps) * self.header["dt"] * self.header["save_interval"]
+
+    def slots(self, n_snaps: int) -> tp.Tuple[np.ndarray, tp.Optional[np.ndarray]]:
+        """Views to the next n_snaps unwritten snapshots, which are marked as written with commit()"""
+        if self.n_snaps + n_snaps > self.capacity:
+            raise ValueError("The trajectory store is full.")
+        end = self.n_snaps + n_snaps
+        return self._x[self.n_snaps:end], None if self._v is None else self._v[self.n_snaps:end]
+
+    def commit(self, n_snaps: int):
+        """Mark the given number of snapshots as written and flush them to the disk"""
+        self._x.flush()
+        if self._v is not None:
+            self._v.flush()
+        self.header["n_snaps"] += n_snaps
+        # The header is updated only after the data, so that an interrupted run leaves a valid file.
+        with open(self.path, "r+b") as file:
+            file.write(self._encode_header(self.header))
+            file.flush()
+            os.fsync(file.fileno())
+        logger.debug("Trajectory store %s: %s/%s snapshots", self.path, self.n_snaps, self.capacity)
+
+
+# Binary output of the Fortran CLI, see core.open_binary_output
+CLI_MAGIC = b"planetary-motion"
+CLI_HEADER_DTYPE = np.dtype([
+    ("magic", "S16"),
+    ("version", "=i4"),
+    ("n_objs", "=i4"),
+    ("n_records", "=i4"),
+    ("n_written", "=i4"),
+    ("write_interval", "=i4"),
+    ("padding", "=i4"),
+    ("dt", "=f8"),
+])
+CLI_HEADER_SIZE = 64
+
+
+def read_cli_output(path: str) -> tp.Tuple[np.void, np.ndarray]:
+    """
+    Map the binary output file of the Fortran CLI without copying
+    :return: the header and the written records. The records have the fields "iteration", "x", "v" and "a",
+        where the arrays have the indices (record, celestial, dim). Use e.g. records["x"].transpose(0, 2, 1)
+        to get a view with the indices (record, dim, celestial) of Simulation.x_hist.
+    """
+    header = np.fromfile(path, dtype=CLI_HEADER_DTYPE, count=1)[0]
+    if header["magic"] != CLI_MAGIC:
+        raise ValueError(f"Not a planetary-motion output file: {path}")
+    n_objs = int(header["n_objs"])
+    record_dtype = np.dtype([
+        ("iteration", "=i8"),
+        ("x", "=f8", (n_objs, 3)),
+        ("v", "=f8", (n_objs, 3)),
+        ("a", "=f8", (n_objs, 3)),
+    ])
+    records = np.memmap(
+        path, dtype=record_dtype, mode="r", offset=CLI_HEADER_SIZE, shape=(int(header["n_records"]),))
+    return header, records[:int(header["n_written"])]
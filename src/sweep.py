@@ -0,0 +1,169 @@
+"""
+Parallel parameter sweeps
+
+The timesteps of a sweep are split into chunks, which are simulated as ensembles in a process pool.
+The histories are written by the worker processes directly to a shared memory-mapped array,
+so that they don't have to be pickled back to the parent process.
+Alternatively the runs can be analyzed by streaming observers without storing their histories.
+"""
+
+import concurrent.futures
+import logging
+import math
+import os
+import tempfile
+import typing as tp
+
+import numpy as np
+
+import observers as obs
+import sim
+
+logger = logging.getLogger(__name__)
+
+# On Linux this is a RAM-backed file system, so the shared arrays don't touch the disk.
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# A function that takes a history of shape (runs, snapshots, dim, celestial), the timesteps of the runs and
+# the save interval, and returns an array with one row per run.
+Analyzer = tp.Callable[[np.ndarray, np.ndarray, int], np.ndarray]
+
+
+def _run_chunk(
+        celestials: tp.List[sim.Celestial],
+        dts: np.ndarray,
+        steps: int,
+        save_interval: int,
+        use_rk4: bool,
+        g: float,
+        fix_scale: bool,
+        n_threads: tp.Optional[int],
+        path: tp.Optional[str],
+        start: int,
+        analyze: tp.Optional[Analyzer]) -> tp.Tuple[int, tp.Optional[np.ndarray]]:
+    """Simulate a chunk of the sweep in a worker process"""
+    ensemble = sim.Ensemble(celestials, dts=dts, g=g, fix_scale=fix_scale, n_threads=n_threads)
+    ensemble.run(steps=steps, save_interval=save_interval, use_rk4=use_rk4)
+    # Indices: (run, snapshot, dim, celestial)
+    x_hist = np.moveaxis(ensemble.x_hist, -1, 0)
+    if analyze is not None:
+        return start, analyze(x_hist, dts, save_interval)
+    stack = np.load(path, mmap_mode="r+")
+    stack[start:start + dts.size] = x_hist
+    stack.flush()
+    return start, None
+
+
+def run_sweep(
+        celestials: tp.List[sim.Celestial],
+        dts: np.ndarray,
+        steps: int,
+        save_interval: int,
+        use_rk4: bool = False,
+        jobs: int = 1,
+        chunk_size: int = None,
+        g: float = sim.G,
+        fix_scale: bool = True,
+        analyze: Analyzer = None) -> np.ndarray:
+    """
+    Simulate the same initial conditions with each of the given timesteps
+    :param jobs: number of worker processes, 1 runs the sweep in the current process
+    :param chunk_size: number of timesteps simulated as one ensemble, defaults to an even split to the jobs
+    :param analyze: if given, the histories are reduced with this function in the workers,
+        which is necessary for sweeps whose histories would not fit in memory.
+        The function must be picklable, i.e. defined on the module level.
+    :return: the histories with the indices (run, snapshot, dim, celestial), or the stacked results of analyze
+    """
+    dts = np.asarray(dts, dtype=float)
+    if chunk_size is None:
+        chunk_size = math.ceil(dts.size / jobs)
+    starts = range(0, dts.size, chunk_size)
+    # With several processes each of them gets one core to avoid oversubscription
+    n_threads = 1 if jobs > 1 else None
+
+    path = None
+    if analyze is None:
+        fd, path = tempfile.mkstemp(prefix="planetary-motion-sweep-", suffix=".npy", dir=SHARED_DIR)
+        os.close(fd)
+    # A failed or interrupted sweep removes the file, since it would otherwise fill the shared memory until a reboot.
+    try:
+        if path is not None:
+            np.lib.format.open_memmap(
+                path, mode="w+", dtype=np.float64, shape=(dts.size, steps // save_interval + 1, 3, len(celestials))
+            ).flush()
+
+        tasks = [
+            (celestials, dts[start:start + chunk_size], steps, save_interval, use_rk4, g, fix_scale, n_threads,
+             path, start, analyze)
+            for start in starts
+        ]
+        if jobs == 1:
+            results = [_run_chunk(*task) for task in tasks]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(_run_chunk, *task) for task in tasks]
+                results = [future.result() for future in futures]
+        logger.debug("Sweep of %s timesteps completed in %s chunks", dts.size, len(tasks))
+
+        if analyze is not None:
+            return np.concatenate([result for _, result in sorted(results, key=lambda result: result[0])])
+
+        stack = np.load(path, mmap_mode="r+")
+    except BaseException:
+        if path is not None:
+            os.remove(path)
+        raise
+    # The mapping stays valid after the file has been removed, except on Windows, where the file is left behind.
+    try:
+        os.remove(path)
+    except OSError:
+        logger.warning("Could not remove the temporary sweep file: %s", path)
+    return stack
+
+
+def _observe_run(
+        celestials: tp.List[sim.Celestial],
+        dt: float,
+        steps: int,
+        save_interval: int,
+        integrator: str,
+        g: float,
+        fix_scale: bool,
+        n_threads: tp.Optional[int],
+        observer_factory: tp.Callable[[], obs.Observer]) -> obs.Observer:
+    """Simulate a single run of the sweep in a worker process"""
+    simulation = sim.Simulation(celestials, dt=dt, g=g, fix_scale=fix_scale, n_threads=n_threads)
+    observer = observer_factory()
+    simulation.run(steps, save_interval, integrator=integrator, observers=[observer], store_history=False)
+    return observer
+
+
+def observe_sweep(
+        celestials: tp.List[sim.Celestial],
+        dts: np.ndarray,
+        steps: int,
+        save_interval: int,
+        observer_factory: tp.Callable[[], obs.Observer],
+        integrator: str = "verlet",
+        jobs: int = 1,
+        g: float = sim.G,
+        fix_scale: bool = True) -> tp.List[obs.Observer]:
+    """
+    Simulate the same initial conditions with each of the given timesteps and analyze the runs with observers.
+    The histories are not stored, so the memory use of a run does not depend on the number of steps.
+    :param observer_factory: creates the observer of a run, e.g. observers.PeriodObserver.
+        It must be picklable, i.e. defined on the module level.
+    :return: the observer of each run
+    """
+    dts = np.asarray(dts, dtype=float)
+    n_threads = 1 if jobs > 1 else None
+    tasks = [
+        (celestials, dt, steps, save_interval, integrator, g, fix_scale, n_threads, observer_factory) for dt in dts
+    ]
+    if jobs == 1:
+        results = [_observe_run(*task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_observe_run, *zip(*tasks)))
+    logger.debug("Observed sweep of %s timesteps completed", dts.size)
+    return results
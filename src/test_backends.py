@@ -0,0 +1,107 @@
+"""Parity of the NumPy backend with the Fortran backend"""
+
+import numpy as np
+import pytest
+
+import backends
+import bench
+import sim
+
+# Relative tolerance of the forces and of the short runs, which differ only by the order of the summation
+RTOL = 1e-10
+# Larger than NUMPY_CHUNK_PAIRS // N, so that the NumPy backend computes the rows in several chunks
+N_CHUNKED = 600
+assert N_CHUNKED > backends.NUMPY_CHUNK_PAIRS // N_CHUNKED
+
+
+def assert_close(actual: np.ndarray, desired: np.ndarray, rtol: float = RTOL):
+    """Assert that the arrays agree relative to the largest element of the reference"""
+    np.testing.assert_allclose(actual, desired, rtol=0, atol=rtol * np.max(np.abs(desired)))
+
+
+@pytest.fixture(scope="module")
+def fortran() -> backends.Backend:
+    return backends.get_backend("fortran")
+
+
+@pytest.fixture(scope="module")
+def numpy_backend() -> backends.Backend:
+    return backends.get_backend("numpy")
+
+
+@pytest.mark.parametrize("n_objs", [2, 10, N_CHUNKED])
+def test_compute_accel(fortran, numpy_backend, n_objs):
+    x, _, _, m = bench.random_system(n_objs)
+    a_fortran, pot_fortran = fortran.compute_accel(x, m, 1, 1e-4)
+    a_numpy, pot_numpy = numpy_backend.compute_accel(x, m, 1, 1e-4)
+    assert_close(a_numpy, a_fortran)
+    assert pot_numpy == pytest.approx(pot_fortran, rel=RTOL)
+
+
+def test_accel_direct(fortran, numpy_backend):
+    x, _, _, m = bench.random_system(N_CHUNKED)
+    inds = np.array([0, 17, N_CHUNKED - 1])
+    assert_close(numpy_backend.accel_direct(x, m, 1, 1e-4, inds), fortran.accel_direct(x, m, 1, 1e-4, inds))
+
+
+def test_min_dist(fortran, numpy_backend):
+    """The pairs within min_dist are excluded by both backends"""
+    x = np.asfortranarray([[0., 1e-3, 1.], [0., 0., 0.], [0., 0., 0.]])
+    m = np.ones(3, order="F")
+    a_fortran, pot_fortran = fortran.compute_accel(x, m, 1, 1e-2)
+    a_numpy, pot_numpy = numpy_backend.compute_accel(x, m, 1, 1e-2)
+    assert_close(a_numpy, a_fortran)
+    assert pot_numpy == pytest.approx(pot_fortran, rel=RTOL)
+
+
+def test_diagnostics(fortran, numpy_backend):
+    x, v, _, m = bench.random_system(10)
+    m = np.asfortranarray(np.linspace(1, 2, 10))
+    _, pot = fortran.compute_accel(x, m, 1, 1e-4)
+    assert_close(numpy_backend.diagnostics(x, v, m, pot), fortran.diagnostics(x, v, m, pot))
+
+
+@pytest.mark.parametrize("integrator", ["verlet", "forest_ruth", "yoshida6", "rk4"])
+@pytest.mark.parametrize("n_objs", [10, N_CHUNKED])
+def test_iterate_hist(fortran, numpy_backend, integrator, n_objs):
+    n_snaps = 3
+    results = []
+    for backend in (fortran, numpy_backend):
+        x, v, _, m = bench.random_system(n_objs)
+        a, _ = backend.compute_accel(x, m, 1, 1e-4)
+        x_hist = np.empty((n_snaps, *x.shape))
+        v_hist = np.empty((n_snaps, *x.shape))
+        diag = np.empty((n_snaps, 11))
+        n_done = backend.iterate_hist(
+            x, v, a, m, 1e-3, save_interval=2, g=1, min_dist=1e-4, x_hist=x_hist, v_hist=v_hist, x_scale=2,
+            use_rk4=integrator == "rk4", order=sim.SYMPLECTIC_ORDERS.get(integrator, 2), diag=diag)
+        assert n_done == n_snaps
+        results.append((x, v, a, x_hist, v_hist, diag))
+    for fortran_arr, numpy_arr in zip(*results):
+        assert_close(numpy_arr, fortran_arr)
+
+
+def test_max_drift(fortran, numpy_backend):
+    """Both backends stop at the same snapshot when the energy drifts"""
+    n_done = []
+    for backend in (fortran, numpy_backend):
+        x, v, _, m = bench.random_system(10)
+        a, pot = backend.compute_accel(x, m, 1, 1e-4)
+        energy_ref = backend.diagnostics(x, v, m, pot)[:2].sum()
+        x_hist = np.empty((20, *x.shape))
+        diag = np.empty((20, 11))
+        # A long step makes the energy drift quickly
+        n_done.append(backend.iterate_hist(
+            x, v, a, m, 0.5, save_interval=1, g=1, min_dist=1e-4, x_hist=x_hist, diag=diag,
+            energy_ref=energy_ref, max_drift=1e-3))
+    assert n_done[0] < 20
+    assert n_done[0] == n_done[1]
+
+
+def test_incomplete_backend():
+    class Incomplete(backends.Backend):
+        def compute_accel(self, x, m, g, min_dist, theta=0):
+            return backends.get_backend("numpy").compute_accel(x, m, g, min_dist, theta)
+
+    with pytest.raises(TypeError):
+        Incomplete()
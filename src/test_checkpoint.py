@@ -0,0 +1,137 @@
+"""Bit-identical continuation of runs from the checkpoints of the Python version and of the Fortran CLI"""
+
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import ics
+import sim
+import store
+
+N_OBJS = 20
+DT = 1e-3
+MIN_DIST = 1e-3
+# Steps before and after the checkpoint
+STEPS = 200
+SAVE_INTERVAL = 10
+
+
+@pytest.fixture(scope="module")
+def system():
+    return ics.plummer(N_OBJS, seed=0)
+
+
+def new_simulation(system) -> sim.Simulation:
+    x, v, m = system
+    return sim.Simulation.from_arrays(
+        x, v, m, dt=DT, min_dist=MIN_DIST, save_velocities=True, save_diagnostics=True)
+
+
+@pytest.mark.parametrize("integrator", ["verlet", "yoshida6", "rk4", "block"])
+def test_resume(system, tmp_path, integrator):
+    full = new_simulation(system)
+    full.run(2 * STEPS, SAVE_INTERVAL, integrator=integrator)
+
+    path = str(tmp_path / "checkpoint.npz")
+    new_simulation(system).run(STEPS, SAVE_INTERVAL, integrator=integrator, checkpoint_path=path)
+    resumed = new_simulation(system)
+    resumed.resume(path)
+    # The integrator is restored from the checkpoint
+    resumed.run(STEPS, SAVE_INTERVAL)
+
+    # The histories of the resumed run start from the checkpointed snapshot
+    start = STEPS // SAVE_INTERVAL
+    assert resumed.integrator == integrator
+    assert np.array_equal(resumed.x_hist, full.x_hist[start:])
+    assert np.array_equal(resumed.v_hist, full.v_hist[start:])
+    assert np.array_equal(resumed.t_hist, full.t_hist[start:])
+    assert np.array_equal(resumed.diagnostics, full.diagnostics[start:])
+    assert np.array_equal(resumed.x, full.x)
+    assert np.array_equal(resumed.v, full.v)
+    assert resumed.t == full.t
+    assert resumed.n_steps == full.n_steps
+
+
+def test_checkpoint_interval(system, tmp_path):
+    """Periodic checkpoints split the run into batches without changing its results"""
+    full = new_simulation(system)
+    full.run(2 * STEPS, SAVE_INTERVAL)
+    path = str(tmp_path / "checkpoint.npz")
+    checkpointed = new_simulation(system)
+    checkpointed.run(2 * STEPS, SAVE_INTERVAL, checkpoint_path=path, checkpoint_interval=3)
+    assert np.array_equal(checkpointed.x_hist, full.x_hist)
+    assert np.array_equal(checkpointed.t_hist, full.t_hist)
+
+
+@pytest.fixture
+def cli_config(system, tmp_path) -> dict:
+    path = str(tmp_path / "ics.npy")
+    ics.save(path, *system)
+    return {
+        "initial_conditions": path,
+        "n_steps": 2 * STEPS,
+        "dt": DT,
+        "G": 1,
+        "min_dist": MIN_DIST,
+        "write_interval": SAVE_INTERVAL,
+        "print_interval": 2 * STEPS,
+        "print_format": "counter",
+        "output_format": "binary",
+        "checkpoint_interval": STEPS,
+    }
+
+
+def interrupt(cli, config: dict, path: str, reference: str):
+    """
+    Create the output folder of a run that was interrupted after the checkpoint half way,
+    when it had written two more records
+    """
+    # The checkpoint is taken from a run that stopped there
+    half_path = f"{path}-half"
+    cli(half_path, **{**config, "n_steps": STEPS})
+    shutil.copytree(reference, path)
+    shutil.copy(os.path.join(half_path, "checkpoint.bin"), os.path.join(path, "checkpoint.bin"))
+
+    output_path = os.path.join(path, "trajectory.bin")
+    header, records = store.read_cli_output(output_path)
+    n_written = STEPS // SAVE_INTERVAL + 2
+    header_map = np.memmap(output_path, dtype=store.CLI_HEADER_DTYPE, mode="r+", shape=(1,))
+    header_map["n_written"] = n_written
+    header_map.flush()
+    record_map = np.memmap(
+        output_path, dtype=records.dtype, mode="r+", offset=store.CLI_HEADER_SIZE, shape=(int(header["n_records"]),))
+    for field in ("x", "v", "a"):
+        record_map[field][n_written:] = np.nan
+    record_map.flush()
+
+
+def test_cli_resume(cli, cli_config, tmp_path):
+    reference = str(tmp_path / "reference")
+    cli(reference, **cli_config)
+    path = str(tmp_path / "interrupted")
+    interrupt(cli, cli_config, path, reference)
+
+    output = cli(path, **cli_config, resume="yes")
+    assert f"Resuming from the checkpoint at iteration {STEPS:>12}" in output
+    header, records = store.read_cli_output(os.path.join(path, "trajectory.bin"))
+    header_ref, records_ref = store.read_cli_output(os.path.join(reference, "trajectory.bin"))
+    assert header == header_ref
+    assert np.array_equal(records, records_ref)
+
+
+def test_cli_resume_mismatch(cli, cli_config, tmp_path):
+    """A resumed run with more steps than the interrupted one does not overwrite its output"""
+    reference = str(tmp_path / "reference")
+    cli(reference, **cli_config)
+    path = str(tmp_path / "interrupted")
+    interrupt(cli, cli_config, path, reference)
+    output_path = os.path.join(path, "trajectory.bin")
+    with open(output_path, "rb") as file:
+        before = file.read()
+
+    output = cli(path, **{**cli_config, "n_steps": 4 * STEPS}, resume="yes")
+    assert "The output file does not match the resumed run" in output
+    with open(output_path, "rb") as file:
+        assert file.read() == before
@@ -0,0 +1,48 @@
+"""Consistency of the streaming observers with the analysis of the full history"""
+
+import numpy as np
+import pytest
+
+import analysis
+import observers
+
+DT = 0.01
+N_SNAPS = 5000
+
+
+@pytest.fixture(scope="module")
+def x_hist() -> np.ndarray:
+    """Orbits in the xy plane whose angular velocities vary, so that the intervals between the crossings vary"""
+    t = np.arange(N_SNAPS) * DT
+    omega = np.array([0.2, 2, 3.5, 5])
+    phase = omega * t[:, np.newaxis] + 0.3 * np.sin(0.7 * t)[:, np.newaxis]
+    radius = np.array([0.5, 1, 2, 3])
+    x_hist = np.zeros((N_SNAPS, 3, omega.size))
+    x_hist[:, 0] = radius * np.cos(phase)
+    x_hist[:, 1] = radius * np.sin(phase)
+    return x_hist
+
+
+@pytest.mark.parametrize("splits", [[], [1, 8, 508, 511, 1745, 1746, 4999], np.arange(10, N_SNAPS, 10)])
+def test_period_observer(x_hist, splits):
+    """The same periods are obtained from uneven chunks as from the full history"""
+    t = np.arange(N_SNAPS) * DT
+    observer = observers.PeriodObserver()
+    bounds = [0, *splits, N_SNAPS]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        # A continued run gives the last snapshot of the previous chunk again
+        start = max(0, start - 1)
+        observer.update(x_hist[start:end], None, t[start:end])
+
+    periods = analysis.periods(x_hist, DT)
+    times, _ = analysis.crossing_times(x_hist, DT)
+    intervals = np.diff(times, axis=0)
+    n_intervals = np.sum(~np.isnan(intervals), axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        period_std = np.sqrt(
+            np.nansum((intervals - np.nanmean(intervals, axis=0))**2, axis=0) / (n_intervals - 1))
+    # The slowest object has a single interval, which gives a period but no standard deviation
+    assert n_intervals[0] == 1 and np.isnan(observer.period_std[0])
+    np.testing.assert_allclose(observer.periods, periods, rtol=1e-10)
+    np.testing.assert_allclose(observer.period_std, period_std, rtol=1e-10)
+    assert np.all(observer.period_std[1:] > 0)
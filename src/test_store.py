@@ -0,0 +1,95 @@
+"""Round trips of the trajectory store and of the binary output of the Fortran CLI"""
+
+import os
+
+import numpy as np
+import pytest
+
+import ics
+import sim
+import store
+
+N_OBJS = 30
+DT = 1e-3
+MIN_DIST = 1e-3
+
+
+def test_trajectory_store(tmp_path):
+    path = str(tmp_path / "trajectory.dat")
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(10, 3, N_OBJS))
+    v = rng.normal(size=x.shape)
+    traj = store.TrajectoryStore.create(
+        path, n_objs=N_OBJS, capacity=12, dt=0.5, save_interval=4, integrator="verlet", velocities=True, t_start=3)
+    # The snapshots are written in uneven chunks, and the last two slots are left unused
+    for start, end in [(0, 1), (1, 8), (8, 10)]:
+        x_slot, v_slot = traj.slots(end - start)
+        x_slot[:] = x[start:end]
+        v_slot[:] = v[start:end]
+        traj.commit(end - start)
+    with pytest.raises(ValueError):
+        traj.slots(3)
+
+    read = store.TrajectoryStore(path)
+    assert read.n_snaps == 10
+    assert read.capacity == 12
+    assert read.header["integrator"] == "verlet"
+    assert np.array_equal(read.x, x)
+    assert np.array_equal(read.v, v)
+    assert np.array_equal(read.t, 3 + np.arange(10) * 2.)
+
+
+def test_trajectory_store_run(tmp_path):
+    """A run to a store gives the same history as a run in memory"""
+    x, v, m = ics.plummer(N_OBJS, seed=0)
+    kwargs = {"dt": DT, "min_dist": MIN_DIST, "save_velocities": True}
+    in_memory = sim.Simulation.from_arrays(x, v, m, **kwargs)
+    in_memory.run(500, 10)
+    path = str(tmp_path / "trajectory.dat")
+    to_store = sim.Simulation.from_arrays(x, v, m, **kwargs)
+    to_store.run(500, 10, store_path=path, chunk_size=7)
+
+    read = store.TrajectoryStore(path)
+    assert np.array_equal(read.x, in_memory.x_hist)
+    assert np.array_equal(read.v, in_memory.v_hist)
+    # The store computes the times from the timestep and the save interval in its header
+    np.testing.assert_allclose(read.t, in_memory.t_hist, rtol=1e-14)
+
+
+def test_cli_output(cli, tmp_path):
+    """The CLI run of initial conditions from ics.save is bit-identical to the same run in Python"""
+    x, v, m = ics.plummer(N_OBJS, seed=0)
+    ics_path = str(tmp_path / "ics.npy")
+    ics.save(ics_path, x, v, m)
+    n_steps = 500
+    write_interval = 10
+    output_path = str(tmp_path / "output")
+    cli(
+        output_path,
+        initial_conditions=ics_path,
+        n_steps=n_steps,
+        dt=DT,
+        G=1,
+        min_dist=MIN_DIST,
+        write_interval=write_interval,
+        print_interval=n_steps,
+        print_format="counter",
+        output_format="binary")
+
+    # The CLI does not move to the center-of-mass frame
+    simulation = sim.Simulation.from_arrays(
+        *ics.load(ics_path), dt=DT, min_dist=MIN_DIST, com_frame=False, save_velocities=True)
+    simulation.run(n_steps, write_interval)
+
+    header, records = store.read_cli_output(os.path.join(output_path, "trajectory.bin"))
+    n_records = n_steps // write_interval
+    assert header["n_objs"] == N_OBJS
+    assert header["n_records"] == n_records
+    assert header["n_written"] == n_records
+    assert header["write_interval"] == write_interval
+    assert header["dt"] == DT
+    # The CLI does not write the initial state
+    assert np.array_equal(records["iteration"], np.arange(1, n_records + 1) * write_interval)
+    assert np.array_equal(records["x"].transpose(0, 2, 1), simulation.x_hist[1:])
+    assert np.array_equal(records["v"].transpose(0, 2, 1), simulation.v_hist[1:])
+    assert np.array_equal(records["a"][-1].T, simulation.a)
@@ -12,6 +12,11 @@ module utils
   integer, parameter :: REAL_KIND = 8
   integer, parameter :: CONFIG_FILE_UNIT = 10
   integer, parameter :: MAX_LINE_LEN = 100
+  integer, parameter :: ICS_FILE_UNIT = 13
+  ! Largest number of objects whose initial conditions are printed
+  integer, parameter :: MAX_PRINT_OBJS = 100
+  ! Columns of an initial-conditions file: x, v and m of each object
+  integer, parameter :: ICS_COLUMNS = 7
   character(len=*), parameter :: DEFAULT_CONFIG_PATH = "../run/config.txt"
 
   ! These should be declared in core.f90, but for F2PY compatiblity they have been declared here
@@ -134,19 +139,21 @@ contains
     close(CONFIG_FILE_UNIT)
   end function read_file_to_arr
 
-  subroutine read_config(path, x, v, m, dt, n_steps, n_objs, g, min_dist, print_interval, write_interval)
+  subroutine read_config(path, x, v, m, dt, n_steps, n_objs, g, min_dist, print_interval, write_interval, n_threads, &
+      output_format, print_format, checkpoint_interval, resume)
     use core
     implicit none
     !f2py integer, intent(aux) :: REAL_KIND
 
     character(len=*), intent(in) :: path
-    integer, intent(out) :: n_objs, n_steps, print_interval, write_interval
+    integer, intent(out) :: n_objs, n_steps, print_interval, write_interval, n_threads, output_format, print_format, &
+      checkpoint_interval, resume
     real(kind=REAL_KIND), allocatable, intent(out) :: m(:), x(:, :), v(:, :)
     real(kind=REAL_KIND), intent(out) :: dt
 
     real(kind=REAL_KIND) :: t, g, min_dist
-    character(len=MAX_LINE_LEN) line, trimmed, name, value, current_array
-    integer :: ios, i_line, arrays_started, scalars_started, delim_pos, arrays_allocated, array_index
+    character(len=MAX_LINE_LEN) line, trimmed, name, value, current_array, ics_path
+    integer :: ios, i_line, arrays_started, scalars_started, delim_pos, arrays_allocated, array_index, n_ics
 
     open(unit=CONFIG_FILE_UNIT, file=path, status="old", iostat=ios)
     if (ios /= 0) then
@@ -170,6 +177,12 @@ contains
     n_steps = -1
     print_interval = 0
     write_interval = 0
+    n_threads = 0
+    output_format = 0
+    print_format = 0
+    checkpoint_interval = 0
+    resume = 0
+    ics_path = ""
 
     i_line = 0
     scalars_started = 0
@@ -234,6 +247,39 @@ contains
           read(value, *, iostat=ios) print_interval
         else if (name == "write_interval") then
           read(value, *, iostat=ios) write_interval
+        else if (name == "n_threads") then
+          read(value, *, iostat=ios) n_threads
+        else if (name == "checkpoint_interval") then
+          read(value, *, iostat=ios) checkpoint_interval
+        else if (name == "initial_conditions") then
+          ics_path = adjustl(value)
+        else if (name == "resume") then
+          if (adjustl(value) == "yes") then
+            resume = 1
+          else if (adjustl(value) == "no") then
+            resume = 0
+          else
+            print *, "The value of resume must be yes or no: ", value
+            stop
+          end if
+        else if (name == "output_format") then
+          if (adjustl(value) == "text") then
+            output_format = 0
+          else if (adjustl(value) == "binary") then
+            output_format = 1
+          else
+            print *, "Unknown output format: ", value
+            stop
+          end if
+        else if (name == "print_format") then
+          if (adjustl(value) == "full") then
+            print_format = 0
+          else if (adjustl(value) == "counter") then
+            print_format = 1
+          else
+            print *, "Unknown print format: ", value
+            stop
+          end if
         end if
 
         if (ios /= 0) then
@@ -276,6 +322,20 @@ contains
     end do
     close(CONFIG_FILE_UNIT)
 
+    ! The initial conditions of large systems are read in bulk from a binary file instead of the arrays section
+    if (ics_path /= " ") then
+      if (arrays_allocated == 1) then
+        print *, "The arrays cannot be given both in the configuration and in the initial conditions file"
+        stop
+      end if
+      call read_initial_conditions(trim(ics_path), x, v, m, n_ics)
+      if (n_objs > 0 .and. n_objs /= n_ics) then
+        print *, "The initial conditions file has ", n_ics, " objects instead of the configured ", n_objs
+        stop
+      end if
+      n_objs = n_ics
+    end if
+
     ! Post-processing and checks
     if (bool2int(dt > 0) + bool2int(t > 0) + bool2int(n_steps > 0) /= 2) then
       print *, "Exactly two of td, t and n_steps must be configured"
@@ -288,4 +348,73 @@ contains
     end if
 
   end subroutine read_config
+
+  subroutine read_initial_conditions(path, x, v, m, n_objs)
+    ! Read the initial conditions from a NumPy .npy file written by ics.save in Python.
+    ! The file contains a little-endian float64 array with the shape (n_objs, ICS_COLUMNS) in the C order,
+    ! so that the data section is directly an array with the indices (column, object).
+    ! https://numpy.org/doc/stable/reference/generated/numpy.lib.format.html
+    implicit none
+    character(len=*), intent(in) :: path
+    real(kind=REAL_KIND), allocatable, intent(out) :: m(:), x(:, :), v(:, :)
+    integer, intent(out) :: n_objs
+
+    real(kind=REAL_KIND), allocatable :: data(:, :)
+    character(len=6) :: magic
+    character(len=1) :: major, minor
+    character(len=:), allocatable :: header
+    integer(kind=2) :: header_len_v1
+    integer(kind=4) :: header_len
+    integer :: ios, shape_start, shape_end, n_cols
+
+    open(unit=ICS_FILE_UNIT, file=path, status="old", access="stream", form="unformatted", action="read", iostat=ios)
+    if (ios /= 0) then
+      print *, "Opening the initial conditions file failed: ", path
+      stop
+    end if
+    read(ICS_FILE_UNIT, iostat=ios) magic, major, minor
+    if (ios /= 0 .or. magic /= char(147) // "NUMPY") then
+      print *, "Not a NumPy .npy file: ", path
+      stop
+    end if
+    ! The header length is a little-endian uint16 in version 1 and uint32 in the later versions
+    if (ichar(major) == 1) then
+      read(ICS_FILE_UNIT, iostat=ios) header_len_v1
+      header_len = iand(int(header_len_v1, kind=4), 65535)
+    else
+      read(ICS_FILE_UNIT, iostat=ios) header_len
+    end if
+    allocate(character(len=header_len) :: header)
+    read(ICS_FILE_UNIT, iostat=ios) header
+    if (ios /= 0) then
+      print *, "Could not read the header of the initial conditions file: ", path
+      stop
+    end if
+    if (index(header, "'descr': '<f8'") == 0 .or. index(header, "'fortran_order': False") == 0) then
+      print *, "The initial conditions must be little-endian float64 in the C order: ", header
+      stop
+    end if
+    shape_start = index(header, "'shape': (")
+    shape_end = shape_start + index(header(shape_start+1:), ")")
+    if (shape_start == 0 .or. shape_end == shape_start) then
+      print *, "Could not find the shape in the header of the initial conditions file: ", header
+      stop
+    end if
+    read(header(shape_start+10:shape_end-1), *, iostat=ios) n_objs, n_cols
+    if (ios /= 0 .or. n_cols /= ICS_COLUMNS) then
+      print *, "The initial conditions must have the shape (n_objs, ", ICS_COLUMNS, "): ", header
+      stop
+    end if
+
+    allocate(data(ICS_COLUMNS, n_objs))
+    read(ICS_FILE_UNIT, iostat=ios) data
+    if (ios /= 0) then
+      print *, "Could not read the data of the initial conditions file: ", path
+      stop
+    end if
+    close(ICS_FILE_UNIT)
+    x = data(1:3, :)
+    v = data(4:6, :)
+    m = data(7, :)
+  end subroutine read_initial_conditions
 end module utils